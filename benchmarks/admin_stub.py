@@ -0,0 +1,104 @@
+"""Minimal stand-in for the ACA-Py admin API used by the benchmarks.
+
+Wallet operations are modelled as a pool of connections, like askar's. Every
+operation waiting for a connection adds to the time each operation holds one,
+approximating the lock contention seen on a busy wallet.
+"""
+
+import asyncio
+from contextlib import contextmanager
+from os import getenv
+import threading
+from time import sleep
+from typing import Iterator
+from uuid import uuid4
+
+import fastapi
+import uvicorn
+
+WALLET_CONNECTIONS = int(getenv("STUB_WALLET_CONNECTIONS", "4"))
+WALLET_LATENCY = float(getenv("STUB_WALLET_LATENCY", "0.005"))
+CONTENTION_PENALTY = float(getenv("STUB_CONTENTION_PENALTY", "0.0005"))
+
+
+class Wallet:
+    """Simulated wallet with a bounded number of connections."""
+
+    def __init__(self):
+        """Initialize the wallet."""
+        self.connections = asyncio.Semaphore(WALLET_CONNECTIONS)
+        self.waiting = 0
+        self.operations = 0
+
+    async def transaction(self):
+        """Perform one wallet operation."""
+        self.waiting += 1
+        async with self.connections:
+            self.waiting -= 1
+            await asyncio.sleep(WALLET_LATENCY + CONTENTION_PENALTY * self.waiting)
+            self.operations += 1
+
+
+def create_app() -> fastapi.FastAPI:
+    """Create the stub admin API."""
+    app = fastapi.FastAPI()
+    wallet = Wallet()
+    app.state.wallet = wallet
+
+    @app.get("/status/live")
+    async def live():
+        return {"alive": True}
+
+    @app.post("/wallet/did/create")
+    async def did_create():
+        await wallet.transaction()
+        return {
+            "result": {"did": "did:key:z6MkstubstubstubstubstubstubstubstubstubstubZ"}
+        }
+
+    @app.get("/issue-credential-2.0/records/{cred_ex_id}")
+    async def cred_ex_v2(cred_ex_id: str):
+        await wallet.transaction()
+        return {
+            "cred_ex_record": {
+                "cred_ex_id": cred_ex_id,
+                "state": "offer-received",
+                "role": "holder",
+                "by_format": {"cred_offer": {"ld_proof": {}}},
+            }
+        }
+
+    @app.post("/issue-credential-2.0/records/{cred_ex_id}/send-request")
+    @app.post("/issue-credential/records/{cred_ex_id}/send-request")
+    async def send_request(cred_ex_id: str):
+        await wallet.transaction()
+        return {"cred_ex_id": cred_ex_id, "state": "request-sent"}
+
+    @app.post("/issue-credential-2.0/records/{cred_ex_id}/store")
+    @app.post("/issue-credential/records/{cred_ex_id}/store")
+    async def store(cred_ex_id: str):
+        await wallet.transaction()
+        return {
+            "cred_ex_id": cred_ex_id,
+            "state": "done",
+            "cred_id_stored": str(uuid4()),
+        }
+
+    return app
+
+
+@contextmanager
+def serve(port: int = 3101) -> Iterator[str]:
+    """Serve the stub admin API from a background thread, yielding its URL."""
+    server = uvicorn.Server(
+        uvicorn.Config(create_app(), host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
@@ -0,0 +1,176 @@
+"""Check partitioning and handoff of exchanges across local controller replicas.
+
+Starts the admin stub and `--replicas` controller processes in cluster mode,
+posts `--events` credential offers round-robin to the replicas, as a load
+balancer would, and checks from each replica's metrics that every event was
+handled by the replica owning its exchange on the hash ring. It then stops one
+replica, waits for the others to notice, and checks that a second round is
+handled entirely by the remaining replicas.
+
+Run from the repository root:
+
+    python -m benchmarks.cluster [--replicas 3] [--events 300]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+from time import monotonic
+from typing import Dict, List
+
+import aiohttp
+
+from src.cluster import HashRing, partition_key
+from src.events import Event
+from src.synthetic import generate
+
+from .admin_stub import serve
+
+RECEIVED = re.compile(
+    r'^controller_events_received_total\{topic="([^"]+)"\} (\S+)$', re.M
+)
+FORWARDED = re.compile(
+    r'^controller_cluster_forwarded_total\{outcome="forwarded"\} (\S+)$', re.M
+)
+
+
+def start_replicas(agent: str, ports: List[int]) -> Dict[str, subprocess.Popen]:
+    """Start a controller process for every port."""
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    replicas = {}
+    for port, url in zip(ports, urls):
+        env = dict(
+            os.environ,
+            AGENT=agent,
+            CLUSTER_SELF=url,
+            CLUSTER_PEERS=",".join(urls),
+            CLUSTER_HEALTH_INTERVAL="0.5",
+        )
+        replicas[url] = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src:app", "--port", str(port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return replicas
+
+
+async def wait_for(session: aiohttp.ClientSession, urls: List[str], members: int):
+    """Wait until every replica in urls sees the given number of members."""
+    deadline = monotonic() + 30
+    while monotonic() < deadline:
+        try:
+            seen = []
+            for url in urls:
+                async with session.get(f"{url}/cluster") as response:
+                    seen.append(len((await response.json())["members"]))
+            if all(count == members for count in seen):
+                return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("Replicas did not agree on the cluster members")
+
+
+async def counts(session: aiohttp.ClientSession, url: str) -> Dict[str, float]:
+    """Return the events received and forwarded by the replica at url."""
+    async with session.get(f"{url}/metrics") as response:
+        text = await response.text()
+    forwarded = FORWARDED.search(text)
+    return {
+        "received": sum(float(value) for _, value in RECEIVED.findall(text)),
+        "forwarded": float(forwarded.group(1)) if forwarded else 0.0,
+    }
+
+
+async def post_round(
+    session: aiohttp.ClientSession, urls: List[str], events: List[dict]
+) -> Dict[str, int]:
+    """Post events round-robin to urls; return the expected owner counts."""
+    ring = HashRing(urls)
+    expected = {url: 0 for url in urls}
+    for index, payload in enumerate(events):
+        url = urls[index % len(urls)]
+        async with session.post(
+            f"{url}/topic/issue_credential_v2_0/", json=payload
+        ) as response:
+            response.raise_for_status()
+        event = Event.from_raw("issue_credential_v2_0", json.dumps(payload).encode())
+        owner = ring.owner(partition_key(event) or "")
+        if owner:
+            expected[owner] += 1
+    return expected
+
+
+async def check(
+    session: aiohttp.ClientSession,
+    urls: List[str],
+    before: Dict[str, Dict[str, float]],
+    expected: Dict[str, int],
+) -> bool:
+    """Print and check the events each replica handled since before."""
+    ok = True
+    print(f"{'replica':28} {'expected':>9} {'handled':>8} {'forwarded':>10}")
+    for url in urls:
+        after = await counts(session, url)
+        handled = after["received"] - before[url]["received"]
+        forwarded = after["forwarded"] - before[url]["forwarded"]
+        print(f"{url:28} {expected[url]:9d} {handled:8.0f} {forwarded:10.0f}")
+        ok = ok and handled == expected[url]
+    return ok
+
+
+async def run(replicas: int, events: int, base_port: int) -> bool:
+    """Run both rounds; return whether every event went to its owner."""
+    ports = [base_port + index for index in range(replicas)]
+    with serve(port=3101) as agent:
+        processes = start_replicas(agent, ports)
+        urls = list(processes)
+        try:
+            async with aiohttp.ClientSession() as session:
+                await wait_for(session, urls, replicas)
+                payloads = list(generate("issue_credential_v2_0", events * 2, seed=1))
+                for payload in payloads:
+                    payload["state"] = "offer-received"
+
+                print(f"Round 1: {replicas} replicas")
+                before = {url: await counts(session, url) for url in urls}
+                expected = await post_round(session, urls, payloads[:events])
+                await asyncio.sleep(1)
+                ok = await check(session, urls, before, expected)
+
+                stopped, remaining = urls[0], urls[1:]
+                processes[stopped].terminate()
+                processes[stopped].wait()
+                await wait_for(session, remaining, replicas - 1)
+
+                print(f"\nRound 2: {stopped} stopped")
+                before = {url: await counts(session, url) for url in remaining}
+                expected = await post_round(session, remaining, payloads[events:])
+                await asyncio.sleep(1)
+                ok = await check(session, remaining, before, expected) and ok
+        finally:
+            for process in processes.values():
+                process.terminate()
+                process.wait()
+    print("\nEvery event was handled by its owner" if ok else "\nOwnership mismatch")
+    return ok
+
+
+def main():
+    """Parse arguments and run."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument("--base-port", type=int, default=8091)
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.replicas, args.events, args.base_port))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
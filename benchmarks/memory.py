@@ -0,0 +1,233 @@
+"""Measure memory used per webhook topic with tracemalloc.
+
+For each topic with a synthetic payload generator, this measures:
+
+- `payload_bytes`: size of the raw webhook body
+- `model_bytes`: memory held by one parsed model instance
+- `parse_peak_bytes`: peak allocation while parsing one payload
+- `retained_bytes_per_event`: memory still held after the controller handled
+  an event, e.g. in caches, timelines and queues
+- `handle_peak_bytes`: peak allocation while handling a burst of events
+
+Memory retained after all topics were handled is also attributed to the source
+files that allocated it. Results are compared with the last run recorded in
+`benchmarks/results/memory.jsonl` with the same options, the committed baseline;
+with `--check`, an increase of more than `--tolerance` exits with an error.
+With `--save`, the run is recorded as the new baseline, unless `--check` failed.
+
+Run from the repository root:
+
+    python -m benchmarks.memory [--check] [--save] [--events 500]
+"""
+
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import gc
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from .admin_stub import serve
+
+RESULTS = Path(__file__).parent / "results" / "memory.jsonl"
+TRACKED_FILES = ("src/", "pydantic/")
+
+
+def commit() -> Optional[str]:
+    """Return the current git commit, if any."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def traced() -> int:
+    """Return the currently traced memory after a full collection."""
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measure_model(topic: str, payloads: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Measure the memory held by parsed models of payloads."""
+    from src.synthetic import GENERATORS
+
+    _, model = GENERATORS[topic]
+    raws = [json.dumps(payload).encode() for payload in payloads]
+
+    tracemalloc.reset_peak()
+    before = traced()
+    model.parse_raw(raws[0])
+    parse_peak = tracemalloc.get_traced_memory()[1] - before
+
+    before = traced()
+    instances = [model.parse_raw(raw) for raw in raws]
+    model_bytes = (traced() - before) / len(instances)
+    del instances
+
+    return {
+        "payload_bytes": sum(len(raw) for raw in raws) / len(raws),
+        "model_bytes": model_bytes,
+        "parse_peak_bytes": parse_peak,
+    }
+
+
+async def measure_handling(
+    topic: str, payloads: List[Dict[str, Any]]
+) -> Dict[str, float]:
+    """Measure the memory retained and peak while the app handles payloads."""
+    from src import app
+    from src.dispatch import dispatcher
+    from src.loadgen import asgi_post
+
+    bodies = [json.dumps(payload).encode() for payload in payloads]
+    path = f"/topic/{topic}"
+    headers = {"content-type": "application/json"}
+
+    tracemalloc.reset_peak()
+    before = traced()
+    await asyncio.gather(*(asgi_post(app, path, headers, body) for body in bodies))
+    await dispatcher.join()
+    await asyncio.sleep(0.1)
+    after = traced()
+    return {
+        "retained_bytes_per_event": (after - before) / len(bodies),
+        "handle_peak_bytes": tracemalloc.get_traced_memory()[1] - before,
+    }
+
+
+async def run(events: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Measure every topic."""
+    from src import app
+    from src.synthetic import GENERATORS, generate
+
+    topics: Dict[str, Dict[str, float]] = {}
+    await app.router.startup()
+    try:
+        baseline = tracemalloc.take_snapshot()
+        for topic in GENERATORS:
+            payloads = list(generate(topic, events, seed=0, **options))
+            topics[topic] = {
+                **measure_model(topic, payloads),
+                **(await measure_handling(topic, payloads)),
+            }
+            del payloads
+        gc.collect()
+        retained = tracemalloc.take_snapshot().compare_to(baseline, "filename")
+    finally:
+        await app.router.shutdown()
+
+    by_file = {
+        os.path.relpath(stat.traceback[0].filename).split("site-packages/")[-1]: (
+            stat.size_diff
+        )
+        for stat in retained
+        if any(part in stat.traceback[0].filename for part in TRACKED_FILES)
+        and stat.size_diff > 0
+    }
+    return {"topics": topics, "retained_by_file": by_file}
+
+
+def compare(
+    previous: Dict[str, Any], current: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Return the metrics that grew by more than tolerance since previous."""
+    regressions = []
+    for topic, metrics in current["topics"].items():
+        for name, value in metrics.items():
+            before = previous.get("topics", {}).get(topic, {}).get(name)
+            if before and before > 0 and value > before * (1 + tolerance):
+                regressions.append(f"{topic} {name}: {before:.0f} -> {value:.0f}")
+    return regressions
+
+
+def main():
+    """Run the benchmark and record the results."""
+    parser = argparse.ArgumentParser(description="Memory benchmark per topic")
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--attachment-size", type=int, default=4096)
+    parser.add_argument("--subject-width", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args()
+
+    options = {
+        "attachment_size": args.attachment_size,
+        "subject_width": args.subject_width,
+    }
+    tracemalloc.start()
+    with serve() as url:
+        os.environ["AGENT"] = url
+        # Handle every topic, not only those the controller acts on
+        os.environ["WEBHOOK_ALLOW"] = "*"
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            result = asyncio.run(run(args.events, options))
+    tracemalloc.stop()
+
+    result = {
+        "commit": commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "events": args.events,
+        "options": options,
+        **result,
+    }
+
+    print(
+        f"{'topic':<24}"
+        + "".join(
+            f"{name:>26}" for name in result["topics"][next(iter(result["topics"]))]
+        )
+    )
+    for topic, metrics in result["topics"].items():
+        print(f"{topic:<24}" + "".join(f"{value:>26.0f}" for value in metrics.values()))
+    print("\nretained by file:")
+    for filename, size in sorted(
+        result["retained_by_file"].items(), key=lambda item: -item[1]
+    )[:15]:
+        print(f"  {size:>12}  {filename}")
+
+    previous = None
+    if RESULTS.exists():
+        runs = [json.loads(line) for line in RESULTS.read_text().splitlines() if line]
+        comparable = [
+            run
+            for run in runs
+            if run.get("options") == options and run.get("events") == args.events
+        ]
+        previous = comparable[-1] if comparable else None
+
+    regressions: List[str] = []
+    if previous is None:
+        print("\nno baseline with these options")
+    else:
+        regressions = compare(previous, result, args.tolerance)
+        if regressions:
+            print(f"\nregressions since {previous.get('commit')}:")
+            for regression in regressions:
+                print(f"  {regression}")
+        else:
+            print(f"\nno regressions since {previous.get('commit')}")
+
+    if regressions and args.check:
+        sys.exit(1)
+    if args.save:
+        RESULTS.parent.mkdir(exist_ok=True)
+        with RESULTS.open("a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
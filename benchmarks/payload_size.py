@@ -0,0 +1,108 @@
+"""Compare ICv2 webhook payloads with and without `--debug-webhooks`.
+
+Run from the repository root:
+
+    python -m benchmarks.payload_size
+"""
+
+import json
+from time import perf_counter
+from uuid import uuid4
+
+from src.models import V20CredExRecord
+
+ITERATIONS = 2000
+
+CREDENTIAL = {
+    "@context": [
+        "https://www.w3.org/2018/credentials/v1",
+        "https://w3id.org/citizenship/v1",
+    ],
+    "type": ["VerifiableCredential", "PermanentResident"],
+    "issuer": "did:sov:" + "V4SGRU86Z58d6TV7PBUe6f",
+    "issuanceDate": "2024-01-01",
+    "credentialSubject": {
+        "type": ["PermanentResident"],
+        "givenName": "Bob",
+        "familyName": "Builder",
+        "gender": "Male",
+        "birthCountry": "Bahamas",
+        "birthDate": "1958-07-17",
+    },
+}
+DETAIL = {"credential": CREDENTIAL, "options": {"proofType": "Ed25519Signature2018"}}
+FORMAT = "aries/ld-proof-vc-detail@v1.0"
+
+
+def message(type_: str, attach_key: str) -> dict:
+    """Return an issue-credential/2.0 message carrying the LD proof detail."""
+    return {
+        "@id": str(uuid4()),
+        "@type": f"https://didcomm.org/issue-credential/2.0/{type_}",
+        "formats": [{"attach_id": "ld_proof", "format": FORMAT}],
+        attach_key: [
+            {
+                "@id": "ld_proof",
+                "mime-type": "application/json",
+                "data": {"json": DETAIL},
+            }
+        ],
+    }
+
+
+def slim_payload() -> dict:
+    """Return the record summary sent without `--debug-webhooks`."""
+    return {
+        "cred_ex_id": str(uuid4()),
+        "connection_id": str(uuid4()),
+        "thread_id": str(uuid4()),
+        "role": "holder",
+        "initiator": "external",
+        "state": "offer-received",
+        "auto_offer": False,
+        "auto_issue": False,
+        "auto_remove": True,
+        "trace": False,
+        "created_at": "2024-01-01 00:00:00.000000Z",
+        "updated_at": "2024-01-01 00:00:00.000000Z",
+    }
+
+
+def debug_payload() -> dict:
+    """Return the full record sent with `--debug-webhooks`."""
+    return {
+        **slim_payload(),
+        "cred_proposal": message("propose-credential", "filters~attach"),
+        "cred_offer": message("offer-credential", "offers~attach"),
+        "by_format": {
+            "cred_proposal": {"ld_proof": DETAIL},
+            "cred_offer": {"ld_proof": DETAIL},
+        },
+    }
+
+
+def measure(payload: dict) -> tuple:
+    """Return serialized size and mean seconds to serialize, decode and validate."""
+    start = perf_counter()
+    for _ in range(ITERATIONS):
+        raw = json.dumps(payload)
+        V20CredExRecord.parse_obj(json.loads(raw))
+    elapsed = (perf_counter() - start) / ITERATIONS
+    return len(json.dumps(payload).encode()), elapsed
+
+
+def main():
+    """Print the comparison."""
+    slim_size, slim_time = measure(slim_payload())
+    debug_size, debug_time = measure(debug_payload())
+    print(f"{'payload':<10}{'bytes':>10}{'us/event':>12}")
+    print(f"{'debug':<10}{debug_size:>10}{debug_time * 1e6:>12.1f}")
+    print(f"{'slim':<10}{slim_size:>10}{slim_time * 1e6:>12.1f}")
+    print(
+        f"slim payloads are {1 - slim_size / debug_size:.0%} smaller and "
+        f"{debug_time / slim_time:.1f}x faster to handle"
+    )
+
+
+if __name__ == "__main__":
+    main()
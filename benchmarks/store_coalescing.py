@@ -0,0 +1,95 @@
+"""Compare storing a burst of credentials directly and through StoreBatcher.
+
+Both modes store through the dispatcher, as the controller does: every
+credential-received event is queued and its handler stores the credential,
+either directly or through the batcher.
+
+Run from the repository root:
+
+    python -m benchmarks.store_coalescing
+"""
+
+import asyncio
+import json
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+from uuid import uuid4
+
+from controller import Controller
+
+from src.dispatch import Dispatcher
+from src.events import Event
+from src.store import StoreBatcher
+
+from .admin_stub import serve
+
+BURST = 500
+TOPIC = "issue_credential_v2_0"
+
+
+async def dispatch_stores(
+    events: list, store: Callable[[str], Awaitable[Any]]
+) -> float:
+    """Queue events and return the seconds until every credential is stored."""
+    dispatcher = Dispatcher()
+
+    @dispatcher.handler(TOPIC, actions=["credential-received"])
+    async def _handle(body: Any):
+        await store(f"/issue-credential-2.0/records/{body['cred_ex_id']}/store")
+
+    dispatcher.start()
+    start = perf_counter()
+    for event in events:
+        await dispatcher.submit(event)
+    await dispatcher.join()
+    elapsed = perf_counter() - start
+    await dispatcher.stop()
+    return elapsed
+
+
+async def store_direct(url: str, events: list) -> float:
+    """Store every record as soon as its event is handled."""
+
+    async def _store(path: str):
+        return await Controller(url).post(path)
+
+    return await dispatch_stores(events, _store)
+
+
+async def store_batched(url: str, events: list) -> float:
+    """Store every record through the batcher."""
+
+    async def _store(path: str):
+        return await Controller(url).post(path)
+
+    batcher = StoreBatcher(_store)
+    batcher.start()
+    elapsed = await dispatch_stores(events, batcher.submit)
+    await batcher.stop()
+    return elapsed
+
+
+def main():
+    """Print the comparison."""
+    events = [
+        Event.from_raw(
+            TOPIC,
+            json.dumps(
+                {"cred_ex_id": str(uuid4()), "state": "credential-received"}
+            ).encode(),
+        )
+        for _ in range(BURST)
+    ]
+    with serve() as url:
+        direct = asyncio.run(store_direct(url, events))
+    with serve() as url:
+        batched = asyncio.run(store_batched(url, events))
+
+    print(f"{'mode':<10}{'seconds':>10}{'stores/s':>12}")
+    print(f"{'direct':<10}{direct:>10.2f}{BURST / direct:>12.1f}")
+    print(f"{'batched':<10}{batched:>10.2f}{BURST / batched:>12.1f}")
+    print(f"batched throughput is {direct / batched:.1f}x direct")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,43 @@
 from enum import Enum
 from os import getenv
-from typing import Any, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Type
 
 from controller import Controller
 from controller.logging import logging_to_stdout
 import fastapi
-from fastapi.params import Body
-
+from fastapi.params import Depends, Header, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from .admin import AdminController
+from .auth import require_admin_key
+from .batch import BatchEntry, BatchItemResult, BatchResult, BatchTooLarge, parse_batch
+from .deadletter import (
+    DeadLetter,
+    DeadLetterFilter,
+    DeadLetterList,
+    ReplayRequest,
+    ReplayResult,
+    dead_letters,
+    replay,
+)
+from .cluster import FORWARDED_HEADER, ClusterStatus, cluster
+from .dispatch import (
+    HIGH,
+    Draining,
+    Handler,
+    current_wallet,
+    dispatcher,
+    persist,
+    restore,
+)
+from .events import Event
+from .filtering import TopicFilter, TopicFilterMiddleware
+from .formats import LD_PROOF, V20CredExWebhook, connection_formats, offer_format
+from .forwarding import Forwarder, ForwardingMiddleware
+from .ingest import WS_INGEST, AdminEventStream, reconcile, websocket_url
+from .loadgen import Recorder, RecordingMiddleware
+from .metrics import REGISTRY
 from .models import (
     ConnRecord,
     DIDResult,
@@ -18,9 +49,25 @@ from .models import (
     V10CredentialExchange,
     V10PresentationExchange,
     V20CredExRecord,
-    V20CredExRecordDetail,
     V20PresExRecord,
 )
+from .openapi import document_models, request_body
+from .profiling import ProfilerBusy, dump_tasks, profile, require_profiling
+from .projection import Exchange, ExchangeList, ExchangeQuery, exchanges
+from .records import cred_ex_v2_records, get_cred_ex_v2_record
+from .signals import drain_before_exit
+from .staleness import MaxAge, StaleVerifier, list_exchanges
+from .statemachine import machine, normalize
+from .store import StoreBatcher
+from .streaming import (
+    EVENTS_STREAM,
+    Subscription,
+    broadcaster,
+    parse_filter,
+    require_events_stream,
+)
+from .timeline import ExchangeTimeline, timelines
+from .tracing import TracingMiddleware, setup_tracing, shutdown_tracing
 
 tag_metadata = [
     {"name": "connections", "description": "Connection related webhooks"},
@@ -28,22 +75,121 @@ tag_metadata = [
         "name": "credentials",
         "description": "Credential and Presentation related webhooks",
     },
+    {"name": "controller", "description": "Controller diagnostics"},
     {"name": "other", "description": "Miscellaneous webhooks"},
 ]
 
 app = fastapi.FastAPI(openapi_tags=tag_metadata)
+topic_filter = TopicFilter.from_env()
+app.add_middleware(TopicFilterMiddleware, topic_filter=topic_filter)
+app.add_middleware(TracingMiddleware)
 
 AGENT = getenv("AGENT", "http://localhost:3001")
+forwarder = Forwarder.from_env()
+forwarder.listeners.append(exchanges.publish)
+if EVENTS_STREAM:
+    forwarder.listeners.append(broadcaster.publish)
+if forwarder.sinks or forwarder.listeners:
+    app.add_middleware(ForwardingMiddleware, forwarder=forwarder)
+RECORD_WEBHOOKS = getenv("RECORD_WEBHOOKS")
+if RECORD_WEBHOOKS:
+    app.add_middleware(RecordingMiddleware, recorder=Recorder(RECORD_WEBHOOKS))
 did: Optional[str] = None
 
 
+async def store_record(path: str):
+    """Store a received credential."""
+    return await AdminController(AGENT).post(path)
+
+
+store_batcher = StoreBatcher(store_record)
+max_age = MaxAge.from_env()
+
+
+async def list_exchanges_in_state(topic: str, state: str) -> Dict[str, Any]:
+    """List the exchanges of topic in state."""
+    return await list_exchanges(AdminController(AGENT), topic, state)
+
+
+stale_verifier = StaleVerifier(list_exchanges_in_state)
+
+
+async def verify_stale(topic: str, record: Any, exchange_id: Optional[str]) -> Any:
+    """Return the record to act on for a credential exchange event.
+
+    If the event exceeds its topic's maximum age, this is the current record
+    of the exchange, or None if the exchange has moved on.
+    """
+    if (
+        not exchange_id
+        or not max_age.stale(topic, record.updated_at)
+        or not machine.acts_on(topic, record.role, record.state)
+    ):
+        return record
+    current = await stale_verifier.verify(topic, record.state, exchange_id)
+    if current is None:
+        print(f"Exchange {exchange_id} has moved on from stale {record.state} event")
+    return current
+
+
+async def submit_event(event: Event) -> str:
+    """Queue event, or pass it to the cluster replica owning its exchange.
+
+    Returns whether the event was queued, forwarded to its owner or dropped
+    as a duplicate.
+    """
+    if await cluster.route(event):
+        return "forwarded"
+    if not await dispatcher.submit(event):
+        return "duplicate"
+    return "queued"
+
+
+async def ingest_event(event: Event, forwarded: bool = False) -> str:
+    """Forward and dispatch an event received other than on /topic/*.
+
+    Returns whether the event was queued, forwarded to the cluster replica
+    owning its exchange, ignored by the topic filter or dropped as a
+    duplicate. Raises ValueError for an event a webhook route would reject
+    with 422, and Draining while shutting down.
+
+    The event is published to the sinks, the event stream and the projection
+    only once these checks passed, so refused events are published when
+    retried and duplicates not again. Ignored events are published like the
+    webhooks the topic filter answers. An event forwarded by another replica
+    was already published by it and is always queued here.
+    """
+    dispatcher.check(event)
+    if dispatcher.draining:
+        raise Draining()
+    if not topic_filter.allows(event.topic, event.raw_body):
+        status = "ignored"
+    elif forwarded:
+        status = "queued" if await dispatcher.submit(event) else "duplicate"
+    else:
+        status = await submit_event(event)
+    if not forwarded and status != "duplicate":
+        await forwarder.publish(event)
+    return status
+
+
+async def reconcile_agent():
+    """Dispatch exchanges awaiting action that may have been missed."""
+    count = await reconcile(AdminController(AGENT), submit_event)
+    print(f"Reconciled {count} exchanges awaiting action")
+
+
+admin_events = AdminEventStream(websocket_url(AGENT), ingest_event, reconcile_agent)
+
+
 @app.on_event("startup")
 async def on_startup():
     """Startup event."""
     logging_to_stdout()
+    setup_tracing()
     global did
     print("Creating did:key for agent: ", AGENT)
-    controller = Controller(AGENT)
+    controller = AdminController(AGENT)
     result = await controller.post(
         "/wallet/did/create",
         json={"method": "key"},
@@ -51,6 +197,38 @@ async def on_startup():
     )
     assert result.result
     did = result.result.did
+    machine.compile()
+    store_batcher.start()
+    forwarder.start()
+    dispatcher.start()
+    cluster.start()
+    await restore(dispatcher)
+    if WS_INGEST:
+        admin_events.start()
+    drain_before_exit(drain)
+
+
+async def drain():
+    """Refuse new events, then handle or persist the queued ones.
+
+    Runs on SIGTERM while the server still answers webhooks with 503, and
+    again, without effect, on shutdown.
+    """
+    await admin_events.stop()
+    unfinished = await dispatcher.stop()
+    # Stores of cancelled handlers either finish or are skipped before persisting
+    await store_batcher.stop()
+    persist(unfinished)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Shutdown event."""
+    await drain()
+    await cluster.stop()
+    await forwarder.stop()
+    await exchanges.flush()
+    shutdown_tracing()
 
 
 class Tags(Enum):
@@ -58,184 +236,646 @@ class Tags(Enum):
 
     credentials = "credentials"
     connections = "connections"
+    controller = "controller"
     other = "other"
 
 
-@app.post("/topic/connections", summary="Connection updates", tags=[Tags.connections])
-@app.post("/topic/connections/", include_in_schema=False)
+async def receive_event(topic: str, request: fastapi.Request):
+    """Queue the webhook in request as an event for topic's handler."""
+    body = await request.body()
+    try:
+        event = Event.from_raw(topic, body, request.headers.get("x-wallet-id"))
+    except ValueError:
+        raise fastapi.HTTPException(422, "Webhook body is not JSON")
+    try:
+        dispatcher.check(event)
+    except ValueError as error:
+        raise fastapi.HTTPException(422, f"Invalid webhook: {error}")
+    try:
+        await submit_event(event)
+    except Draining:
+        # ACA-Py retries the webhook, reaching another instance
+        raise fastapi.HTTPException(503, "Shutting down", headers={"Retry-After": "1"})
+
+
+def webhook(
+    topic: str,
+    model: Optional[Type[BaseModel]] = None,
+    actions: Iterable[str] = (),
+    priority: Optional[str] = None,
+    **kwargs: Any,
+) -> Callable[[Handler], Handler]:
+    """Route webhooks for topic through the dispatcher to the decorated handler.
+
+    The handler is called with the body parsed as model and acts on the
+    states in actions, in the dispatcher's priority lane; kwargs are passed
+    to the route.
+    """
+
+    def _decorator(func: Handler) -> Handler:
+        dispatcher.handler(topic, model, actions, priority)(func)
+
+        async def _receive(request: fastapi.Request):
+            return await receive_event(topic, request)
+
+        route = app.post(
+            f"/topic/{topic}",
+            name=func.__name__,
+            description=func.__doc__,
+            openapi_extra=request_body(model) if model else None,
+            **kwargs,
+        )
+        route(_receive)
+        app.post(f"/topic/{topic}/", include_in_schema=False)(_receive)
+        return func
+
+    return _decorator
+
+
+@webhook(
+    "connections", ConnRecord, summary="Connection updates", tags=[Tags.connections]
+)
 async def connections(body: ConnRecord):
     """Connections webhook."""
     print("connections topic called with:", body.json(indent=2))
+    await machine.handle(
+        "connections",
+        body.their_role,
+        body.state,
+        body.connection_id,
+        body,
+        current_wallet(),
+    )
 
 
-@app.post(
-    "/topic/oob_invitation", summary="Out-of-band updates", tags=[Tags.connections]
+@webhook(
+    "oob_invitation",
+    InvitationRecord,
+    summary="Out-of-band updates",
+    tags=[Tags.connections],
 )
-@app.post("/topic/oob_invitation", include_in_schema=False)
 async def oob_invitation(body: InvitationRecord):
     """Out-of-band webhook."""
     print("oob_invitation topic called with:", body.json(indent=2))
 
 
-@app.post("/topic/mediation", summary="Mediation updates", tags=[Tags.connections])
-@app.post("/topic/mediation", include_in_schema=False)
+@webhook(
+    "mediation", MediationRecord, summary="Mediation updates", tags=[Tags.connections]
+)
 async def mediation(body: MediationRecord):
     """Mediation webhook."""
     print("mediation topic called with:", body.json(indent=2))
 
 
-@app.post(
-    "/topic/revocation_registry",
+@webhook(
+    "revocation_registry",
+    IssuerRevRegRecord,
     summary="Revocation registry updates",
     tags=[Tags.credentials],
 )
-@app.post("/topic/revocation_registry", include_in_schema=False)
 async def revocation_registry(body: IssuerRevRegRecord):
     """Revocation registry webhook."""
     print("revocation_registry topic called with:", body.json(indent=2))
 
 
-@app.post(
-    "/topic/issuer_cred_rev",
+@webhook(
+    "issuer_cred_rev",
+    IssuerCredRevRecord,
     summary="Credential revocation updates (issuer)",
     tags=[Tags.credentials],
 )
-@app.post("/topic/issuer_cred_rev", include_in_schema=False)
 async def issuer_cred_rev(body: IssuerCredRevRecord):
     """Issuer cred rev webhook."""
     print("issuer_cred_rev topic called with:", body.json(indent=2))
 
 
-@app.post(
-    "/topic/issue_credential",
+@machine.on("issue_credential", "holder", "offer_received")
+async def request_credential_v1(cred_rec: V10CredentialExchange):
+    """Request the offered credential."""
+    print("Received credential offer, sending credential request")
+    cred_request = await AdminController(AGENT).post(
+        f"/issue-credential/records/{cred_rec.credential_exchange_id}/send-request",
+    )
+    timelines.action(
+        "issue_credential", cred_rec.credential_exchange_id, "send-request"
+    )
+    print("Credential request sent:", cred_request)
+
+
+@machine.on("issue_credential", "holder", "credential_received")
+async def store_credential_v1(cred_rec: V10CredentialExchange):
+    """Store the received credential."""
+    print("Received credential with id:", cred_rec.credential_exchange_id)
+
+    await store_batcher.submit(
+        f"/issue-credential/records/{cred_rec.credential_exchange_id}/store",
+    )
+    timelines.action(
+        "issue_credential", cred_rec.credential_exchange_id, "store", final=True
+    )
+    print("Credential stored.")
+
+
+@webhook(
+    "issue_credential",
+    V10CredentialExchange,
+    actions=machine.action_states("issue_credential"),
     summary="Credential exchange updates",
     tags=[Tags.credentials],
 )
-@app.post("/topic/issue_credential", include_in_schema=False)
 async def issue_credential(body: V10CredentialExchange):
     """ICv1 webhook."""
     print("issue_credential topic called with:", body.json(indent=2))
 
-    controller = Controller(AGENT)
-    cred_rec = body
-    if cred_rec.state == "offer_received":
-        print("Received credential offer, sending credential request")
-        cred_request = await controller.post(
-            f"/issue-credential/records/{cred_rec.credential_exchange_id}/send-request",
-        )
-        print("Credential request sent:", cred_request)
-    elif cred_rec.state == "credential_received":
-        print("Received credential with id:", cred_rec.credential_exchange_id)
+    timelines.state("issue_credential", body.credential_exchange_id, body.state)
+    cred_rec = await verify_stale("issue_credential", body, body.credential_exchange_id)
+    if cred_rec is None:
+        return
+    if not await machine.handle(
+        "issue_credential",
+        cred_rec.role,
+        cred_rec.state,
+        cred_rec.credential_exchange_id,
+        cred_rec,
+        current_wallet(),
+    ):
+        print("Taking no action.")
 
-        await controller.post(
-            f"/issue-credential/records/{cred_rec.credential_exchange_id}/store",
-        )
-        print("Credential stored.")
+
+async def send_cred_request_v2(
+    controller: Controller, cred_rec: V20CredExRecord, fmt: str
+):
+    """Send an ICv2 credential request, including the holder DID for LD proofs."""
+    return await controller.post(
+        f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}/send-request",
+        json={"holder_did": did} if fmt == LD_PROOF else {},
+    )
+
+
+@machine.on("issue_credential_v2_0", "holder", "offer-received")
+async def request_credential_v2(cred_rec: V20CredExRecord):
+    """Request the offered credential in the offer's format."""
+    print("Received credential offer, sending credential request")
+
+    controller = AdminController(AGENT)
+    detected = offer_format(cred_rec)
+    guessed = False
+    if not detected:
+        detected = connection_formats.guess(cred_rec.connection_id)
+        guessed = detected is not None
+    if not detected:
+        cred_rec = await get_cred_ex_v2_record(controller, cred_rec)
+        detected = offer_format(cred_rec)
+    if not detected:
+        raise ValueError("Expected credential offer by format")
+
+    try:
+        cred_request = await send_cred_request_v2(controller, cred_rec, detected)
+    except Exception:
+        if not guessed:
+            raise
+        print("Guessed offer format was wrong, retrieving offer")
+        connection_formats.forget(cred_rec.connection_id)
+        # Not cached: the failed request may have changed the exchange
+        cred_ex_v2_records.evict(cred_rec.cred_ex_id)
+        cred_rec = await get_cred_ex_v2_record(controller, cred_rec)
+        if normalize(cred_rec.state or "") != "offer-received":
+            raise ValueError(
+                f"Exchange {cred_rec.cred_ex_id} is {cred_rec.state} after a request "
+                "in the guessed offer format failed"
+            )
+        detected = offer_format(cred_rec)
+        if not detected:
+            raise ValueError("Expected credential offer by format")
+        cred_request = await send_cred_request_v2(controller, cred_rec, detected)
+
+    connection_formats.learn(cred_rec.connection_id, detected)
+    timelines.action("issue_credential_v2_0", cred_rec.cred_ex_id, "send-request")
+    print("Credential request sent:", cred_request)
+
+
+@machine.on("issue_credential_v2_0", "holder", "credential-received")
+async def store_credential_v2(cred_rec: V20CredExRecord):
+    """Store the received credential."""
+    if cred_rec.cred_issue:
+        print("Received credential:", cred_rec.cred_issue.json(indent=2))
     else:
-        print("Taking no action.")
+        print("Received credential with id:", cred_rec.cred_ex_id)
+
+    await store_batcher.submit(
+        f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}/store",
+    )
+    timelines.action("issue_credential_v2_0", cred_rec.cred_ex_id, "store", final=True)
+    print("Credential stored.")
+    cred_ex_v2_records.evict(cred_rec.cred_ex_id)
 
 
-@app.post(
-    "/topic/issue_credential_v2_0",
+@webhook(
+    "issue_credential_v2_0",
+    V20CredExWebhook,
+    actions=machine.action_states("issue_credential_v2_0"),
     summary="Credential exchange v2 updates",
     tags=[Tags.credentials],
 )
-@app.post("/topic/issue_credential_v2_0", include_in_schema=False)
-async def issue_credential_v2_0(body: V20CredExRecord):
+async def issue_credential_v2_0(body: V20CredExWebhook):
     """ICv2 webhook."""
     print("issue_credential_v2_0 topic called with:", body.json(indent=2))
 
-    controller = Controller(AGENT)
-    cred_rec = body
-    if not cred_rec.by_format:
-        cred_rec = (await controller.get(
-            f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}",
-            response=V20CredExRecordDetail,
-        )).cred_ex_record
-        assert cred_rec
-
-    if cred_rec.state == "offer-received":
-        print("Received credential offer, sending credential request")
-
-        if not cred_rec.by_format:
-            cred_rec = (await controller.get(
-                f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}",
-                response=V20CredExRecordDetail,
-            )).cred_ex_record
-            assert cred_rec
-        assert cred_rec.by_format
-        if not cred_rec.by_format.cred_offer:
-            raise ValueError("Expected credential offer by format")
-
-        cred_request = await controller.post(
-            f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}/send-request",
-            json={"holder_did": did} if "ld_proof" in cred_rec.by_format.cred_offer else {}
-        )
-        print("Credential request sent:", cred_request)
-    elif cred_rec.state == "credential-received":
-        if cred_rec.cred_issue:
-            print("Received credential:", cred_rec.cred_issue.json(indent=2))
-        else:
-            print("Received credential with id:", cred_rec.cred_ex_id)
-
-        await controller.post(
-            f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}/store",
-        )
-        print("Credential stored.")
-    else:
+    timelines.state("issue_credential_v2_0", body.cred_ex_id, body.state)
+    cred_rec = await verify_stale("issue_credential_v2_0", body, body.cred_ex_id)
+    if cred_rec is None:
+        return
+    if not await machine.handle(
+        "issue_credential_v2_0",
+        cred_rec.role,
+        cred_rec.state,
+        cred_rec.cred_ex_id,
+        cred_rec,
+        current_wallet(),
+    ):
         print("Taking no action.")
 
 
-@app.post(
-    "/topic/present_proof",
+@webhook(
+    "present_proof",
+    V10PresentationExchange,
+    priority=HIGH,
     summary="Presentation exchange updates",
     tags=[Tags.credentials],
 )
-@app.post("/topic/present_proof", include_in_schema=False)
 async def present_proof(body: V10PresentationExchange):
     """PPv1 webhook."""
     print("present_proof topic called with:", body.json(indent=2))
+    await machine.handle(
+        "present_proof",
+        body.role,
+        body.state,
+        body.presentation_exchange_id,
+        body,
+        current_wallet(),
+    )
 
 
-@app.post(
-    "/topic/present_proof_v2_0",
+@webhook(
+    "present_proof_v2_0",
+    V20PresExRecord,
+    priority=HIGH,
     summary="Presentation exchange v2 updates",
     tags=[Tags.credentials],
 )
-@app.post("/topic/present_proof_v2_0", include_in_schema=False)
 async def present_proof_v2_0(body: V20PresExRecord):
     """PPv2 webhook."""
     print("present_proof_v2_0 topic called with:", body.json(indent=2))
+    await machine.handle(
+        "present_proof_v2_0",
+        body.role,
+        body.state,
+        body.pres_ex_id,
+        body,
+        current_wallet(),
+    )
 
 
-@app.post("/topic/discover_feature", summary="Discover Feature 1.0", tags=[Tags.other])
-@app.post("/topic/discover_feature", include_in_schema=False)
+@webhook("discover_feature", summary="Discover Feature 1.0", tags=[Tags.other])
 async def discover_feature(body: Any):
     """Discover Features v1 webhook."""
     print("discover_feature topic called with:", body)
 
 
-@app.post(
-    "/topic/discover_feature_v2_0", summary="Discover Feature 2.0", tags=[Tags.other]
-)
-@app.post("/topic/discover_feature_v2_0", include_in_schema=False)
+@webhook("discover_feature_v2_0", summary="Discover Feature 2.0", tags=[Tags.other])
 async def discover_feature_v2_0(body: Any):
     """Discover feature v2 webhook."""
     print("discover_feature_v2_0 topic called with:", body)
 
 
-@app.post(
-    "/topic/endorse_transaction",
+@webhook(
+    "endorse_transaction",
+    TransactionRecord,
     summary="Endorse Transaction updates",
     tags=[Tags.other],
 )
-@app.post("/topic/endorse_transaction", include_in_schema=False)
 async def endorse_transaction(body: TransactionRecord):
     """Endorse transaction webhook."""
     print("endorse_transaction topic called with:", body.json(indent=2))
 
 
-@app.post("/topic/{topic}")
-async def webhook_received(topic: str, body: Any = Body(...)):
+@app.post(
+    "/topics/batch",
+    summary="Batch of webhooks",
+    tags=[Tags.other],
+    response_model=BatchResult,
+    openapi_extra=request_body(BatchEntry, many=True),
+)
+async def topics_batch(request: fastapi.Request, validate: bool = True):
+    """Webhooks as a JSON array or newline delimited JSON of entries.
+
+    Every entry is handled like a webhook on its topic's route, and its
+    outcome is reported in order: `queued`, `forwarded` to the cluster
+    replica owning its exchange, `ignored` by the topic filter, `duplicate`,
+    `invalid`, or `refused` while shutting down. With validate, payloads are
+    checked against their topic's model before any is queued.
+    """
+    if dispatcher.draining:
+        raise fastapi.HTTPException(503, "Shutting down", headers={"Retry-After": "1"})
+    try:
+        parsed = parse_batch(
+            await request.body(), dispatcher.validate if validate else None
+        )
+    except BatchTooLarge:
+        raise fastapi.HTTPException(413, "Too many entries in batch")
+    except ValueError:
+        raise fastapi.HTTPException(422, "Batch is not a JSON array or NDJSON")
+
+    forwarded = FORWARDED_HEADER in request.headers
+    results = []
+    for index, item in enumerate(parsed):
+        if isinstance(item, ValueError):
+            results.append(
+                BatchItemResult(index=index, status="invalid", error=str(item))
+            )
+            continue
+        try:
+            status = await ingest_event(item, forwarded)
+        except Draining:
+            status = "refused"
+        except ValueError as error:
+            results.append(
+                BatchItemResult(index=index, status="invalid", error=str(error))
+            )
+            continue
+        results.append(BatchItemResult(index=index, status=status, topic=item.topic))
+    return BatchResult(results=results)
+
+
+@app.get(
+    "/cluster",
+    summary="Cluster membership",
+    tags=[Tags.controller],
+    response_model=ClusterStatus,
+)
+async def cluster_status():
+    """Replicas of the cluster and those currently sharing its exchanges.
+
+    Replicas check each other's health with this route.
+    """
+    return cluster.status(dispatcher.draining)
+
+
+@app.get(
+    "/dead-letters",
+    summary="List dead letters",
+    tags=[Tags.controller],
+    response_model=DeadLetterList,
+    dependencies=[Depends(require_admin_key)],
+)
+async def list_dead_letters(
+    topic: Optional[str] = None,
+    state: Optional[str] = None,
+    exchange_id: Optional[str] = None,
+    error: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """Events whose handler failed, oldest first.
+
+    error matches dead letters whose error contains it.
+    """
+    criteria = DeadLetterFilter(
+        topic=topic, state=state, exchange_id=exchange_id, error=error
+    )
+    return await dead_letters.list(criteria, limit, offset)
+
+
+@app.get(
+    "/dead-letters/{id}",
+    summary="Get a dead letter",
+    tags=[Tags.controller],
+    response_model=DeadLetter,
+    dependencies=[Depends(require_admin_key)],
+)
+async def get_dead_letter(id: int):
+    """Event whose handler failed, with its error."""
+    stored = await dead_letters.get(id)
+    if not stored:
+        raise fastapi.HTTPException(404, f"No dead letter {id}")
+    return stored.letter
+
+
+@app.delete(
+    "/dead-letters/{id}",
+    summary="Discard a dead letter",
+    tags=[Tags.controller],
+    status_code=204,
+    dependencies=[Depends(require_admin_key)],
+)
+async def discard_dead_letter(id: int):
+    """Remove a dead letter without replaying it."""
+    if not await dead_letters.remove(id):
+        raise fastapi.HTTPException(404, f"No dead letter {id}")
+
+
+@app.post(
+    "/dead-letters/replay",
+    summary="Replay dead letters",
+    tags=[Tags.controller],
+    response_model=ReplayResult,
+    dependencies=[Depends(require_admin_key)],
+)
+async def replay_dead_letters(request: ReplayRequest):
+    """Submit the dead letters matching the request again.
+
+    Up to `limit` letters, oldest first, are submitted `concurrency` at a time
+    like webhooks, reporting whether each was `queued`, `forwarded` to the
+    cluster replica owning its exchange or dropped as a `duplicate`. Submitted
+    letters are removed, and kept as new dead letters if they fail again;
+    letters that could not be submitted are `failed` and keep the error.
+    """
+    if dispatcher.draining:
+        raise fastapi.HTTPException(503, "Shutting down", headers={"Retry-After": "1"})
+    letters = await dead_letters.select(request, request.limit)
+    return await replay(dead_letters, letters, submit_event, request.concurrency)
+
+
+@app.get(
+    "/metrics",
+    summary="Controller metrics",
+    tags=[Tags.other],
+    response_class=PlainTextResponse,
+)
+async def metrics():
+    """Metrics in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+@app.get(
+    "/exchanges",
+    summary="Query exchanges",
+    tags=[Tags.controller],
+    response_model=ExchangeList,
+    dependencies=[Depends(require_admin_key)],
+)
+async def query_exchanges(
+    topic: Optional[str] = None,
+    wallet_id: Optional[str] = None,
+    connection_id: Optional[str] = None,
+    role: Optional[str] = None,
+    state: Optional[List[str]] = Query(None),
+    thread_id: Optional[str] = None,
+    updated_after: Optional[str] = None,
+    updated_before: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """Latest known records of credential and presentation exchanges.
+
+    Exchanges are served from the controller's projection of the webhooks it
+    received, most recently updated first. state may be repeated or comma
+    separated.
+    """
+    query = ExchangeQuery(
+        topic=topic,
+        wallet_id=wallet_id,
+        connection_id=connection_id,
+        role=role,
+        state=sorted(parse_filter(state)) if state else None,
+        thread_id=thread_id,
+        updated_after=updated_after,
+        updated_before=updated_before,
+    )
+    return await exchanges.query(query, limit, offset)
+
+
+@app.get(
+    "/exchanges/slow",
+    summary="Slowest recent exchanges",
+    tags=[Tags.controller],
+    response_model=List[ExchangeTimeline],
+    dependencies=[Depends(require_admin_key)],
+)
+async def slow_exchanges(limit: int = 20, min_duration: float = 0):
+    """Timelines of the slowest recently seen exchanges, slowest first."""
+    return timelines.slowest(limit, min_duration)
+
+
+@app.get(
+    "/exchanges/{exchange_id}/timeline",
+    summary="Exchange timeline",
+    tags=[Tags.controller],
+    response_model=ExchangeTimeline,
+    dependencies=[Depends(require_admin_key)],
+)
+async def exchange_timeline(exchange_id: str):
+    """Timeline of a recently seen exchange."""
+    timeline = timelines.get(exchange_id)
+    if not timeline:
+        raise fastapi.HTTPException(404, f"No timeline for exchange {exchange_id}")
+    return timeline
+
+
+@app.get(
+    "/exchanges/{exchange_id}",
+    summary="Get an exchange",
+    tags=[Tags.controller],
+    response_model=Exchange,
+    dependencies=[Depends(require_admin_key)],
+)
+async def get_exchange(
+    exchange_id: str, wallet_id: Optional[str] = None, topic: Optional[str] = None
+):
+    """Latest known record of an exchange.
+
+    Exchanges of different wallets or topics sharing the id are told apart
+    with wallet_id and topic, otherwise the most recently updated is returned.
+    """
+    exchange = await exchanges.get(exchange_id, wallet_id, topic)
+    if not exchange:
+        raise fastapi.HTTPException(404, f"No exchange {exchange_id}")
+    return exchange
+
+
+@app.get(
+    "/events",
+    summary="Stream webhook events",
+    tags=[Tags.controller],
+    response_class=StreamingResponse,
+    dependencies=[Depends(require_admin_key), Depends(require_events_stream)],
+)
+async def stream_events(
+    request: fastapi.Request,
+    topic: Optional[List[str]] = Query(None),
+    state: Optional[List[str]] = Query(None),
+    connection_id: Optional[str] = None,
+    last_event_id: Optional[int] = Header(None),
+):
+    """Server-sent events of accepted webhooks.
+
+    Filters may be repeated or comma separated. Each event's data is a JSON
+    object of its topic, wallet_id and payload; a `dropped` event reports
+    how many events were dropped because the subscriber fell behind.
+    """
+    subscription = Subscription(
+        topics=parse_filter(topic),
+        states=parse_filter(state),
+        connection=connection_id,
+    )
+    return StreamingResponse(
+        broadcaster.stream(
+            subscription, request.is_disconnected, last_event_id=last_event_id
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get(
+    "/debug/profile",
+    summary="Profile the controller",
+    tags=[Tags.controller],
+    response_class=PlainTextResponse,
+    dependencies=[Depends(require_admin_key), Depends(require_profiling)],
+)
+async def debug_profile(seconds: float = 10, interval: float = 0.005):
+    """Sample the event loop for seconds, returning collapsed stacks.
+
+    The result can be rendered with flame graph tools such as speedscope.
+    """
+    try:
+        return await profile(seconds, interval)
+    except ProfilerBusy:
+        raise fastapi.HTTPException(409, "A profile is already running")
+
+
+@app.get(
+    "/debug/tasks",
+    summary="Dump asyncio tasks",
+    tags=[Tags.controller],
+    response_class=PlainTextResponse,
+    dependencies=[Depends(require_admin_key), Depends(require_profiling)],
+)
+async def debug_tasks():
+    """Stacks of all running asyncio tasks."""
+    return dump_tasks()
+
+
+@dispatcher.failure_handler
+async def dead_letter(event: Event, error: Exception):
+    """Keep an event whose handler failed for replay."""
+    id = await dead_letters.add(event, error)
+    print(f"Kept {event!r} as dead letter {id}")
+
+
+@dispatcher.fallback_handler
+async def webhook_received(topic: str, body: Any):
     """Catch-all webhook."""
     print(f"/topic/{topic}", body)
+
+
+@app.post("/topic/{topic}")
+async def catch_all(topic: str, request: fastapi.Request):
+    """Catch-all webhook."""
+    return await receive_event(topic, request)
+
+
+document_models(
+    app, [BatchEntry] + [model for model, _ in dispatcher.handlers.values() if model]
+)
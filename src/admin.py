@@ -0,0 +1,52 @@
+"""Admin API client used by the controller."""
+
+from time import monotonic
+from typing import Dict, Optional
+
+from controller import Controller
+
+from .limiter import AdaptiveLimiter, admin_limiter
+from .metrics import Counter, Histogram
+from .tracing import admin_span
+
+admin_request_seconds = Histogram(
+    "controller_admin_request_seconds", "Latency of admin API calls"
+)
+admin_request_errors = Counter(
+    "controller_admin_request_errors", "Admin API calls that raised an error"
+)
+
+
+class AdminController(Controller):
+    """Controller whose admin API calls are subject to the adaptive limiter."""
+
+    def __init__(
+        self, base_url: str, *, limiter: Optional[AdaptiveLimiter] = None, **kwargs
+    ):
+        """Initialize the controller."""
+        super().__init__(base_url, **kwargs)
+        self.limiter = limiter or admin_limiter
+
+    async def _call(self, method: str, url: str, *args, **kwargs):
+        call = getattr(super(), method)
+        headers: Dict[str, str] = {}
+        async with self.limiter.slot():
+            started = monotonic()
+            try:
+                with admin_span(method, url, headers):
+                    if headers:
+                        kwargs["headers"] = {**(kwargs.get("headers") or {}), **headers}
+                    return await call(url, *args, **kwargs)
+            except Exception:
+                admin_request_errors.inc(method=method)
+                raise
+            finally:
+                admin_request_seconds.observe(monotonic() - started, method=method)
+
+    async def get(self, url: str, *args, **kwargs):
+        """Perform a GET request against the admin API."""
+        return await self._call("get", url, *args, **kwargs)
+
+    async def post(self, url: str, *args, **kwargs):
+        """Perform a POST request against the admin API."""
+        return await self._call("post", url, *args, **kwargs)
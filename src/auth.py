@@ -0,0 +1,20 @@
+"""Authentication of the controller's own admin routes."""
+
+import hmac
+from os import getenv
+from typing import Optional
+
+import fastapi
+
+ADMIN_API_KEY = getenv("ADMIN_API_KEY", "")
+
+
+async def require_admin_key(x_api_key: Optional[str] = fastapi.Header(None)):
+    """Require the X-API-Key header to match ADMIN_API_KEY.
+
+    Routes using this dependency are unavailable unless ADMIN_API_KEY is set.
+    """
+    if not ADMIN_API_KEY:
+        raise fastapi.HTTPException(404, "Not Found")
+    if not x_api_key or not hmac.compare_digest(x_api_key, ADMIN_API_KEY):
+        raise fastapi.HTTPException(401, "Invalid or missing X-API-Key")
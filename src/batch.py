@@ -0,0 +1,99 @@
+"""Parsing of batches of webhook events.
+
+A batch is a JSON array, or newline delimited JSON, of
+`{"topic": ..., "wallet_id": ..., "payload": ...}` entries, the same format the
+forwarding sinks produce. Each entry becomes an event or an error of its own,
+so one bad entry does not reject the rest of the batch.
+"""
+
+import json
+from os import getenv
+from typing import Any, Callable, List, Optional, Union
+
+from pydantic import BaseModel
+
+from .events import Event
+
+BATCH_MAX_ITEMS = int(getenv("BATCH_MAX_ITEMS", "1000"))
+
+
+class BatchTooLarge(Exception):
+    """Raised when a batch has more than the allowed number of entries."""
+
+
+class BatchEntry(BaseModel):
+    """Entry of a batch."""
+
+    topic: str
+    wallet_id: Optional[str] = None
+    payload: Any
+
+
+class BatchItemResult(BaseModel):
+    """Outcome of one entry of a batch."""
+
+    index: int
+    status: str
+    topic: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchResult(BaseModel):
+    """Outcome of every entry of a batch, in order."""
+
+    results: List[BatchItemResult]
+
+
+def entry_event(entry: Any) -> Event:
+    """Return the event of a batch entry.
+
+    Raises ValueError if the entry is malformed.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("Entry is not an object")
+    topic = entry.get("topic")
+    if not isinstance(topic, str) or not topic:
+        raise ValueError("Entry has no topic")
+    wallet_id = entry.get("wallet_id")
+    if wallet_id is not None and not isinstance(wallet_id, str):
+        raise ValueError("wallet_id is not a string")
+    if "payload" not in entry:
+        raise ValueError("Entry has no payload")
+    body = json.dumps(entry["payload"], separators=(",", ":")).encode()
+    return Event.from_raw(topic, body, wallet_id)
+
+
+def parse_batch(
+    body: bytes,
+    validate: Optional[Callable[[Event], None]] = None,
+    max_items: int = BATCH_MAX_ITEMS,
+) -> List[Union[Event, ValueError]]:
+    """Parse a JSON array or NDJSON batch into events, or errors per entry.
+
+    validate is called with each event and may raise ValueError. Raises
+    ValueError if body is not a JSON array or NDJSON, and BatchTooLarge if it
+    has more than max_items entries.
+    """
+    stripped = body.lstrip()
+    if stripped.startswith(b"["):
+        entries = json.loads(stripped)
+        if len(entries) > max_items:
+            raise BatchTooLarge()
+        lines: List[Any] = entries
+    else:
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) > max_items:
+            raise BatchTooLarge()
+
+    parsed: List[Union[Event, ValueError]] = []
+    for entry in lines:
+        try:
+            if isinstance(entry, bytes):
+                entry = json.loads(entry)
+            event = entry_event(entry)
+            if validate:
+                validate(event)
+            parsed.append(event)
+        except ValueError as error:
+            parsed.append(error)
+    return parsed
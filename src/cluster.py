@@ -0,0 +1,243 @@
+"""Partitioning of exchanges across controller replicas.
+
+Behind a load balancer, the events of one exchange reach different replicas,
+which breaks the per-exchange ordering and deduplication of the dispatcher.
+In cluster mode every replica knows the others from static configuration and
+maps each exchange to one owner with a consistent hash ring. Events received
+for an exchange owned by another replica are forwarded to it over a kept-alive
+connection, as a batch on its `/topics/batch` route.
+
+Replicas check each other's health and build the ring from the replicas that
+are up and not shutting down. When a replica leaves, only the exchanges it
+owned move to other replicas, and they move back when it returns. An event is
+forwarded at most once: a replica handles a forwarded event itself, and
+handles an event locally if its owner cannot be reached, so the webhook is
+never lost to a membership change.
+"""
+
+import asyncio
+from bisect import bisect
+import hashlib
+from os import getenv
+from typing import FrozenSet, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+from .events import Event
+from .forwarding import event_line
+from .metrics import Counter, Gauge
+
+CLUSTER_PEERS = getenv("CLUSTER_PEERS", "")
+CLUSTER_SELF = getenv("CLUSTER_SELF", "")
+CLUSTER_VNODES = int(getenv("CLUSTER_VNODES", "64"))
+CLUSTER_HEALTH_INTERVAL = float(getenv("CLUSTER_HEALTH_INTERVAL", "2"))
+CLUSTER_FORWARD_TIMEOUT = float(getenv("CLUSTER_FORWARD_TIMEOUT", "5"))
+
+# Header marking a batch forwarded by another replica
+FORWARDED_HEADER = "x-cluster-forwarded"
+
+cluster_forwarded = Counter(
+    "controller_cluster_forwarded",
+    "Events forwarded to the replica owning their exchange, by outcome",
+)
+cluster_membership_changes = Counter(
+    "controller_cluster_membership_changes", "Changes of the live cluster members"
+)
+
+
+def ring_hash(value: str) -> int:
+    """Return the position of value on the ring."""
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), "big"
+    )
+
+
+def parse_peers(spec: str) -> List[str]:
+    """Parse a comma separated list of replica URLs."""
+    return [peer.strip().rstrip("/") for peer in spec.split(",") if peer.strip()]
+
+
+class ClusterStatus(BaseModel):
+    """Cluster membership as seen by one replica."""
+
+    url: str
+    peers: List[str]
+    members: List[str]
+    draining: bool
+
+
+class HashRing:
+    """Consistent hash ring of nodes, each placed at vnodes points."""
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = CLUSTER_VNODES):
+        """Initialize the ring."""
+        self.nodes: FrozenSet[str] = frozenset(nodes)
+        points = sorted(
+            (ring_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Return the node owning key, None if the ring is empty."""
+        if not self._nodes:
+            return None
+        index = bisect(self._hashes, ring_hash(key)) % len(self._nodes)
+        return self._nodes[index]
+
+
+def partition_key(event: Event) -> Optional[str]:
+    """Return the key partitioning event, None if it has no exchange."""
+    if not event.exchange_id:
+        return None
+    return f"{event.wallet_id or ''}/{event.exchange_id}"
+
+
+class Cluster:
+    """Membership of this replica in a cluster and routing of events."""
+
+    def __init__(
+        self,
+        self_url: str = CLUSTER_SELF,
+        peers: Iterable[str] = (),
+        *,
+        vnodes: int = CLUSTER_VNODES,
+        health_interval: float = CLUSTER_HEALTH_INTERVAL,
+        forward_timeout: float = CLUSTER_FORWARD_TIMEOUT,
+    ):
+        """Initialize the cluster; it is enabled if peers are given."""
+        self.self_url = self_url.rstrip("/")
+        self.peers = sorted(set(peers) | ({self.self_url} if self.self_url else set()))
+        self.vnodes = vnodes
+        self.health_interval = health_interval
+        self.forward_timeout = forward_timeout
+        self.ring = HashRing(self.peers, vnodes)
+        self._session = None
+        self._task: "Optional[asyncio.Task]" = None
+
+    @classmethod
+    def from_env(cls) -> "Cluster":
+        """Load the cluster from CLUSTER_SELF and CLUSTER_PEERS."""
+        peers = parse_peers(CLUSTER_PEERS)
+        if peers and not CLUSTER_SELF:
+            raise ValueError("CLUSTER_SELF is required with CLUSTER_PEERS")
+        return cls(CLUSTER_SELF, peers)
+
+    @property
+    def enabled(self) -> bool:
+        """Return whether this replica shares work with others."""
+        return len(self.peers) > 1
+
+    @property
+    def members(self) -> List[str]:
+        """Return the replicas currently in the ring."""
+        return sorted(self.ring.nodes)
+
+    def owner(self, event: Event) -> Optional[str]:
+        """Return the replica owning event's exchange, None if any may handle it."""
+        key = partition_key(event)
+        if not self.enabled or key is None:
+            return None
+        return self.ring.owner(key)
+
+    def set_members(self, members: Iterable[str]):
+        """Rebuild the ring from the replicas that are up."""
+        members = frozenset(members) | {self.self_url}
+        if members == self.ring.nodes:
+            return
+        joined = sorted(members - self.ring.nodes)
+        left = sorted(self.ring.nodes - members)
+        self.ring = HashRing(members, self.vnodes)
+        cluster_membership_changes.inc()
+        print(f"Cluster members changed, joined: {joined}, left: {left}")
+
+    def start(self):
+        """Start checking the health of the other replicas."""
+        if not self.enabled or self._task:
+            return
+        from aiohttp import ClientSession, ClientTimeout
+
+        self._session = ClientSession(timeout=ClientTimeout(total=self.forward_timeout))
+        self._task = asyncio.get_event_loop().create_task(self._check_health())
+
+    async def stop(self):
+        """Stop checking health and close connections."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def route(self, event: Event) -> bool:
+        """Forward event to the replica owning its exchange.
+
+        Returns False if event is to be handled by this replica, because it
+        owns the exchange or the owner could not be reached.
+        """
+        owner = self.owner(event)
+        if owner is None or owner == self.self_url or not self._session:
+            return False
+        try:
+            async with self._session.post(
+                f"{owner}/topics/batch",
+                params={"validate": "false"},
+                data=event_line(event),
+                headers={
+                    "Content-Type": "application/x-ndjson",
+                    FORWARDED_HEADER: self.self_url,
+                },
+            ) as response:
+                if response.status != 200:
+                    raise ValueError(f"status {response.status}")
+                status = (await response.json())["results"][0]["status"]
+                if status == "refused":
+                    raise ValueError("owner is shutting down")
+        except Exception as error:
+            cluster_forwarded.inc(outcome="failed")
+            print(f"Forwarding {event!r} to {owner} failed: {error!r}")
+            self.set_members(self.ring.nodes - {owner})
+            return False
+        cluster_forwarded.inc(outcome="forwarded")
+        return True
+
+    async def _healthy(self, peer: str) -> bool:
+        assert self._session
+        try:
+            async with self._session.get(f"{peer}/cluster") as response:
+                return response.status == 200 and not (await response.json()).get(
+                    "draining"
+                )
+        except Exception:
+            return False
+
+    async def _check_health(self):
+        others = [peer for peer in self.peers if peer != self.self_url]
+        while True:
+            healthy = await asyncio.gather(*(self._healthy(peer) for peer in others))
+            self.set_members(peer for peer, up in zip(others, healthy) if up)
+            await asyncio.sleep(self.health_interval)
+
+    def status(self, draining: bool) -> "ClusterStatus":
+        """Return the cluster status of this replica."""
+        return ClusterStatus(
+            url=self.self_url,
+            peers=self.peers,
+            members=self.members,
+            draining=draining,
+        )
+
+
+cluster = Cluster.from_env()
+
+cluster_members = Gauge(
+    "controller_cluster_members",
+    "Replicas in the cluster ring",
+    callback=lambda: len(cluster.ring.nodes),
+)
@@ -0,0 +1,328 @@
+"""Dead letters: events whose handler failed.
+
+When sending a credential request or storing a credential fails, the event is
+kept with the error instead of being lost, in a bounded SQLite table at
+`DEAD_LETTER_DB` that survives restarts. Dead letters can be listed, filtered
+and replayed in bulk once the cause of the failures is resolved. Replayed
+events are submitted again like webhooks, so they are handled in order with
+the other events of their exchange, by the cluster replica owning it; a replay
+that fails again is kept as a new dead letter.
+"""
+
+import asyncio
+import sqlite3
+import threading
+from os import getenv
+from time import time
+import traceback
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .events import Event
+from .metrics import Counter, Gauge
+
+DEAD_LETTER_DB = getenv("DEAD_LETTER_DB", "dead_letters.db")
+DEAD_LETTER_SIZE = int(getenv("DEAD_LETTER_SIZE", "10000"))
+REPLAY_CONCURRENCY = int(getenv("REPLAY_CONCURRENCY", "4"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    wallet_id TEXT,
+    exchange_id TEXT,
+    state TEXT,
+    updated_at TEXT,
+    body BLOB NOT NULL,
+    error TEXT NOT NULL,
+    failed_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS dead_letters_topic ON dead_letters (topic, state);
+CREATE INDEX IF NOT EXISTS dead_letters_exchange ON dead_letters (exchange_id);
+"""
+COLUMNS = (
+    "id, topic, wallet_id, exchange_id, state, updated_at, body, error, "
+    "failed_at, attempts"
+)
+
+dead_letters_replayed = Counter(
+    "controller_dead_letters_replayed", "Dead letters replayed, by outcome"
+)
+
+
+class DeadLetter(BaseModel):
+    """Event whose handler failed."""
+
+    id: int
+    topic: str
+    wallet_id: Optional[str] = None
+    exchange_id: Optional[str] = None
+    state: Optional[str] = None
+    updated_at: Optional[str] = None
+    error: str
+    failed_at: float
+    attempts: int
+    payload: Any = None
+
+
+class DeadLetterList(BaseModel):
+    """Page of dead letters, oldest first."""
+
+    total: int
+    results: List[DeadLetter]
+
+
+class DeadLetterFilter(BaseModel):
+    """Criteria selecting dead letters; unset criteria match every letter."""
+
+    ids: Optional[List[int]] = None
+    topic: Optional[str] = None
+    state: Optional[str] = None
+    exchange_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class ReplayRequest(DeadLetterFilter):
+    """Dead letters to replay and how many to replay at once."""
+
+    limit: int = 1000
+    concurrency: int = REPLAY_CONCURRENCY
+
+
+class ReplayItemResult(BaseModel):
+    """Outcome of replaying one dead letter."""
+
+    id: int
+    status: str
+    error: Optional[str] = None
+
+
+class ReplayResult(BaseModel):
+    """Outcome of a replay."""
+
+    replayed: int
+    failed: int
+    results: List[ReplayItemResult]
+
+
+def describe(error: BaseException) -> str:
+    """Return the error details kept with a dead letter."""
+    return "".join(traceback.format_exception_only(type(error), error)).strip()
+
+
+def _where(criteria: DeadLetterFilter) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    params: List[Any] = []
+    if criteria.ids is not None:
+        clauses.append(f"id IN ({','.join('?' * len(criteria.ids))})")
+        params.extend(criteria.ids)
+    for column in ("topic", "state", "exchange_id"):
+        value = getattr(criteria, column)
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if criteria.error:
+        clauses.append("instr(error, ?) > 0")
+        params.append(criteria.error)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+class DeadLetterStore:
+    """Bounded store of dead letters, oldest dropped first.
+
+    The database is used from a worker thread, so the event loop does not
+    wait for the disk.
+    """
+
+    def __init__(self, path: str = DEAD_LETTER_DB, max_size: int = DEAD_LETTER_SIZE):
+        """Initialize the store, creating its table in the database at path."""
+        self.path = path
+        self.max_size = max_size
+        if path == ":memory:":
+            print("Dead letters are kept in memory and lost on restart")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(SCHEMA)
+        # Serializes use of the connection across threads
+        self._lock = threading.Lock()
+        self._counted()
+
+    def __len__(self) -> int:
+        """Return the number of dead letters as of the last change."""
+        return self._count
+
+    async def add(self, event: Event, error: BaseException) -> int:
+        """Keep event with the error its handler raised; return its id."""
+        return await asyncio.to_thread(self._add, event, describe(error), time())
+
+    def _add(self, event: Event, error: str, failed_at: float) -> int:
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT INTO dead_letters (topic, wallet_id, exchange_id, state, "
+                    "updated_at, body, error, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        event.topic,
+                        event.wallet_id,
+                        event.exchange_id,
+                        event.state,
+                        event.updated_at,
+                        event.raw_body,
+                        error,
+                        failed_at,
+                    ),
+                )
+                self._db.execute(
+                    "DELETE FROM dead_letters WHERE id <= ?",
+                    (cursor.lastrowid - self.max_size,),
+                )
+            self._counted()
+        return cursor.lastrowid
+
+    async def list(
+        self, criteria: DeadLetterFilter, limit: int = 50, offset: int = 0
+    ) -> DeadLetterList:
+        """Return a page of the dead letters matching criteria."""
+        where, params = _where(criteria)
+        total = (
+            await asyncio.to_thread(
+                self._read, f"SELECT count(*) FROM dead_letters{where}", params
+            )
+        )[0][0]
+        rows = await asyncio.to_thread(
+            self._read,
+            f"SELECT {COLUMNS} FROM dead_letters{where} ORDER BY id LIMIT ? OFFSET ?",
+            params + [limit, offset],
+        )
+        return DeadLetterList(
+            total=total, results=[self._letter(row).letter for row in rows]
+        )
+
+    async def get(self, id: int) -> Optional["StoredLetter"]:
+        """Return the dead letter with id."""
+        rows = await asyncio.to_thread(
+            self._read, f"SELECT {COLUMNS} FROM dead_letters WHERE id = ?", [id]
+        )
+        return self._letter(rows[0]) if rows else None
+
+    async def select(
+        self, criteria: DeadLetterFilter, limit: int
+    ) -> List["StoredLetter"]:
+        """Return up to limit dead letters matching criteria, oldest first."""
+        where, params = _where(criteria)
+        rows = await asyncio.to_thread(
+            self._read,
+            f"SELECT {COLUMNS} FROM dead_letters{where} ORDER BY id LIMIT ?",
+            params + [limit],
+        )
+        return [self._letter(row) for row in rows]
+
+    async def remove(self, id: int) -> bool:
+        """Remove the dead letter with id; return whether it existed."""
+        return await asyncio.to_thread(self._remove, id)
+
+    def _remove(self, id: int) -> bool:
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute(
+                    "DELETE FROM dead_letters WHERE id = ?", (id,)
+                )
+            self._counted()
+        return cursor.rowcount > 0
+
+    async def failed_again(self, id: int, error: BaseException):
+        """Record that replaying the dead letter with id failed with error."""
+        await asyncio.to_thread(
+            self._write,
+            "UPDATE dead_letters SET error = ?, failed_at = ?, "
+            "attempts = attempts + 1 WHERE id = ?",
+            [describe(error), time(), id],
+        )
+
+    def _read(self, sql: str, params: List[Any]) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _write(self, sql: str, params: List[Any]):
+        with self._lock:
+            with self._db:
+                self._db.execute(sql, params)
+
+    def _counted(self):
+        (self._count,) = self._db.execute(
+            "SELECT count(*) FROM dead_letters"
+        ).fetchone()
+
+    @staticmethod
+    def _letter(row: sqlite3.Row) -> "StoredLetter":
+        event = Event.from_raw(row["topic"], bytes(row["body"]), row["wallet_id"])
+        letter = DeadLetter(
+            id=row["id"],
+            topic=row["topic"],
+            wallet_id=row["wallet_id"],
+            exchange_id=row["exchange_id"],
+            state=row["state"],
+            updated_at=row["updated_at"],
+            error=row["error"],
+            failed_at=row["failed_at"],
+            attempts=row["attempts"],
+            payload=event.json(),
+        )
+        return StoredLetter(letter, event)
+
+
+class StoredLetter:
+    """Dead letter with the event to replay."""
+
+    __slots__ = ("letter", "event")
+
+    def __init__(self, letter: DeadLetter, event: Event):
+        """Initialize the stored letter."""
+        self.letter = letter
+        self.event = event
+
+
+async def replay(
+    store: DeadLetterStore,
+    letters: List[StoredLetter],
+    submit: Callable[[Event], Awaitable[str]],
+    concurrency: int = REPLAY_CONCURRENCY,
+) -> ReplayResult:
+    """Submit the events of letters again, concurrency at a time.
+
+    submit queues an event like a webhook and returns its status. Letters
+    whose event is submitted are removed from store; an event that fails
+    again is kept as a new dead letter by the dispatcher.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def _replay(stored: StoredLetter) -> ReplayItemResult:
+        async with semaphore:
+            try:
+                status = await submit(stored.event)
+            except Exception as error:
+                await store.failed_again(stored.letter.id, error)
+                dead_letters_replayed.inc(outcome="failed")
+                return ReplayItemResult(
+                    id=stored.letter.id, status="failed", error=describe(error)
+                )
+        await store.remove(stored.letter.id)
+        dead_letters_replayed.inc(outcome="replayed")
+        return ReplayItemResult(id=stored.letter.id, status=status)
+
+    results = await asyncio.gather(*(_replay(stored) for stored in letters))
+    failed = sum(result.status == "failed" for result in results)
+    return ReplayResult(
+        replayed=len(results) - failed, failed=failed, results=list(results)
+    )
+
+
+dead_letters = DeadLetterStore()
+
+dead_letters_stored = Gauge(
+    "controller_dead_letters", "Dead letters stored", callback=lambda: len(dead_letters)
+)
@@ -0,0 +1,659 @@
+"""Queueing, deduplication and scheduling of webhook events.
+
+Webhooks are acknowledged as soon as their event is queued. Events carry only
+the fields needed to route them (see `src.events`), and their handlers parse
+the full model when they run.
+
+ACA-Py retries webhooks it considers failed, so events already seen recently
+are dropped. Events are sharded over a fixed set of workers by exchange, so
+the events of one exchange are handled in the order they arrived while
+different exchanges are handled concurrently.
+
+Events are handled in one of two priority lanes by topic, each with workers
+of its own. Topics the controller acts on are handled in the high priority
+lane, so a flood of events that are only logged cannot delay them; when the
+low priority lane falls behind, its new events are dropped instead of waiting.
+
+When a newer event for an exchange is queued behind an older one, the older
+event is coalesced away, i.e. dropped without being handled, if its state is
+not one its handler acts on, or if the newer event shows the exchange has
+since moved on. A backlog thus drains in time proportional to the number of
+exchanges rather than the number of events.
+
+With a queue backend (see `src.queues`), submitted events are appended to a
+queue shared by several nodes instead, and each node's dispatcher consumes
+from it into its lanes as its workers have room. Events are acknowledged once
+handled or coalesced; low priority events shed while their lane is full are
+left unacknowledged, so they are reclaimed once idle rather than lost.
+
+On shutdown the dispatcher drains: new events are refused while queued and
+in-flight events are given until a deadline to finish. Events that did not
+finish are persisted so they can be handled after a restart, or logged. Events
+read from a queue backend are not acknowledged instead, so they are reclaimed
+by another node.
+"""
+
+import asyncio
+from collections import OrderedDict
+import contextvars
+import os
+from os import getenv
+from time import monotonic
+import traceback
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
+
+from pydantic import BaseModel
+
+from .events import Event
+from .loadgen import Recorder, read_recording
+from .metrics import Counter, Gauge, Histogram
+from .queues import backend_from_env, Delivery, QueueBackend
+from .timestamps import parse_timestamp
+
+DISPATCH_WORKERS = int(getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_QUEUE_SIZE = int(getenv("DISPATCH_QUEUE_SIZE", "1024"))
+DISPATCH_LOW_WORKERS = int(getenv("DISPATCH_LOW_WORKERS", "2"))
+DISPATCH_LOW_QUEUE_SIZE = int(getenv("DISPATCH_LOW_QUEUE_SIZE", "256"))
+DEDUPE_SIZE = int(getenv("DEDUPE_SIZE", "4096"))
+DRAIN_TIMEOUT = float(getenv("DRAIN_TIMEOUT", "20"))
+DRAIN_FILE = getenv("DRAIN_FILE")
+
+Handler = Callable[[Any], Awaitable[Any]]
+# Event, submitter's context, time queued and queue backend delivery id
+Queued = Tuple[Event, contextvars.Context, float, Optional[str]]
+ExchangeKey = Tuple[str, Optional[str], str]
+
+# The event whose handler is running, for handlers called with its body only
+current_event: "contextvars.ContextVar[Optional[Event]]" = contextvars.ContextVar(
+    "current_event", default=None
+)
+
+# Priority lanes; each has its own workers and queues
+HIGH = "high"
+LOW = "low"
+
+events_received = Counter(
+    "controller_events_received", "Webhook events received, by topic"
+)
+events_duplicate = Counter(
+    "controller_events_duplicate", "Webhook events dropped as duplicates, by topic"
+)
+events_failed = Counter(
+    "controller_events_failed", "Webhook events whose handler failed, by topic"
+)
+events_coalesced = Counter(
+    "controller_events_coalesced",
+    "Queued webhook events dropped as superseded by a newer event, by topic",
+)
+events_shed = Counter(
+    "controller_events_shed",
+    "Low priority webhook events dropped as their lane was full, by topic",
+)
+event_queue_seconds = Histogram(
+    "controller_event_queue_seconds", "Time webhook events spent queued"
+)
+
+
+class Draining(Exception):
+    """Raised when submitting an event while the dispatcher drains."""
+
+
+def current_wallet() -> Optional[str]:
+    """Return the wallet of the event whose handler is running, if any."""
+    event = current_event.get()
+    return event.wallet_id if event else None
+
+
+def exchange_key(event: Event) -> Optional[ExchangeKey]:
+    """Return the key of the exchange event belongs to, if any."""
+    if not event.exchange_id:
+        return None
+    return (event.topic, event.wallet_id, event.exchange_id)
+
+
+def superseded(event: Event, newer: Event, actionable: bool) -> bool:
+    """Return whether event need not be handled given newer for its exchange.
+
+    An event its handler would act on is only superseded once newer shows
+    the exchange was updated since, e.g. because the action was taken.
+    """
+    if newer.state == event.state and newer.updated_at == event.updated_at:
+        return True
+    before = parse_timestamp(event.updated_at)
+    after = parse_timestamp(newer.updated_at)
+    if before is None or after is None:
+        # Without timestamps only trust arrival order for inert events
+        return not actionable
+    if actionable:
+        return after > before
+    return after >= before
+
+
+class Dedupe:
+    """Bounded record of recently seen events, oldest forgotten first."""
+
+    def __init__(self, max_size: int = DEDUPE_SIZE):
+        """Initialize the record."""
+        self.max_size = max_size
+        self._seen: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """Return the number of events remembered."""
+        return len(self._seen)
+
+    def seen(self, event: Event) -> bool:
+        """Return whether event was seen before, remembering it if not.
+
+        Events without an exchange and state are never considered duplicates.
+        """
+        key = event.key
+        if key is None:
+            return False
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = None
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def forget(self, event: Event):
+        """Forget event, e.g. because it could not be queued."""
+        key = event.key
+        if key is not None:
+            self._seen.pop(key, None)
+
+
+class Dispatcher:
+    """Queue events and hand them to their topic's handler."""
+
+    def __init__(
+        self,
+        *,
+        workers: int = DISPATCH_WORKERS,
+        queue_size: int = DISPATCH_QUEUE_SIZE,
+        low_workers: int = DISPATCH_LOW_WORKERS,
+        low_queue_size: int = DISPATCH_LOW_QUEUE_SIZE,
+        dedupe: Optional[Dedupe] = None,
+        backend: Optional[QueueBackend] = None,
+    ):
+        """Initialize the dispatcher.
+
+        High priority events are handled by workers sharing queue_size; once a
+        worker's queue is full, submitting waits for it to drain. Low priority
+        events are handled by low_workers sharing low_queue_size, and are
+        dropped while their worker's queue is full. With backend, submitted
+        events are appended to the shared queue and the workers consume it.
+        """
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+        self.low_workers = max(low_workers, 1)
+        self.low_queue_size = low_queue_size
+        self.dedupe = dedupe or Dedupe()
+        self.backend = backend
+        self.handlers: Dict[str, Tuple[Optional[Type[BaseModel]], Handler]] = {}
+        self.actions: Dict[str, FrozenSet[str]] = {}
+        self.priorities: Dict[str, str] = {}
+        self.fallback: Optional[Handler] = None
+        self.on_failure: Optional[Callable[[Event, Exception], Awaitable[Any]]] = None
+        self._queues: "List[asyncio.Queue[Queued]]" = []
+        self._lanes: "Dict[str, List[asyncio.Queue[Queued]]]" = {}
+        self._tasks: "List[asyncio.Task]" = []
+        self._in_flight: "Dict[asyncio.Task, Tuple[Event, Optional[str]]]" = {}
+        self._consumer: "Optional[asyncio.Task]" = None
+        self._acker: "Optional[asyncio.Task]" = None
+        self._acks: List[str] = []
+        # Ids of deliveries read from the backend and not yet acknowledged
+        self._held: Set[str] = set()
+        self._acks_ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._latest: Dict[ExchangeKey, Event] = {}
+        self._next = 0
+        self._halted = False
+        self.draining = False
+
+    def handler(
+        self,
+        topic: str,
+        model: Optional[Type[BaseModel]] = None,
+        actions: Iterable[str] = (),
+        priority: Optional[str] = None,
+    ):
+        """Register the decorated function as the handler of topic.
+
+        The handler is called with the event body parsed as model, or decoded
+        JSON without one. actions are the states the handler acts on, which
+        are kept when coalescing the queue. Events of topic are handled in
+        the priority lane, by default HIGH if the handler has actions and LOW
+        otherwise.
+        """
+
+        def _decorator(func: Handler) -> Handler:
+            self.handlers[topic] = (model, func)
+            self.actions[topic] = frozenset(actions)
+            self.priorities[topic] = priority or (HIGH if actions else LOW)
+            return func
+
+        return _decorator
+
+    def fallback_handler(self, func: Callable[[str, Any], Awaitable[Any]]):
+        """Register the decorated function as handler of unknown topics.
+
+        It is called with the topic and the decoded JSON body.
+        """
+
+        async def _fallback(event: Event):
+            return await func(event.topic, event.json())
+
+        self.fallback = _fallback
+        return func
+
+    def failure_handler(self, func: Callable[[Event, Exception], Awaitable[Any]]):
+        """Register the decorated coroutine function to be called with failed events.
+
+        It is called with the event and the exception its handler raised. The
+        event is forgotten as seen, so it is handled again when resubmitted.
+        """
+        self.on_failure = func
+        return func
+
+    @property
+    def running(self) -> bool:
+        """Return whether events are queued rather than dispatched directly."""
+        return bool(self._tasks)
+
+    @property
+    def depth(self) -> int:
+        """Return the number of queued events."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    @property
+    def in_flight(self) -> int:
+        """Return the number of events being handled."""
+        return len(self._in_flight)
+
+    def start(self):
+        """Start the workers."""
+        if self._tasks:
+            return
+        loop = asyncio.get_event_loop()
+        size = max(self.queue_size // self.workers, 1)
+        low_size = max(self.low_queue_size // self.low_workers, 1)
+        self._lanes = {
+            HIGH: [asyncio.Queue(size) for _ in range(self.workers)],
+            LOW: [asyncio.Queue(low_size) for _ in range(self.low_workers)],
+        }
+        self._queues = self._lanes[HIGH] + self._lanes[LOW]
+        self._tasks = [loop.create_task(self._run(queue)) for queue in self._queues]
+        self._acks_ready = asyncio.Event()
+        self._room = asyncio.Event()
+        if self.backend:
+            self._consumer = loop.create_task(self._consume(self.backend))
+            self._acker = loop.create_task(self._send_acks(self.backend))
+        self._halted = False
+        self.draining = False
+
+    async def join(self):
+        """Wait until every queued event has been handled."""
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT) -> List[Event]:
+        """Refuse new events, handle queued ones for up to timeout seconds and stop.
+
+        Returns the events that were not handled in time, in-flight ones
+        first; their handlers are cancelled. A handler that finishes anyway,
+        e.g. because the store it waited for had started, counts as handled.
+        Events read from the queue backend are left unacknowledged instead of
+        returned.
+        """
+        if not self._tasks:
+            return []
+        self.draining = True
+        if self._consumer:
+            self._consumer.cancel()
+            await asyncio.gather(self._consumer, return_exceptions=True)
+            self._consumer = None
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        in_flight = dict(self._in_flight)
+        self._halted = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        unfinished = [
+            entry
+            for task, entry in in_flight.items()
+            if task.cancelled() or not task.done()
+        ]
+        for queue in self._queues:
+            while not queue.empty():
+                event, _, _, delivery_id = queue.get_nowait()
+                unfinished.append((event, delivery_id))
+        if self.backend and self._acker:
+            self._acker.cancel()
+            await asyncio.gather(self._acker, return_exceptions=True)
+            self._acker = None
+            await self._flush_acks(self.backend)
+            await self.backend.stop()
+            self._held.clear()
+        self._tasks = []
+        self._queues = []
+        self._lanes = {}
+        self._in_flight.clear()
+        self._latest.clear()
+        return [event for event, delivery_id in unfinished if delivery_id is None]
+
+    async def submit(self, event: Event) -> bool:
+        """Queue event for its handler.
+
+        Returns False if the event was dropped as a duplicate. Without running
+        workers, the event is dispatched before returning. With a queue
+        backend, the event is appended to the shared queue. Low priority events
+        are dropped while their queue is full. Raises Draining while the
+        dispatcher drains.
+        """
+        if self.draining:
+            raise Draining()
+        if self.dedupe.seen(event):
+            events_duplicate.inc(topic=event.topic)
+            return False
+        events_received.inc(topic=event.topic)
+
+        if not self._queues:
+            await self.dispatch(event)
+            return True
+        try:
+            if self.backend:
+                await self.backend.put(event)
+            else:
+                await self._enqueue(event, contextvars.copy_context())
+        except BaseException:
+            self.dedupe.forget(event)
+            raise
+        return True
+
+    async def _enqueue(
+        self,
+        event: Event,
+        context: contextvars.Context,
+        delivery_id: Optional[str] = None,
+    ):
+        """Put event on its worker's queue, or drop it if it is shed."""
+        priority = self.priority(event)
+        queue = self._shard(self._lanes[priority], event)
+        if priority == LOW and queue.full():
+            events_shed.inc(topic=event.topic)
+            if delivery_id is not None:
+                # Not acknowledged, so it is reclaimed once idle
+                self._held.discard(delivery_id)
+            return
+
+        key = exchange_key(event)
+        previous = self._latest.get(key) if key else None
+        if key:
+            self._latest[key] = event
+        try:
+            await queue.put((event, context, monotonic(), delivery_id))
+        except BaseException:
+            if key and self._latest.get(key) is event:
+                if previous:
+                    self._latest[key] = previous
+                else:
+                    del self._latest[key]
+            raise
+
+    def _ack(self, delivery_id: Optional[str]):
+        if delivery_id is not None:
+            self._held.discard(delivery_id)
+            self._acks.append(delivery_id)
+            self._acks_ready.set()
+
+    async def _flush_acks(self, backend: QueueBackend):
+        acks, self._acks = self._acks, []
+        try:
+            await backend.ack(acks)
+        except BaseException:
+            self._acks.extend(acks)
+            raise
+
+    async def _send_acks(self, backend: QueueBackend):
+        """Acknowledge handled deliveries as soon as they are handled."""
+        while True:
+            await self._acks_ready.wait()
+            self._acks_ready.clear()
+            try:
+                await self._flush_acks(backend)
+            except Exception:
+                print("Acknowledging queued events failed:")
+                traceback.print_exc()
+                await asyncio.sleep(1)
+                self._acks_ready.set()
+
+    def _free(self) -> int:
+        """Return the number of events that can be queued without waiting.
+
+        Any event may go to any high priority worker, so this is the least
+        room of their queues. Low priority events never wait, as they are
+        shed while their worker's queue is full.
+        """
+        return min(queue.maxsize - queue.qsize() for queue in self._lanes[HIGH])
+
+    async def _consume(self, backend: QueueBackend):
+        """Move events from the queue backend to the workers' queues.
+
+        Only as many events are read as the queues have room for, so queueing
+        them never waits and events are not held unacknowledged meanwhile. The deliveries
+        still held are touched before reclaiming, so no node takes them over.
+        """
+        loop = asyncio.get_event_loop()
+        started = False
+        reclaim_at = loop.time()
+        # Also checked because some clients swallow the cancellation on stop
+        while not self.draining:
+            try:
+                if not started:
+                    await backend.start()
+                    started = True
+                deliveries: List[Delivery] = []
+                free = self._free()
+                if free:
+                    deliveries = await backend.read(free)
+                else:
+                    self._room.clear()
+                    try:
+                        await asyncio.wait_for(
+                            self._room.wait(), backend.reclaim_interval
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                if loop.time() >= reclaim_at:
+                    await backend.touch(sorted(self._held))
+                    free -= len(deliveries)
+                    if free > 0:
+                        deliveries.extend(
+                            delivery
+                            for delivery in await backend.reclaim(free)
+                            if delivery.id not in self._held
+                        )
+                    reclaim_at = loop.time() + backend.reclaim_interval
+                for delivery in deliveries:
+                    self._held.add(delivery.id)
+                    # Each event is handled in a context of its own
+                    context = contextvars.Context()
+                    await self._enqueue(delivery.event, context, delivery.id)
+            except Exception:
+                print("Consuming the event queue failed:")
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    def actionable(self, event: Event) -> bool:
+        """Return whether event's handler acts on its state."""
+        return event.state in self.actions.get(event.topic, ())
+
+    def _coalesce(self, event: Event, key: Optional[ExchangeKey]) -> bool:
+        """Return whether a dequeued event is superseded by a newer one."""
+        if not key:
+            return False
+        newer = self._latest.get(key)
+        if newer is None or newer is event:
+            return False
+        return superseded(event, newer, self.actionable(event))
+
+    def priority(self, event: Event) -> str:
+        """Return the lane of event."""
+        return self.priorities.get(event.topic, LOW)
+
+    def _shard(
+        self, queues: "List[asyncio.Queue[Queued]]", event: Event
+    ) -> "asyncio.Queue[Queued]":
+        """Return the queue of the worker of a lane handling event."""
+        if event.exchange_id:
+            return queues[hash((event.wallet_id, event.exchange_id)) % len(queues)]
+        self._next += 1
+        return queues[self._next % len(queues)]
+
+    def check(self, event: Event):
+        """Raise ValueError if event cannot be handled, without parsing its model.
+
+        The body must be a JSON object, and an event in a state its handler
+        acts on must identify its exchange.
+        """
+        if not event.raw_body.lstrip().startswith(b"{"):
+            raise ValueError("Body is not a JSON object")
+        if self.actionable(event) and not event.exchange_id:
+            raise ValueError(f"{event.state} event has no exchange id")
+
+    def validate(self, event: Event):
+        """Raise ValueError if event's body does not match its topic's model."""
+        self.check(event)
+        if event.topic in self.handlers:
+            model, _ = self.handlers[event.topic]
+            if model:
+                event.model(model)
+
+    async def dispatch(self, event: Event) -> Any:
+        """Call the handler of event's topic with the parsed body."""
+        token = current_event.set(event)
+        try:
+            if event.topic in self.handlers:
+                model, func = self.handlers[event.topic]
+                return await func(event.model(model) if model else event.json())
+            if self.fallback:
+                return await self.fallback(event)
+            return None
+        finally:
+            current_event.reset(token)
+
+    async def _failed(self, event: Event, error: Exception):
+        self.dedupe.forget(event)
+        if not self.on_failure:
+            return
+        try:
+            await self.on_failure(event, error)
+        except Exception:
+            print(f"Recording failure of {event!r} failed:")
+            traceback.print_exc()
+
+    async def _run(self, queue: "asyncio.Queue[Queued]"):
+        loop = asyncio.get_event_loop()
+        # Also checked as a handler that finishes when cancelled ends the cancel
+        while not self._halted:
+            event, context, queued_at, delivery_id = await queue.get()
+            self._room.set()
+            event_queue_seconds.observe(monotonic() - queued_at)
+            key = exchange_key(event)
+            if self._coalesce(event, key):
+                events_coalesced.inc(topic=event.topic)
+                self._ack(delivery_id)
+                queue.task_done()
+                continue
+
+            # Handle in the submitter's context, e.g. its trace span
+            task = context.run(loop.create_task, self.dispatch(event))
+            self._in_flight[task] = (event, delivery_id)
+            try:
+                await task
+            except Exception as error:
+                events_failed.inc(topic=event.topic)
+                print(f"Handling {event!r} failed:")
+                traceback.print_exc()
+                await self._failed(event, error)
+            finally:
+                self._in_flight.pop(task, None)
+                if key and self._latest.get(key) is event:
+                    del self._latest[key]
+                queue.task_done()
+            # Not reached if cancelled, so the event is reclaimed elsewhere
+            self._ack(delivery_id)
+
+
+def persist(events: List[Event], path: Optional[str] = DRAIN_FILE):
+    """Persist unfinished events to path as a webhook recording, or log them.
+
+    The recording can be replayed with `acapy-webhook-loadgen replay`, and is
+    resubmitted by `restore` on the next start.
+    """
+    if not events:
+        return
+    if not path:
+        for event in events:
+            print(f"Unfinished on shutdown: {event!r}")
+        return
+
+    recorder = Recorder(path)
+    try:
+        for event in events:
+            headers = {"x-wallet-id": event.wallet_id} if event.wallet_id else {}
+            recorder.record(event.topic, headers, event.raw_body)
+    finally:
+        recorder.close()
+    print(f"Persisted {len(events)} unfinished events to {path}")
+
+
+async def restore(dispatcher: "Dispatcher", path: Optional[str] = DRAIN_FILE) -> int:
+    """Resubmit the events persisted to path and remove it.
+
+    Returns the number of events resubmitted.
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    webhooks = list(read_recording(path))
+    os.remove(path)
+    for webhook in webhooks:
+        event = Event.from_raw(
+            webhook.topic, webhook.body, webhook.headers.get("x-wallet-id")
+        )
+        await dispatcher.submit(event)
+    print(f"Resubmitted {len(webhooks)} unfinished events from {path}")
+    return len(webhooks)
+
+
+dispatcher = Dispatcher(backend=backend_from_env())
+
+event_queue_depth = Gauge(
+    "controller_event_queue_depth",
+    "Webhook events queued for their handler",
+    callback=lambda: dispatcher.depth,
+)
+events_in_flight = Gauge(
+    "controller_events_in_flight",
+    "Webhook events being handled",
+    callback=lambda: dispatcher.in_flight,
+)
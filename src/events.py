@@ -0,0 +1,130 @@
+"""Compact envelope for webhook events in the internal pipeline.
+
+Routing, deduplicating and scheduling an event only needs a handful of fields.
+The envelope holds those and the raw body; the full model is only parsed by
+the handler that needs it, which keeps queued backlogs small.
+"""
+
+import json
+import sys
+from typing import Any, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+M = TypeVar("M", bound=BaseModel)
+
+# Keys identifying the exchange a record belongs to, by precedence
+EXCHANGE_ID_KEYS = (
+    "cred_ex_id",
+    "credential_exchange_id",
+    "pres_ex_id",
+    "presentation_exchange_id",
+    "connection_id",
+    "oob_id",
+    "mediation_id",
+    "transaction_id",
+)
+
+
+def exchange_id(record: Any) -> Optional[str]:
+    """Return the identifier of the exchange record belongs to."""
+    if not isinstance(record, dict):
+        return None
+    for key in EXCHANGE_ID_KEYS:
+        value = record.get(key)
+        if value and isinstance(value, str):
+            return value
+    return None
+
+
+class Event:
+    """Immutable webhook event envelope."""
+
+    __slots__ = ("topic", "wallet_id", "exchange_id", "state", "updated_at", "raw_body")
+
+    topic: str
+    wallet_id: Optional[str]
+    exchange_id: Optional[str]
+    state: Optional[str]
+    updated_at: Optional[str]
+    raw_body: bytes
+
+    def __init__(
+        self,
+        topic: str,
+        raw_body: bytes,
+        *,
+        wallet_id: Optional[str] = None,
+        exchange_id: Optional[str] = None,
+        state: Optional[str] = None,
+        updated_at: Optional[str] = None,
+    ):
+        """Initialize the event."""
+        setter = super().__setattr__
+        setter("topic", topic)
+        setter("raw_body", raw_body)
+        setter("wallet_id", wallet_id)
+        setter("exchange_id", exchange_id)
+        setter("state", state)
+        setter("updated_at", updated_at)
+
+    @classmethod
+    def from_raw(
+        cls, topic: str, raw_body: bytes, wallet_id: Optional[str] = None
+    ) -> "Event":
+        """Create an event from a raw webhook body.
+
+        Raises ValueError if the body is not JSON.
+        """
+        record = json.loads(raw_body)
+        if not isinstance(record, dict):
+            return cls(topic, raw_body, wallet_id=wallet_id)
+
+        state = record.get("state")
+        updated_at = record.get("updated_at")
+        return cls(
+            topic,
+            raw_body,
+            wallet_id=wallet_id,
+            exchange_id=exchange_id(record),
+            # States repeat across events, so queued and deduplicated events share them
+            state=sys.intern(state) if isinstance(state, str) else None,
+            updated_at=updated_at if isinstance(updated_at, str) else None,
+        )
+
+    def __setattr__(self, name: str, value: Any):
+        """Events are immutable."""
+        raise AttributeError("Event is immutable")
+
+    def __delattr__(self, name: str):
+        """Events are immutable."""
+        raise AttributeError("Event is immutable")
+
+    def __repr__(self) -> str:
+        """Return a representation without the body."""
+        return (
+            f"Event(topic={self.topic!r}, wallet_id={self.wallet_id!r}, "
+            f"exchange_id={self.exchange_id!r}, state={self.state!r}, "
+            f"updated_at={self.updated_at!r}, size={len(self.raw_body)})"
+        )
+
+    @property
+    def key(self) -> Optional[Tuple[str, Optional[str], str, str, Optional[str]]]:
+        """Return the key identifying duplicates of this event, if it has one."""
+        if not self.exchange_id or not self.state:
+            return None
+        return (
+            self.topic,
+            self.wallet_id,
+            self.exchange_id,
+            self.state,
+            self.updated_at,
+        )
+
+    def json(self) -> Any:
+        """Return the decoded body."""
+        return json.loads(self.raw_body)
+
+    def model(self, model: Type[M]) -> M:
+        """Return the body parsed as model."""
+        return model.parse_raw(self.raw_body)
@@ -0,0 +1,172 @@
+"""Topic and state filtering of webhooks before model validation.
+
+ACA-Py emits a webhook for every state transition of every record. Only a few
+of these require the controller to act; the rest are answered with a cheap 200
+before FastAPI parses them into models.
+"""
+
+import json
+from os import getenv
+from typing import Awaitable, Callable, Dict, FrozenSet, Mapping, Optional
+
+Scope = Mapping
+Message = Dict
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+WILDCARD = "*"
+DEFAULT_ALLOW = ",".join(
+    (
+        "issue_credential:offer_received",
+        "issue_credential:credential_received",
+        "issue_credential_v2_0:offer-received",
+        "issue_credential_v2_0:credential-received",
+    )
+)
+TOPIC_PREFIX = "/topic/"
+
+
+class TopicFilter:
+    """Allow-list of (topic, state) pairs that need action.
+
+    The allow-list is a comma separated list of `topic:state` entries. Either
+    side may be `*` to match anything; a bare `topic` is the same as `topic:*`.
+    """
+
+    def __init__(self, spec: str):
+        """Parse the allow-list from spec."""
+        self.allow_all = False
+        self.topics: Dict[str, Optional[FrozenSet[str]]] = {}
+        self.any_topic_states: FrozenSet[str] = frozenset()
+
+        states: Dict[str, set] = {}
+        for entry in spec.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            topic, _, state = entry.partition(":")
+            topic = topic.strip() or WILDCARD
+            state = state.strip() or WILDCARD
+            if topic == WILDCARD and state == WILDCARD:
+                self.allow_all = True
+            elif state == WILDCARD:
+                states[topic] = None  # pyright: ignore
+            elif topic == WILDCARD:
+                self.any_topic_states |= {state}
+            elif topic not in states or states[topic] is not None:
+                states.setdefault(topic, set()).add(state)
+
+        self.topics = {
+            topic: frozenset(value) if value is not None else None
+            for topic, value in states.items()
+        }
+        self._needles = {
+            topic: tuple(
+                f'"{state}"'.encode() for state in value | self.any_topic_states
+            )
+            for topic, value in self.topics.items()
+            if value is not None
+        }
+
+    @classmethod
+    def from_env(cls) -> "TopicFilter":
+        """Load the allow-list from the WEBHOOK_ALLOW environment variable."""
+        return cls(getenv("WEBHOOK_ALLOW", DEFAULT_ALLOW))
+
+    def allows(self, topic: str, body: bytes) -> bool:
+        """Return whether a webhook with raw body on topic needs action."""
+        if self.allow_all:
+            return True
+
+        if topic in self.topics:
+            states = self.topics[topic]
+            if states is None:
+                return True
+            states = states | self.any_topic_states
+            needles = self._needles[topic]
+        elif self.any_topic_states:
+            states = self.any_topic_states
+            needles = tuple(f'"{state}"'.encode() for state in states)
+        else:
+            return False
+
+        # Most events are rejected here without decoding the body at all
+        if not any(needle in body for needle in needles):
+            return False
+
+        try:
+            value = json.loads(body)
+        except ValueError:
+            # Let the route report the malformed body
+            return True
+
+        return isinstance(value, dict) and value.get("state") in states
+
+
+class TopicFilterMiddleware:
+    """ASGI middleware answering filtered webhooks before they reach a route."""
+
+    def __init__(self, app: ASGIApp, topic_filter: TopicFilter):
+        """Wrap app."""
+        self.app = app
+        self.topic_filter = topic_filter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle a request."""
+        if (
+            self.topic_filter.allow_all
+            or scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(TOPIC_PREFIX)
+        ):
+            return await self.app(scope, receive, send)
+
+        topic = scope["path"][len(TOPIC_PREFIX) :].strip("/")
+        if not topic or "/" in topic:
+            return await self.app(scope, receive, send)
+
+        body = await read_body(receive)
+        # Let the route reject a body that is not a JSON object
+        if body.lstrip().startswith(b"{") and not self.topic_filter.allows(topic, body):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", b"4"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": b"null"})
+            return
+
+        return await self.app(scope, replay_body(body, receive), send)
+
+
+async def read_body(receive: Receive) -> bytes:
+    """Read the complete request body from receive."""
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def replay_body(body: bytes, receive: Receive) -> Receive:
+    """Return a receive callable that yields body before deferring to receive."""
+    sent = False
+
+    async def _receive() -> Message:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return _receive
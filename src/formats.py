@@ -0,0 +1,137 @@
+"""Credential offer format detection.
+
+Deciding whether a credential request needs a holder DID only requires knowing
+the format of the offer. That is answered, from cheapest to most expensive, by:
+
+1. The format identifiers listed in the offer message's `formats`
+2. The keys of the record's `by_format`
+3. The format previously offered over the same connection, i.e. by the same
+   issuer, unless disabled
+4. Fetching the record from the admin API
+
+Slim webhooks carry neither of the first two, so without the guess every offer
+would be fetched. A guess is only made once a connection has offered a single
+format, and a request that fails after a guess is retried with the fetched
+offer if the exchange is still awaiting a request.
+
+Full webhooks, sent with `--debug-webhooks`, are parsed as `V20CredExWebhook`,
+which keeps only the formats of the offer rather than validating its
+attachments, which make up most of the record.
+"""
+
+from collections import OrderedDict
+from os import getenv
+from typing import Iterable, List, Optional
+
+from pydantic import BaseModel
+
+from .models import V20CredExRecord, V20CredFormat
+
+LD_PROOF = "ld_proof"
+INDY = "indy"
+ANONCREDS = "anoncreds"
+VC_DI = "vc_di"
+
+# Prefixes of the attachment format identifiers, mapped to by_format keys
+FORMAT_PREFIXES = (
+    ("aries/ld-proof-vc", LD_PROOF),
+    ("hlindy/", INDY),
+    ("anoncreds/", ANONCREDS),
+    ("didcomm/w3c-di-vc", VC_DI),
+)
+MIXED = "mixed"
+
+FORMAT_CACHE_SIZE = int(getenv("FORMAT_CACHE_SIZE", "1024"))
+FORMAT_GUESS_BY_CONNECTION = getenv("FORMAT_GUESS_BY_CONNECTION", "true") == "true"
+
+
+class V20CredOfferFormats(BaseModel):
+    """Credential offer message, parsed down to the formats it offers."""
+
+    formats: Optional[List[V20CredFormat]] = None
+
+
+class V20CredExWebhook(V20CredExRecord):
+    """ICv2 record received in a webhook, without parsing the offer's attachments."""
+
+    cred_offer: Optional[V20CredOfferFormats] = None  # type: ignore[assignment]
+
+
+def format_from_identifier(identifier: str) -> Optional[str]:
+    """Return the by_format key for an attachment format identifier."""
+    for prefix, key in FORMAT_PREFIXES:
+        if identifier.startswith(prefix):
+            return key
+    return None
+
+
+def single_format(keys: Iterable[Optional[str]]) -> Optional[str]:
+    """Return the format if all keys agree on exactly one."""
+    found = set(keys)
+    found.discard(None)
+    if len(found) != 1:
+        return None
+    return found.pop()
+
+
+def offer_format(cred_rec: V20CredExRecord) -> Optional[str]:
+    """Return the format of the record's offer if the record contains it."""
+    if cred_rec.cred_offer and cred_rec.cred_offer.formats:
+        detected = single_format(
+            format_from_identifier(fmt.format) for fmt in cred_rec.cred_offer.formats
+        )
+        if detected:
+            return detected
+
+    if cred_rec.by_format and cred_rec.by_format.cred_offer:
+        return single_format(cred_rec.by_format.cred_offer.keys())
+
+    return None
+
+
+class ConnectionFormats:
+    """Bounded record of the offer format last used on each connection.
+
+    Connections that have offered more than one format are never used for a
+    guess, since the guess could be wrong.
+    """
+
+    def __init__(
+        self,
+        max_size: int = FORMAT_CACHE_SIZE,
+        enabled: bool = FORMAT_GUESS_BY_CONNECTION,
+    ):
+        """Initialize the record."""
+        self.max_size = max_size
+        self.enabled = enabled
+        self._formats: "OrderedDict[str, str]" = OrderedDict()
+
+    def guess(self, connection_id: Optional[str]) -> Optional[str]:
+        """Return the format used by all previous offers on connection_id."""
+        if not self.enabled or not connection_id:
+            return None
+        value = self._formats.get(connection_id)
+        if value is None or value == MIXED:
+            return None
+        self._formats.move_to_end(connection_id)
+        return value
+
+    def learn(self, connection_id: Optional[str], fmt: str):
+        """Remember that connection_id offered a credential in fmt."""
+        if not connection_id:
+            return
+        previous = self._formats.get(connection_id)
+        self._formats[connection_id] = (
+            fmt if previous is None or previous == fmt else MIXED
+        )
+        self._formats.move_to_end(connection_id)
+        while len(self._formats) > self.max_size:
+            self._formats.popitem(last=False)
+
+    def forget(self, connection_id: Optional[str]):
+        """Stop guessing for connection_id."""
+        if connection_id:
+            self._formats[connection_id] = MIXED
+
+
+connection_formats = ConnectionFormats()
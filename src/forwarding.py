@@ -0,0 +1,367 @@
+"""Forwarding of received webhooks to other services.
+
+Every webhook the controller accepts can be re-published to a set of sinks,
+configured with `FORWARD_TO` as a comma separated list of URLs:
+
+- `http://` or `https://` URLs receive batches of events in POST requests
+- `file:///path` appends events to a local file
+- `unix:///path` and `tcp://host:port` stream events over a socket
+
+Events are written as JSON lines of `{"topic", "wallet_id", "payload"}`. Each
+sink has its own bounded buffer and sends in batches, retrying failed batches
+with exponential backoff. When a sink's buffer is full, accepting a webhook
+waits up to `FORWARD_BLOCK_TIMEOUT` seconds for room before the sink's oldest
+event is dropped, so a slow sink slows ingress without holding unbounded
+memory or affecting other sinks.
+"""
+
+import asyncio
+import json
+from os import getenv
+import re
+import traceback
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from .events import Event
+from .filtering import (
+    TOPIC_PREFIX,
+    ASGIApp,
+    Receive,
+    Scope,
+    Send,
+    TopicFilter,
+    read_body,
+    replay_body,
+)
+from .metrics import Counter, Gauge
+
+FORWARD_TO = getenv("FORWARD_TO", "")
+FORWARD_TOPICS = getenv("FORWARD_TOPICS", "*")
+FORWARD_BUFFER_SIZE = int(getenv("FORWARD_BUFFER_SIZE", "10000"))
+FORWARD_BATCH_SIZE = int(getenv("FORWARD_BATCH_SIZE", "100"))
+FORWARD_FLUSH_INTERVAL = float(getenv("FORWARD_FLUSH_INTERVAL", "0.05"))
+FORWARD_BLOCK_TIMEOUT = float(getenv("FORWARD_BLOCK_TIMEOUT", "1"))
+FORWARD_RETRY_MAX = float(getenv("FORWARD_RETRY_MAX", "30"))
+FORWARD_DRAIN_TIMEOUT = float(getenv("FORWARD_DRAIN_TIMEOUT", "5"))
+
+forward_sent = Counter("controller_forward_sent", "Events forwarded, by sink")
+forward_failures = Counter(
+    "controller_forward_failures", "Failed attempts to send a batch, by sink"
+)
+forward_dropped = Counter(
+    "controller_forward_dropped", "Events dropped without being forwarded, by sink"
+)
+forward_buffered = Gauge(
+    "controller_forward_buffered", "Events buffered for forwarding, by sink"
+)
+
+
+class PermanentError(Exception):
+    """Raised when a sink rejects a batch that would be rejected again."""
+
+
+def event_line(event: Event) -> bytes:
+    """Return the JSON line forwarding event."""
+    payload = event.raw_body
+    if b"\n" in payload or b"\r" in payload:
+        payload = json.dumps(event.json(), separators=(",", ":")).encode()
+    return (
+        b'{"topic":'
+        + json.dumps(event.topic).encode()
+        + b',"wallet_id":'
+        + json.dumps(event.wallet_id).encode()
+        + b',"payload":'
+        + payload
+        + b"}\n"
+    )
+
+
+class Sink:
+    """Bounded buffer of events sent in batches to a destination."""
+
+    def __init__(
+        self,
+        url: str,
+        *,
+        buffer_size: int = FORWARD_BUFFER_SIZE,
+        batch_size: int = FORWARD_BATCH_SIZE,
+        flush_interval: float = FORWARD_FLUSH_INTERVAL,
+        block_timeout: float = FORWARD_BLOCK_TIMEOUT,
+        retry_max: float = FORWARD_RETRY_MAX,
+    ):
+        """Initialize the sink."""
+        self.url = url
+        # Label without credentials
+        self.name = re.sub(r"//[^/@]*@", "//", url)
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.retry_max = retry_max
+        self._queue: "Optional[asyncio.Queue[bytes]]" = None
+        self._task: "Optional[asyncio.Task]" = None
+
+    @staticmethod
+    def from_url(url: str, **kwargs) -> "Sink":
+        """Return the sink for url."""
+        scheme = urlsplit(url).scheme
+        if scheme in ("http", "https"):
+            return HttpSink(url, **kwargs)
+        if scheme == "file":
+            return FileSink(url, **kwargs)
+        if scheme in ("unix", "tcp"):
+            return StreamSink(url, **kwargs)
+        raise ValueError(f"Unsupported forwarding sink: {url}")
+
+    def start(self):
+        """Start sending."""
+        if self._task:
+            return
+        self._queue = asyncio.Queue(self.buffer_size)
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = FORWARD_DRAIN_TIMEOUT):
+        """Send buffered events for up to timeout seconds and stop."""
+        if not self._task or not self._queue:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if not self._queue.empty():
+            print(f"Dropping {self._queue.qsize()} events not forwarded to {self.name}")
+            forward_dropped.inc(self._queue.qsize(), sink=self.name)
+        self._task = None
+        self._queue = None
+        await self.close()
+
+    async def put(self, line: bytes):
+        """Buffer line, waiting for room up to the block timeout."""
+        if not self._queue:
+            return
+        queue = self._queue
+        try:
+            await asyncio.wait_for(queue.put(line), self.block_timeout)
+        except asyncio.TimeoutError:
+            # Shed the oldest event rather than grow without bound
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                forward_dropped.inc(sink=self.name)
+            queue.put_nowait(line)
+        forward_buffered.set(queue.qsize(), sink=self.name)
+
+    async def send(self, lines: List[bytes]):
+        """Send a batch of lines."""
+        raise NotImplementedError()
+
+    async def close(self):
+        """Release connections."""
+
+    async def _send_with_retry(self, lines: List[bytes]):
+        delay = 0.1
+        while True:
+            try:
+                await self.send(lines)
+                forward_sent.inc(len(lines), sink=self.name)
+                return
+            except PermanentError as error:
+                print(f"Forwarding to {self.name} rejected, dropping batch: {error}")
+                forward_dropped.inc(len(lines), sink=self.name)
+                return
+            except (OSError, asyncio.TimeoutError) as error:
+                forward_failures.inc(sink=self.name)
+                print(f"Forwarding to {self.name} failed, retrying: {error!r}")
+            except Exception:
+                # E.g. an invalid sink URL; retrying would fail the same way
+                print(f"Forwarding to {self.name} failed, dropping batch:")
+                traceback.print_exc()
+                forward_failures.inc(sink=self.name)
+                forward_dropped.inc(len(lines), sink=self.name)
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+
+    async def _run(self):
+        assert self._queue
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            if self.flush_interval and queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await self._send_with_retry(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+                forward_buffered.set(queue.qsize(), sink=self.name)
+
+
+class HttpSink(Sink):
+    """POST batches as newline delimited JSON over a keep-alive session."""
+
+    def __init__(self, url: str, **kwargs):
+        """Initialize the sink."""
+        super().__init__(url, **kwargs)
+        self._session = None
+
+    async def send(self, lines: List[bytes]):
+        """POST the batch."""
+        from aiohttp import ClientError, ClientSession, ClientTimeout
+
+        if not self._session:
+            self._session = ClientSession(timeout=ClientTimeout(total=30))
+        try:
+            async with self._session.post(
+                self.url,
+                data=b"".join(lines),
+                headers={"content-type": "application/x-ndjson"},
+            ) as response:
+                await response.read()
+                if response.status >= 500 or response.status == 429:
+                    raise OSError(f"HTTP {response.status}")
+                if response.status >= 400:
+                    raise PermanentError(f"HTTP {response.status}")
+        except ClientError as error:
+            raise OSError(str(error)) from error
+
+    async def close(self):
+        """Close the session."""
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+
+class FileSink(Sink):
+    """Append batches to a local file."""
+
+    def __init__(self, url: str, **kwargs):
+        """Initialize the sink."""
+        super().__init__(url, **kwargs)
+        self.path = urlsplit(url).path
+
+    async def send(self, lines: List[bytes]):
+        """Append the batch without blocking the event loop."""
+        await asyncio.get_event_loop().run_in_executor(None, self._append, lines)
+
+    def _append(self, lines: List[bytes]):
+        with open(self.path, "ab") as file:
+            file.write(b"".join(lines))
+
+
+class StreamSink(Sink):
+    """Write batches to a unix or TCP socket, reconnecting as needed."""
+
+    def __init__(self, url: str, **kwargs):
+        """Initialize the sink."""
+        super().__init__(url, **kwargs)
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        parts = urlsplit(self.url)
+        if parts.scheme == "unix":
+            _, writer = await asyncio.open_unix_connection(parts.path)
+        else:
+            _, writer = await asyncio.open_connection(parts.hostname, parts.port)
+        return writer
+
+    async def send(self, lines: List[bytes]):
+        """Write the batch, dropping the connection on failure."""
+        if not self._writer or self._writer.is_closing():
+            self._writer = await self._connect()
+        try:
+            self._writer.write(b"".join(lines))
+            await self._writer.drain()
+        except OSError:
+            self._writer.close()
+            self._writer = None
+            raise
+
+    async def close(self):
+        """Close the connection."""
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+class Forwarder:
+    """Publish events to every configured sink and listener."""
+
+    def __init__(self, sinks: List[Sink], topic_filter: Optional[TopicFilter] = None):
+        """Initialize the forwarder."""
+        self.sinks = sinks
+        self.topic_filter = topic_filter or TopicFilter("*")
+        self.listeners: List[Callable[[Event], None]] = []
+
+    @classmethod
+    def from_env(cls) -> "Forwarder":
+        """Load the sinks from FORWARD_TO and topics from FORWARD_TOPICS."""
+        urls = [url.strip() for url in FORWARD_TO.split(",") if url.strip()]
+        return cls([Sink.from_url(url) for url in urls], TopicFilter(FORWARD_TOPICS))
+
+    def start(self):
+        """Start every sink."""
+        for sink in self.sinks:
+            sink.start()
+
+    async def stop(self):
+        """Flush and stop every sink."""
+        await asyncio.gather(*(sink.stop() for sink in self.sinks))
+
+    async def publish(self, event: Event):
+        """Pass event to every listener and buffer it for every sink.
+
+        Listeners are called synchronously and must not block.
+        """
+        for listener in self.listeners:
+            listener(event)
+        if not self.sinks or not self.topic_filter.allows(event.topic, event.raw_body):
+            return
+        line = event_line(event)
+        await asyncio.gather(*(sink.put(line) for sink in self.sinks))
+
+
+class ForwardingMiddleware:
+    """ASGI middleware forwarding every accepted /topic/* request."""
+
+    def __init__(self, app: ASGIApp, forwarder: Forwarder):
+        """Wrap app."""
+        self.app = app
+        self.forwarder = forwarder
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle a request."""
+        if scope["type"] != "http" or not scope["path"].startswith(TOPIC_PREFIX):
+            return await self.app(scope, receive, send)
+
+        body = await read_body(receive)
+        status: Dict[str, int] = {}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        await self.app(scope, replay_body(body, receive), _send)
+
+        # Forward only webhooks ACA-Py will not retry
+        if status.get("code", 500) >= 300:
+            return
+        topic = scope["path"][len(TOPIC_PREFIX) :].strip("/")
+        wallet_id = None
+        for key, value in scope["headers"]:
+            if key == b"x-wallet-id":
+                wallet_id = value.decode("latin-1")
+        try:
+            event = Event.from_raw(topic, body, wallet_id)
+        except ValueError:
+            return
+        await self.forwarder.publish(event)
@@ -0,0 +1,213 @@
+"""Ingest of events over the agent's admin WebSocket.
+
+Instead of receiving one HTTP request per event on `/topic/*`, the controller
+can hold a WebSocket to the agent's admin `/ws` endpoint, which pushes the
+same events as `{"topic", "payload", "wallet_id"}` messages. The connection is
+re-established with exponential backoff when it drops.
+
+The admin WebSocket has no way to resume from a position, so any time without
+a connection is a gap in which events may have been missed. Each time the
+connection is (re-)established, the exchanges in states the controller acts on
+are listed through the admin API and fed through the same dispatch as live
+events; events already handled are dropped as duplicates.
+"""
+
+import asyncio
+import json
+from os import getenv
+import traceback
+from typing import Awaitable, Callable, List, Optional, Tuple, Type
+
+from controller import Controller
+from pydantic import BaseModel
+
+from .events import Event
+from .metrics import Counter, Gauge
+from .models import V10CredentialExchangeListResult, V20CredExRecordListResult
+
+WS_INGEST = getenv("WS_INGEST", "") == "true"
+AGENT_API_KEY = getenv("AGENT_API_KEY")
+WS_RECONNECT_MAX = float(getenv("WS_RECONNECT_MAX", "30"))
+WS_HEARTBEAT = float(getenv("WS_HEARTBEAT", "30"))
+
+# Topic, state, admin API path and list result model of exchanges to reconcile
+RECONCILED: Tuple[Tuple[str, str, str, Type[BaseModel]], ...] = (
+    (
+        "issue_credential",
+        "offer_received",
+        "/issue-credential/records",
+        V10CredentialExchangeListResult,
+    ),
+    (
+        "issue_credential",
+        "credential_received",
+        "/issue-credential/records",
+        V10CredentialExchangeListResult,
+    ),
+    (
+        "issue_credential_v2_0",
+        "offer-received",
+        "/issue-credential-2.0/records",
+        V20CredExRecordListResult,
+    ),
+    (
+        "issue_credential_v2_0",
+        "credential-received",
+        "/issue-credential-2.0/records",
+        V20CredExRecordListResult,
+    ),
+)
+
+ws_connects = Counter(
+    "controller_ws_connects", "Connections established to the admin WebSocket"
+)
+ws_events = Counter("controller_ws_events", "Events received over the admin WebSocket")
+reconciled_events = Counter(
+    "controller_reconciled_events", "Events resubmitted by reconciliation, by topic"
+)
+
+
+def websocket_url(admin_url: str) -> str:
+    """Return the admin WebSocket URL of the agent at admin_url."""
+    if admin_url.startswith("https://"):
+        admin_url = "wss://" + admin_url[len("https://") :]
+    elif admin_url.startswith("http://"):
+        admin_url = "ws://" + admin_url[len("http://") :]
+    return admin_url.rstrip("/") + "/ws"
+
+
+def record_body(record: BaseModel) -> bytes:
+    """Return the webhook body of a record fetched from the admin API."""
+    return record.json(by_alias=True, exclude_none=True).encode()
+
+
+async def reconcile(
+    controller: Controller, submit: Callable[[Event], Awaitable[object]]
+) -> int:
+    """Submit an event for every exchange awaiting action; return their number."""
+    count = 0
+    for topic, state, path, model in RECONCILED:
+        listed = await controller.get(path, params={"state": state}, response=model)
+        for result in getattr(listed, "results", None) or []:
+            # ICv2 lists wrap each record with its format details
+            record = getattr(result, "cred_ex_record", None) or result
+            await submit(Event.from_raw(topic, record_body(record)))
+            reconciled_events.inc(topic=topic)
+            count += 1
+    return count
+
+
+class AdminEventStream:
+    """Receive events from an agent's admin WebSocket, reconnecting as needed."""
+
+    def __init__(
+        self,
+        url: str,
+        on_event: Callable[[Event], Awaitable[object]],
+        on_connect: Callable[[], Awaitable[object]],
+        *,
+        api_key: Optional[str] = AGENT_API_KEY,
+        reconnect_max: float = WS_RECONNECT_MAX,
+        heartbeat: float = WS_HEARTBEAT,
+    ):
+        """Initialize the stream.
+
+        on_event is called with every event received and on_connect, e.g. to
+        reconcile missed events, each time the connection is established.
+        """
+        self.url = url
+        self.on_event = on_event
+        self.on_connect = on_connect
+        self.api_key = api_key
+        self.reconnect_max = reconnect_max
+        self.heartbeat = heartbeat
+        self.connected = False
+        self._task: "Optional[asyncio.Task]" = None
+
+    def start(self):
+        """Start receiving events."""
+        if not self._task:
+            streams.append(self)
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        """Close the connection."""
+        if self._task:
+            streams.remove(self)
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        from aiohttp import ClientError, ClientSession, WSMsgType
+
+        headers = {"x-api-key": self.api_key} if self.api_key else {}
+        delay = 0.5
+        async with ClientSession() as session:
+            while True:
+                try:
+                    async with session.ws_connect(
+                        self.url, headers=headers, heartbeat=self.heartbeat
+                    ) as ws:
+                        print("Connected to admin WebSocket", self.url)
+                        self.connected = True
+                        ws_connects.inc()
+                        delay = 0.5
+                        connected = asyncio.get_event_loop().create_task(
+                            self._connected()
+                        )
+                        try:
+                            async for message in ws:
+                                if message.type == WSMsgType.TEXT:
+                                    await self._receive(message.data)
+                        finally:
+                            connected.cancel()
+                except (ClientError, OSError, asyncio.TimeoutError) as error:
+                    print(f"Admin WebSocket {self.url} failed: {error!r}")
+                except Exception:
+                    print(f"Admin WebSocket {self.url} failed unexpectedly:")
+                    traceback.print_exc()
+                self.connected = False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max)
+
+    async def _connected(self):
+        try:
+            await self.on_connect()
+        except Exception as error:
+            print(f"Handling connection to {self.url} failed: {error!r}")
+
+    async def _receive(self, data: str):
+        try:
+            message = json.loads(data)
+            topic = message["topic"]
+            payload = message.get("payload")
+        except (ValueError, KeyError, TypeError):
+            print("Ignoring malformed admin WebSocket message")
+            return
+        if topic in ("ping", "settings"):
+            return
+        ws_events.inc()
+        try:
+            event = Event.from_raw(
+                topic, json.dumps(payload).encode(), message.get("wallet_id")
+            )
+            await self.on_event(event)
+        except ValueError as error:
+            print(f"Ignoring invalid admin WebSocket {topic} event: {error}")
+        except Exception:
+            # One event must not end the stream
+            print(f"Handling admin WebSocket {topic} event failed:")
+            traceback.print_exc()
+
+
+streams: List[AdminEventStream] = []
+
+ws_connected = Gauge(
+    "controller_ws_connected",
+    "Admin WebSockets currently connected",
+    callback=lambda: sum(stream.connected for stream in streams),
+)
@@ -0,0 +1,130 @@
+"""Adaptive concurrency limit for admin API calls.
+
+The number of concurrent calls the agent can take before wallet contention
+drives up latency depends on the agent and its load. Instead of a fixed limit,
+the limit is adjusted with AIMD based on observed latency and errors:
+
+- Each call that completes without error, while the limit was in use, raises
+  the limit by `1 / limit`, i.e. by about one per round of calls.
+- A call that fails, or takes longer than `tolerance` times the baseline
+  latency, lowers the limit by `backoff`, at most once per baseline latency.
+
+The baseline is the lowest recently observed latency, slowly decayed upwards
+so that it follows lasting changes in the agent's performance.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from os import getenv
+from time import monotonic
+from typing import AsyncIterator, Optional
+
+from .metrics import Gauge
+
+ADMIN_MIN_CONCURRENCY = int(getenv("ADMIN_MIN_CONCURRENCY", "1"))
+ADMIN_MAX_CONCURRENCY = int(getenv("ADMIN_MAX_CONCURRENCY", "64"))
+ADMIN_INITIAL_CONCURRENCY = int(getenv("ADMIN_INITIAL_CONCURRENCY", "4"))
+ADMIN_LATENCY_TOLERANCE = float(getenv("ADMIN_LATENCY_TOLERANCE", "2.0"))
+ADMIN_BACKOFF = float(getenv("ADMIN_BACKOFF", "0.9"))
+
+# Fraction the baseline moves towards each sample that is above it
+BASELINE_DECAY = 0.01
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limiter driven by latency and errors."""
+
+    def __init__(
+        self,
+        *,
+        min_limit: int = ADMIN_MIN_CONCURRENCY,
+        max_limit: int = ADMIN_MAX_CONCURRENCY,
+        initial_limit: int = ADMIN_INITIAL_CONCURRENCY,
+        tolerance: float = ADMIN_LATENCY_TOLERANCE,
+        backoff: float = ADMIN_BACKOFF,
+    ):
+        """Initialize the limiter."""
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        """Return the condition waiters block on, created on first use."""
+        if not self._condition:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        """Wait for a free slot."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: Optional[float], error: bool = False):
+        """Release a slot and update the limit with the call's outcome.
+
+        Calls without a latency, such as cancelled calls, leave the limit as is.
+        """
+        if latency is not None:
+            self.update(latency, error, self.in_flight >= int(self.limit))
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def update(self, latency: float, error: bool, saturated: bool):
+        """Adjust the limit with the outcome of a call."""
+        if not error:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * BASELINE_DECAY
+
+        overloaded = error or latency > self.tolerance * (self.baseline or latency)
+        now = monotonic()
+        if overloaded:
+            if now - self._last_decrease >= (self.baseline or 0):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot for the duration of a call, measuring its outcome."""
+        await self.acquire()
+        started = monotonic()
+        latency: Optional[float] = None
+        error = False
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            error = True
+            latency = monotonic() - started
+            raise
+        else:
+            latency = monotonic() - started
+        finally:
+            await self.release(latency, error)
+
+
+admin_limiter = AdaptiveLimiter()
+
+admin_concurrency_limit = Gauge(
+    "controller_admin_concurrency_limit",
+    "Current adaptive limit of concurrent admin API calls",
+    callback=lambda: int(admin_limiter.limit),
+)
+admin_in_flight = Gauge(
+    "controller_admin_in_flight",
+    "Admin API calls currently in flight",
+    callback=lambda: admin_limiter.in_flight,
+)
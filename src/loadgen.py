@@ -0,0 +1,444 @@
+"""Record webhook traffic and replay it against a controller.
+
+Recordings are gzip compressed JSON lines, one per webhook, holding the delay
+since the previous webhook, the topic, the relevant headers and the raw body:
+
+    {"t": 0.012, "topic": "issue_credential_v2_0", "h": {...}, "b": "{...}"}
+
+Usage:
+
+    acapy-webhook-loadgen record recording.jsonl.gz --port 8081
+    acapy-webhook-loadgen replay recording.jsonl.gz --target http://localhost:8080
+    acapy-webhook-loadgen replay recording.jsonl.gz --in-process --speed max
+    acapy-webhook-loadgen generate synthetic.jsonl.gz --count 1000 --attachment-size 65536
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import IO, Any, Dict, Iterator, List, Mapping, NamedTuple, Optional
+
+from .filtering import (
+    TOPIC_PREFIX,
+    ASGIApp,
+    Receive,
+    Scope,
+    Send,
+    read_body,
+    replay_body,
+)
+
+RECORDED_HEADERS = ("content-type", "x-wallet-id")
+
+
+class Webhook(NamedTuple):
+    """A recorded webhook."""
+
+    delay: float
+    topic: str
+    headers: Dict[str, str]
+    body: bytes
+
+
+def open_recording(path: str, mode: str) -> IO[str]:
+    """Open a recording, compressed if path ends in .gz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")  # pyright: ignore
+    return open(path, mode, encoding="utf-8")
+
+
+def read_recording(path: str) -> Iterator[Webhook]:
+    """Read the webhooks of a recording."""
+    with open_recording(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            value = json.loads(line)
+            yield Webhook(
+                value["t"], value["topic"], value.get("h", {}), value["b"].encode()
+            )
+
+
+def webhook_line(
+    delay: float, topic: str, headers: Mapping[str, str], body: bytes
+) -> str:
+    """Return the line recording a webhook."""
+    return (
+        json.dumps(
+            {
+                "t": round(delay, 6),
+                "topic": topic,
+                "h": {key: headers[key] for key in RECORDED_HEADERS if key in headers},
+                "b": body.decode("utf-8", errors="replace"),
+            },
+            separators=(",", ":"),
+        )
+        + "\n"
+    )
+
+
+class Recorder:
+    """Append webhooks to a recording."""
+
+    def __init__(self, path: str):
+        """Open the recording at path."""
+        self.file = open_recording(path, "a")
+        self.lock = Lock()
+        self.last: Optional[float] = None
+
+    def record(self, topic: str, headers: Mapping[str, str], body: bytes):
+        """Record a webhook received now."""
+        now = monotonic()
+        with self.lock:
+            delay = now - self.last if self.last is not None else 0.0
+            self.last = now
+            self.file.write(webhook_line(delay, topic, headers, body))
+            self.file.flush()
+
+    def close(self):
+        """Close the recording."""
+        self.file.close()
+
+
+class RecordingMiddleware:
+    """ASGI middleware recording every /topic/* request."""
+
+    def __init__(self, app: Optional[ASGIApp], recorder: Recorder):
+        """Wrap app; without an app, webhooks are only recorded."""
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle a request."""
+        if scope["type"] != "http" or not scope["path"].startswith(TOPIC_PREFIX):
+            if self.app:
+                return await self.app(scope, receive, send)
+            return await respond(send, 404)
+
+        body = await read_body(receive)
+        headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in scope["headers"]
+        }
+        self.recorder.record(
+            scope["path"][len(TOPIC_PREFIX) :].strip("/"), headers, body
+        )
+        if self.app:
+            return await self.app(scope, replay_body(body, receive), send)
+        return await respond(send, 200)
+
+
+async def respond(send: Send, status: int):
+    """Send an empty JSON response."""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b"null"})
+
+
+async def asgi_post(
+    app: ASGIApp, path: str, headers: Mapping[str, str], body: bytes
+) -> int:
+    """Post body to path of app in-process, returning the response status."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in {"content-type": "application/json", **headers}.items()
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    received = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    status = 500
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        disconnected.set()
+    return status
+
+
+class Report:
+    """Latencies and outcomes of a replay."""
+
+    def __init__(self):
+        """Initialize the report."""
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.elapsed = 0.0
+
+    def add(self, latency: float, error: Optional[str] = None):
+        """Add the outcome of one webhook."""
+        self.latencies.append(latency)
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Return the latency at fraction, e.g. 0.99."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the report as a dictionary."""
+        count = len(self.latencies)
+        errors = sum(self.errors.values())
+        return {
+            "requests": count,
+            "errors": errors,
+            "error_rate": errors / count if count else 0.0,
+            "errors_by_kind": self.errors,
+            "elapsed_seconds": self.elapsed,
+            "throughput": count / self.elapsed if self.elapsed else 0.0,
+            "latency_seconds": {
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "max": max(self.latencies, default=0.0),
+            },
+        }
+
+
+async def replay(
+    webhooks: List[Webhook],
+    post,
+    speed: Optional[float],
+    concurrency: int,
+) -> Report:
+    """Replay webhooks with post at speed times the recorded rate.
+
+    Without a speed, webhooks are sent as fast as concurrency allows.
+    """
+    report = Report()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _send(webhook: Webhook):
+        try:
+            started = perf_counter()
+            try:
+                status = await post(webhook)
+            except Exception as error:
+                report.add(perf_counter() - started, type(error).__name__)
+            else:
+                report.add(
+                    perf_counter() - started,
+                    f"HTTP {status}" if status >= 400 else None,
+                )
+        finally:
+            semaphore.release()
+
+    tasks = []
+    started = perf_counter()
+    offset = 0.0
+    for webhook in webhooks:
+        if speed:
+            offset += webhook.delay / speed
+            delay = started + offset - perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(_send(webhook)))
+
+    await asyncio.gather(*tasks)
+    report.elapsed = perf_counter() - started
+    return report
+
+
+async def replay_over_http(
+    webhooks: List[Webhook], target: str, speed: Optional[float], concurrency: int
+) -> Report:
+    """Replay webhooks against a controller listening at target."""
+    from aiohttp import ClientSession, TCPConnector
+
+    async with ClientSession(
+        base_url=target, connector=TCPConnector(limit=concurrency)
+    ) as session:
+
+        async def _post(webhook: Webhook) -> int:
+            async with session.post(
+                f"{TOPIC_PREFIX}{webhook.topic}",
+                data=webhook.body,
+                headers={"content-type": "application/json", **webhook.headers},
+            ) as response:
+                await response.read()
+                return response.status
+
+        return await replay(webhooks, _post, speed, concurrency)
+
+
+async def replay_in_process(
+    webhooks: List[Webhook], speed: Optional[float], concurrency: int
+) -> Report:
+    """Replay webhooks against the controller app in this process."""
+    from . import app
+
+    await app.router.startup()
+    try:
+
+        async def _post(webhook: Webhook) -> int:
+            return await asgi_post(
+                app, f"{TOPIC_PREFIX}{webhook.topic}", webhook.headers, webhook.body
+            )
+
+        return await replay(webhooks, _post, speed, concurrency)
+    finally:
+        await app.router.shutdown()
+
+
+def parse_speed(value: str) -> Optional[float]:
+    """Parse a replay speed such as 1, 10x or max."""
+    if value == "max":
+        return None
+    return float(value.rstrip("x"))
+
+
+def record_command(args: argparse.Namespace):
+    """Serve a receiver that records webhooks without acting on them."""
+    import uvicorn
+
+    recorder = Recorder(args.recording)
+    try:
+        uvicorn.run(RecordingMiddleware(None, recorder), host=args.host, port=args.port)
+    finally:
+        recorder.close()
+
+
+def replay_command(args: argparse.Namespace):
+    """Replay a recording and print the report."""
+    webhooks = list(read_recording(args.recording))
+    speed = parse_speed(args.speed)
+    if args.in_process:
+        report = asyncio.run(replay_in_process(webhooks, speed, args.concurrency))
+    else:
+        report = asyncio.run(
+            replay_over_http(webhooks, args.target, speed, args.concurrency)
+        )
+    print(json.dumps(report.summary(), indent=2))
+
+
+def generate_command(args: argparse.Namespace):
+    """Write a recording of synthetic webhooks."""
+    from .synthetic import generate, parse_states
+
+    payloads = generate(
+        args.topic,
+        args.count,
+        states=parse_states(args.states) if args.states else None,
+        validate=True,
+        seed=args.seed,
+        ld_proof=not args.indy,
+        attachment_size=args.attachment_size,
+        subject_width=args.subject_width,
+        context_count=args.context_count,
+    )
+    delay = 1 / args.rate if args.rate else 0.0
+    headers = {"content-type": "application/json"}
+    with open_recording(args.recording, "w") as file:
+        for payload in payloads:
+            body = json.dumps(payload).encode()
+            file.write(webhook_line(delay, args.topic, headers, body))
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the load generator."""
+    parser = argparse.ArgumentParser(
+        prog="acapy-webhook-loadgen", description=__doc__.split("\n")[0]
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="Record webhooks sent to this receiver")
+    record.add_argument("recording", help="File to append to; .gz to compress")
+    record.add_argument("--host", default="0.0.0.0")
+    record.add_argument("--port", type=int, default=8081)
+    record.set_defaults(func=record_command)
+
+    replay = commands.add_parser("replay", help="Replay a recording")
+    replay.add_argument("recording")
+    target = replay.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target", help="URL of the controller, e.g. http://localhost")
+    target.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Replay against the controller app in this process",
+    )
+    replay.add_argument(
+        "--speed",
+        default="1",
+        help="Multiple of the recorded rate, e.g. 1, 10x, or max (default 1)",
+    )
+    replay.add_argument(
+        "--concurrency",
+        type=int,
+        default=64,
+        help="Maximum webhooks in flight (default 64)",
+    )
+    replay.set_defaults(func=replay_command)
+
+    generate = commands.add_parser(
+        "generate", help="Write a recording of synthetic webhooks"
+    )
+    generate.add_argument("recording", help="File to write; .gz to compress")
+    generate.add_argument(
+        "--topic",
+        default="issue_credential_v2_0",
+        help="issue_credential_v2_0, issue_credential, present_proof_v2_0 or connections",
+    )
+    generate.add_argument("--count", type=int, default=1000)
+    generate.add_argument(
+        "--rate", type=float, default=100, help="Webhooks per second; 0 for no delay"
+    )
+    generate.add_argument(
+        "--states", help="State distribution, e.g. offer-received=3,done=1"
+    )
+    generate.add_argument(
+        "--attachment-size",
+        type=int,
+        default=0,
+        help="Approximate bytes per attachment",
+    )
+    generate.add_argument("--subject-width", type=int, default=4)
+    generate.add_argument("--context-count", type=int, default=1)
+    generate.add_argument(
+        "--indy", action="store_true", help="Generate Indy instead of LD proof offers"
+    )
+    generate.add_argument("--seed", type=int)
+    generate.set_defaults(func=generate_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Minimal metrics registry exposed in the Prometheus text format."""
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metric:
+    """Base class for metrics."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, registry: Optional["Registry"] = None):
+        """Initialize and register the metric."""
+        self.name = name
+        self.help = help
+        (registry or REGISTRY).register(self)
+
+    def samples(self) -> Iterable[Sample]:
+        """Return the current samples of the metric."""
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, registry: Optional["Registry"] = None):
+        """Initialize the counter."""
+        super().__init__(name, help, registry)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increment the counter."""
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        """Return the current samples of the metric."""
+        return (("_total", labels, value) for labels, value in self._values.items())
+
+
+class Gauge(Metric):
+    """Value that can go up and down, or is read from a callback."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        callback: Optional[Callable[[], float]] = None,
+        registry: Optional["Registry"] = None,
+    ):
+        """Initialize the gauge."""
+        super().__init__(name, help, registry)
+        self.callback = callback
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels: str):
+        """Set the gauge."""
+        self._values[_labels(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increment the gauge."""
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        """Decrement the gauge."""
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterable[Sample]:
+        """Return the current samples of the metric."""
+        if self.callback:
+            return (("", (), float(self.callback())),)
+        return (("", labels, value) for labels, value in self._values.items())
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional["Registry"] = None,
+    ):
+        """Initialize the histogram."""
+        super().__init__(name, help, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Record value."""
+        key = _labels(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def samples(self) -> Iterable[Sample]:
+        """Return the current samples of the metric."""
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", labels + (("le", repr(bound)),), cumulative
+            cumulative += counts[-1]
+            yield "_bucket", labels + (("le", "+Inf"),), cumulative
+            yield "_count", labels, cumulative
+            yield "_sum", labels, self._sums[labels]
+
+
+class Registry:
+    """Collection of metrics."""
+
+    def __init__(self):
+        """Initialize the registry."""
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        """Add metric to the registry."""
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
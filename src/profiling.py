@@ -0,0 +1,113 @@
+"""Sampling profiler and task dumps for the running controller.
+
+The profiler samples the stack of the event loop's thread from a separate
+thread using `sys._current_frames`, so the event loop is never paused or
+instrumented. Samples are returned in the collapsed stack format understood by
+flame graph tools such as `flamegraph.pl` and speedscope.
+"""
+
+import asyncio
+from collections import Counter
+from os import getenv
+import sys
+import threading
+from time import monotonic, sleep
+import traceback
+from types import FrameType
+from typing import List, Optional
+
+import fastapi
+
+PROFILING = getenv("PROFILING", "") == "true"
+PROFILE_MAX_SECONDS = float(getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MIN_INTERVAL = 0.001
+
+_profiling = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another is running."""
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def _stack(frame: Optional[FrameType]) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample(thread_id: int, seconds: float, interval: float) -> Counter:
+    """Sample the stack of thread_id for seconds, returning counts per stack."""
+    if not _profiling.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        stacks: Counter = Counter()
+        deadline = monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+        interval = max(interval, PROFILE_MIN_INTERVAL)
+        while monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stacks[_stack(frame)] += 1
+            del frame
+            sleep(interval)
+        return stacks
+    finally:
+        _profiling.release()
+
+
+async def profile(seconds: float, interval: float) -> str:
+    """Profile the event loop's thread, returning collapsed stacks."""
+    thread_id = threading.get_ident()
+    stacks = await asyncio.get_event_loop().run_in_executor(
+        None, sample, thread_id, seconds, interval
+    )
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _task_frames(task: asyncio.Task, limit: int) -> List[FrameType]:
+    """Return the frames of the chain of coroutines task is awaiting."""
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None and len(frames) < limit:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(
+            awaitable, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(
+            awaitable, "gi_yieldfrom", None
+        )
+    return frames
+
+
+def dump_tasks(limit: int = 32) -> str:
+    """Return the stacks of all asyncio tasks, outermost frame first."""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    lines = [f"{len(tasks)} tasks\n"]
+    for task in tasks:
+        lines.append(f"\n{task.get_name()}:\n")
+        lines.extend(
+            traceback.format_list(
+                [
+                    traceback.FrameSummary(
+                        frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
+                    )
+                    for frame in _task_frames(task, limit)
+                ]
+            )
+        )
+    return "".join(lines)
+
+
+async def require_profiling():
+    """Make routes unavailable unless PROFILING is enabled."""
+    if not PROFILING:
+        raise fastapi.HTTPException(404, "Not Found")
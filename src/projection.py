@@ -0,0 +1,323 @@
+"""Local projection of the exchanges seen in webhooks.
+
+Listing an agent's exchanges, e.g. the pending credential exchanges of a
+connection, is slow on a large wallet. The controller already receives every
+change to every exchange, so it keeps the latest record of each credential and
+presentation exchange in an SQLite table indexed for the common queries, and
+serves those queries itself.
+
+Exchanges are keyed by wallet, topic and exchange id, as in the dispatcher.
+Writes are collected for a short interval and committed in one transaction in
+a worker thread, so the event loop does not wait for the disk. A record only
+replaces the stored one if it is at least as recent, so events handled out of
+order do not move an exchange back, and exchanges are removed once deleted.
+
+The projection holds the webhooks received by this process only; in cluster
+mode each replica projects the webhooks the load balancer sent it.
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+from os import getenv
+from typing import Any, FrozenSet, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from .events import Event, exchange_id
+from .metrics import Counter, Gauge
+
+EXCHANGE_DB = getenv("EXCHANGE_DB", "exchanges.db")
+EXCHANGE_FLUSH_INTERVAL = float(getenv("EXCHANGE_FLUSH_INTERVAL", "0.05"))
+
+PROJECTED_TOPICS = frozenset(
+    (
+        "issue_credential",
+        "issue_credential_v2_0",
+        "present_proof",
+        "present_proof_v2_0",
+    )
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (
+    wallet_id TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    exchange_id TEXT NOT NULL,
+    connection_id TEXT,
+    role TEXT,
+    state TEXT,
+    thread_id TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (wallet_id, topic, exchange_id)
+);
+CREATE INDEX IF NOT EXISTS exchanges_id ON exchanges (exchange_id);
+CREATE INDEX IF NOT EXISTS exchanges_connection
+    ON exchanges (connection_id, state, updated_at);
+CREATE INDEX IF NOT EXISTS exchanges_state ON exchanges (state, updated_at);
+CREATE INDEX IF NOT EXISTS exchanges_role ON exchanges (role, state);
+CREATE INDEX IF NOT EXISTS exchanges_updated_at ON exchanges (updated_at);
+"""
+UPSERT = """
+INSERT INTO exchanges (exchange_id, topic, wallet_id, connection_id, role, state,
+    thread_id, created_at, updated_at, record)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (wallet_id, topic, exchange_id) DO UPDATE SET
+    connection_id = coalesce(excluded.connection_id, exchanges.connection_id),
+    role = coalesce(excluded.role, exchanges.role),
+    state = excluded.state,
+    thread_id = coalesce(excluded.thread_id, exchanges.thread_id),
+    created_at = coalesce(exchanges.created_at, excluded.created_at),
+    updated_at = excluded.updated_at,
+    record = excluded.record
+WHERE exchanges.updated_at IS NULL OR excluded.updated_at >= exchanges.updated_at
+"""
+DELETE = "DELETE FROM exchanges WHERE wallet_id = ? AND topic = ? AND exchange_id = ?"
+COLUMNS = (
+    "exchange_id, topic, wallet_id, connection_id, role, state, thread_id, "
+    "created_at, updated_at, record"
+)
+# Columns that can be filtered on by equality
+FILTERS = ("topic", "wallet_id", "connection_id", "role", "state", "thread_id")
+
+Row = Tuple[Optional[str], ...]
+# Wallet, topic and exchange id
+Key = Tuple[str, str, str]
+
+exchanges_projected = Counter(
+    "controller_exchanges_projected", "Exchange updates written to the projection"
+)
+
+
+class Exchange(BaseModel):
+    """Latest known record of an exchange."""
+
+    exchange_id: str
+    topic: str
+    wallet_id: Optional[str] = None
+    connection_id: Optional[str] = None
+    role: Optional[str] = None
+    state: Optional[str] = None
+    thread_id: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+    record: Any = None
+
+
+class ExchangeList(BaseModel):
+    """Page of exchanges, most recently updated first."""
+
+    total: int
+    results: List[Exchange]
+
+
+class ExchangeQuery(BaseModel):
+    """Criteria selecting exchanges; unset criteria match every exchange."""
+
+    topic: Optional[str] = None
+    wallet_id: Optional[str] = None
+    connection_id: Optional[str] = None
+    role: Optional[str] = None
+    state: Optional[List[str]] = None
+    thread_id: Optional[str] = None
+    updated_after: Optional[str] = None
+    updated_before: Optional[str] = None
+
+
+def _text(record: dict, key: str) -> Optional[str]:
+    value = record.get(key)
+    return value if isinstance(value, str) else None
+
+
+def exchange_row(event: Event) -> Optional[Row]:
+    """Return the projected row of event, None if it has no exchange."""
+    record = event.json()
+    record_id = exchange_id(record)
+    if not record_id:
+        return None
+    return (
+        record_id,
+        event.topic,
+        # The base wallet is stored as "" so it is part of the key
+        event.wallet_id or "",
+        _text(record, "connection_id"),
+        _text(record, "role"),
+        event.state,
+        _text(record, "thread_id"),
+        _text(record, "created_at"),
+        event.updated_at,
+        event.raw_body.decode(),
+    )
+
+
+def _where(query: ExchangeQuery) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    params: List[Any] = []
+    for column in FILTERS:
+        value = getattr(query, column)
+        if isinstance(value, list):
+            clauses.append(f"{column} IN ({','.join('?' * len(value))})")
+            params.extend(value)
+        elif value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if query.updated_after is not None:
+        clauses.append("updated_at > ?")
+        params.append(query.updated_after)
+    if query.updated_before is not None:
+        clauses.append("updated_at < ?")
+        params.append(query.updated_before)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+class ExchangeProjection:
+    """SQLite projection of the latest record of every exchange."""
+
+    def __init__(
+        self,
+        path: str = EXCHANGE_DB,
+        *,
+        flush_interval: float = EXCHANGE_FLUSH_INTERVAL,
+        topics: FrozenSet[str] = PROJECTED_TOPICS,
+    ):
+        """Initialize the projection, creating its table in the database at path."""
+        self.path = path
+        self.flush_interval = flush_interval
+        self.topics = topics
+        if path == ":memory:":
+            print("Exchanges are projected in memory and lost on restart")
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        with self._db:
+            self._db.executescript(SCHEMA)
+        self._count = 0
+        # Serializes use of the connection across threads
+        self._lock = threading.Lock()
+        # Keeps writes in order; created on the event loop
+        self._writing: "Optional[asyncio.Lock]" = None
+        self._pending: List[Row] = []
+        self._deleted: List[Key] = []
+        self._flush: "Optional[asyncio.TimerHandle]" = None
+        self._tasks: "Set[asyncio.Task]" = set()
+
+    def __len__(self) -> int:
+        """Return the number of exchanges as of the last write."""
+        return self._count
+
+    def publish(self, event: Event):
+        """Project event, writing it with the next flush."""
+        if event.topic not in self.topics:
+            return
+        row = exchange_row(event)
+        if not row:
+            return
+        if event.state == "deleted":
+            self._deleted.append((row[2] or "", row[1] or "", row[0] or ""))
+        else:
+            self._pending.append(row)
+        if self._flush is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._write(*self._take())
+                return
+            self._flush = loop.call_later(self.flush_interval, self._flush_soon)
+
+    def _flush_soon(self):
+        task = asyncio.get_event_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take(self) -> Tuple[List[Row], List[Key]]:
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        pending, self._pending = self._pending, []
+        deleted, self._deleted = self._deleted, []
+        return pending, deleted
+
+    async def flush(self):
+        """Write the pending updates in one transaction, after earlier writes."""
+        pending, deleted = self._take()
+        if self._writing is None:
+            self._writing = asyncio.Lock()
+        async with self._writing:
+            if pending or deleted:
+                await asyncio.to_thread(self._write, pending, deleted)
+
+    def _write(self, pending: List[Row], deleted: List[Key]):
+        if not pending and not deleted:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany(UPSERT, pending)
+                self._db.executemany(DELETE, deleted)
+            (self._count,) = self._db.execute(
+                "SELECT count(*) FROM exchanges"
+            ).fetchone()
+        exchanges_projected.inc(len(pending) + len(deleted))
+
+    def _read(self, sql: str, params: List[Any]) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    async def get(
+        self,
+        exchange_id: str,
+        wallet_id: Optional[str] = None,
+        topic: Optional[str] = None,
+    ) -> Optional[Exchange]:
+        """Return the most recently updated exchange with exchange_id.
+
+        wallet_id and topic narrow down exchanges sharing the id.
+        """
+        await self.flush()
+        where, params = _where(ExchangeQuery(wallet_id=wallet_id, topic=topic))
+        clause = f"{where} AND" if where else " WHERE"
+        rows = await asyncio.to_thread(
+            self._read,
+            f"SELECT {COLUMNS} FROM exchanges{clause} exchange_id = ? "
+            "ORDER BY updated_at DESC LIMIT 1",
+            params + [exchange_id],
+        )
+        return self._exchange(rows[0]) if rows else None
+
+    async def query(
+        self, query: ExchangeQuery, limit: int = 50, offset: int = 0
+    ) -> ExchangeList:
+        """Return a page of the exchanges matching query."""
+        await self.flush()
+        where, params = _where(query)
+        total = (
+            await asyncio.to_thread(
+                self._read, f"SELECT count(*) FROM exchanges{where}", params
+            )
+        )[0][0]
+        rows = await asyncio.to_thread(
+            self._read,
+            f"SELECT {COLUMNS} FROM exchanges{where} "
+            "ORDER BY updated_at DESC, exchange_id LIMIT ? OFFSET ?",
+            params + [limit, offset],
+        )
+        return ExchangeList(total=total, results=[self._exchange(row) for row in rows])
+
+    @staticmethod
+    def _exchange(row: sqlite3.Row) -> Exchange:
+        fields = dict(row)
+        fields["record"] = json.loads(fields["record"])
+        fields["wallet_id"] = fields["wallet_id"] or None
+        return Exchange(**fields)
+
+
+exchanges = ExchangeProjection()
+
+exchanges_stored = Gauge(
+    "controller_exchanges",
+    "Exchanges in the projection",
+    callback=lambda: len(exchanges),
+)
@@ -0,0 +1,237 @@
+"""External queue backends shared by several controller nodes.
+
+By default the dispatcher queues events in process, so a node's backlog can
+only be worked off by that node. With a queue backend, webhooks are appended
+to a queue shared by every node and each node's dispatcher consumes from it,
+so any node with free workers takes on work. Delivery is at least once: an
+event is acknowledged once it was handled, and events a node read but never
+acknowledged, e.g. because it crashed, are reclaimed by another node after
+they were idle for a while. A node only reads as many events as its workers
+have room for, and touches the events it still holds before reclaiming, so
+events waiting for a busy node are not taken over and handled twice.
+
+`RedisStreamsBackend` implements the backend with a Redis stream and a
+consumer group. It requires the `redis` package.
+"""
+
+import asyncio
+from os import getenv
+import socket
+from time import monotonic
+from typing import Any, List, Optional, Sequence, Tuple
+
+from .events import Event
+from .metrics import Counter
+
+QUEUE_BACKEND = getenv("QUEUE_BACKEND", "")
+QUEUE_STREAM = getenv("QUEUE_STREAM", "acapy-webhook-events")
+QUEUE_GROUP = getenv("QUEUE_GROUP", "acapy-webhook-controllers")
+QUEUE_CONSUMER = getenv("QUEUE_CONSUMER") or socket.gethostname()
+QUEUE_READ_COUNT = int(getenv("QUEUE_READ_COUNT", "64"))
+QUEUE_BLOCK = float(getenv("QUEUE_BLOCK", "1"))
+QUEUE_RECLAIM_IDLE = float(getenv("QUEUE_RECLAIM_IDLE", "60"))
+QUEUE_MAX_LENGTH = int(getenv("QUEUE_MAX_LENGTH", "100000"))
+
+queue_reclaimed = Counter(
+    "controller_queue_reclaimed",
+    "Events reclaimed from consumers that did not acknowledge them",
+)
+
+
+class Delivery:
+    """Event read from a queue backend, to be acknowledged once handled."""
+
+    __slots__ = ("id", "event")
+
+    def __init__(self, id: str, event: Event):
+        """Initialize the delivery."""
+        self.id = id
+        self.event = event
+
+
+class QueueBackend:
+    """Queue of events shared by controller nodes."""
+
+    # Seconds between attempts to reclaim unacknowledged events
+    reclaim_interval: float = QUEUE_RECLAIM_IDLE
+
+    async def start(self):
+        """Prepare the queue for reading."""
+
+    async def stop(self):
+        """Close the connection to the queue."""
+
+    async def put(self, event: Event):
+        """Append event to the queue."""
+        raise NotImplementedError()
+
+    async def read(self, count: int) -> List[Delivery]:
+        """Return up to count next events for this node, waiting briefly for any."""
+        raise NotImplementedError()
+
+    async def ack(self, ids: Sequence[str]):
+        """Acknowledge the deliveries with ids as handled."""
+        raise NotImplementedError()
+
+    async def touch(self, ids: Sequence[str]):
+        """Mark the deliveries with ids as still being handled by this node."""
+
+    async def reclaim(self, count: int) -> List[Delivery]:
+        """Take over up to count events read but not acknowledged in time."""
+        return []
+
+
+def _text(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+class RedisStreamsBackend(QueueBackend):
+    """Queue backend using a Redis stream read by a consumer group."""
+
+    def __init__(
+        self,
+        client: Any,
+        *,
+        stream: str = QUEUE_STREAM,
+        group: str = QUEUE_GROUP,
+        consumer: str = QUEUE_CONSUMER,
+        count: int = QUEUE_READ_COUNT,
+        block: float = QUEUE_BLOCK,
+        reclaim_idle: float = QUEUE_RECLAIM_IDLE,
+        max_length: int = QUEUE_MAX_LENGTH,
+    ):
+        """Initialize the backend.
+
+        client is a `redis.asyncio` client. Each node reads as its own
+        consumer of group, up to count events at a time, waiting up to block
+        seconds. Events unacknowledged for reclaim_idle seconds are reclaimed.
+        The stream is trimmed to about max_length events.
+        """
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block = block
+        self.reclaim_idle = reclaim_idle
+        self.reclaim_interval = reclaim_idle / 2
+        self.max_length = max_length
+        self._reclaim_from = "0-0"
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: Any) -> "RedisStreamsBackend":
+        """Connect to the Redis server at url."""
+        import redis.asyncio
+
+        return cls(redis.asyncio.from_url(url), **kwargs)
+
+    async def start(self):
+        """Create the stream and consumer group if they do not exist."""
+        from redis.exceptions import ResponseError
+
+        try:
+            await self.client.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    async def stop(self):
+        """Close the connection."""
+        await self.client.aclose()
+
+    async def put(self, event: Event):
+        """Append event to the stream."""
+        await self.client.xadd(
+            self.stream,
+            {
+                "topic": event.topic,
+                "wallet_id": event.wallet_id or "",
+                "body": event.raw_body,
+            },
+            maxlen=self.max_length,
+            approximate=True,
+        )
+
+    async def read(self, count: int) -> List[Delivery]:
+        """Return events not yet delivered to any consumer of the group."""
+        started = monotonic()
+        response = await self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=min(count, self.count),
+            block=int(self.block * 1000),
+        )
+        deliveries: List[Delivery] = []
+        for _, messages in response or []:
+            deliveries.extend(await self._deliveries(messages))
+        if not response:
+            # Some servers, e.g. fakeredis, answer an empty read without blocking
+            await asyncio.sleep(max(self.block - (monotonic() - started), 0))
+        return deliveries
+
+    async def ack(self, ids: Sequence[str]):
+        """Acknowledge ids in the consumer group."""
+        if ids:
+            await self.client.xack(self.stream, self.group, *ids)
+
+    async def touch(self, ids: Sequence[str]):
+        """Reset the idle time of ids by claiming them again for this consumer."""
+        if ids:
+            await self.client.xclaim(
+                self.stream,
+                self.group,
+                self.consumer,
+                min_idle_time=0,
+                message_ids=list(ids),
+                justid=True,
+            )
+
+    async def reclaim(self, count: int) -> List[Delivery]:
+        """Claim events pending longer than reclaim_idle for this consumer."""
+        response = await self.client.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=int(self.reclaim_idle * 1000),
+            start_id=self._reclaim_from,
+            count=min(count, self.count),
+        )
+        self._reclaim_from = _text(response[0])
+        deliveries = await self._deliveries(response[1])
+        queue_reclaimed.inc(len(deliveries))
+        return deliveries
+
+    async def _deliveries(self, messages: List[Tuple[Any, Any]]) -> List[Delivery]:
+        """Return the deliveries of messages, acknowledging unusable ones."""
+        deliveries = []
+        unusable = []
+        for message_id, fields in messages:
+            message_id = _text(message_id)
+            try:
+                fields = {_text(key): value for key, value in (fields or {}).items()}
+                body = fields["body"]
+                event = Event.from_raw(
+                    _text(fields["topic"]),
+                    body.encode() if isinstance(body, str) else bytes(body),
+                    _text(fields.get("wallet_id") or "") or None,
+                )
+            except (KeyError, ValueError):
+                # Malformed, or trimmed from the stream while pending
+                print(f"Dropping unusable queue entry {message_id}")
+                unusable.append(message_id)
+                continue
+            deliveries.append(Delivery(message_id, event))
+        await self.ack(unusable)
+        return deliveries
+
+
+def backend_from_env() -> Optional[QueueBackend]:
+    """Return the backend configured with QUEUE_BACKEND, None for in process."""
+    if not QUEUE_BACKEND:
+        return None
+    if QUEUE_BACKEND.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStreamsBackend.from_url(QUEUE_BACKEND)
+    raise ValueError(f"Unsupported queue backend {QUEUE_BACKEND}")
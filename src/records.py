@@ -0,0 +1,135 @@
+"""On demand retrieval of exchange records from the admin API.
+
+Without `--debug-webhooks`, ACA-Py only sends a slim summary of each record in
+its webhooks. The few details the controller needs are fetched through the
+admin API and kept for a short time so repeated events for the same exchange
+don't cause repeated requests.
+"""
+
+import asyncio
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+from controller import Controller
+
+from .models import V20CredExRecord, V20CredExRecordDetail
+
+T = TypeVar("T")
+
+RECORD_CACHE_TTL = float(getenv("RECORD_CACHE_TTL", "30"))
+RECORD_CACHE_SIZE = int(getenv("RECORD_CACHE_SIZE", "1024"))
+
+
+class RecordCache(Generic[T]):
+    """Bounded, short-TTL cache of records keyed by exchange id.
+
+    A cached record is only returned if it is at least as recent as the
+    `updated_at` of the event asking for it. Concurrent misses for the same
+    exchange share a single fetch.
+    """
+
+    def __init__(
+        self, ttl: float = RECORD_CACHE_TTL, max_size: int = RECORD_CACHE_SIZE
+    ):
+        """Initialize the cache."""
+        self.ttl = ttl
+        self.max_size = max_size
+        self._records: "OrderedDict[str, Tuple[float, str, T]]" = OrderedDict()
+        self._pending: Dict[str, "asyncio.Future[T]"] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, exchange_id: str, updated_at: Optional[str] = None) -> Optional[T]:
+        """Return the cached record for exchange_id if it is still fresh."""
+        entry = self._records.get(exchange_id)
+        if not entry:
+            return None
+
+        expires, cached_updated_at, record = entry
+        if expires < monotonic() or (updated_at or "") > cached_updated_at:
+            del self._records[exchange_id]
+            return None
+
+        self._records.move_to_end(exchange_id)
+        return record
+
+    def put(self, exchange_id: str, record: T, updated_at: Optional[str] = None):
+        """Cache record for exchange_id."""
+        self._records[exchange_id] = (
+            monotonic() + self.ttl,
+            updated_at or "",
+            record,
+        )
+        self._records.move_to_end(exchange_id)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+
+    def evict(self, exchange_id: str):
+        """Remove exchange_id from the cache."""
+        self._records.pop(exchange_id, None)
+
+    async def get_or_fetch(
+        self,
+        exchange_id: str,
+        updated_at: Optional[str],
+        fetch: Callable[[], Awaitable[T]],
+    ) -> T:
+        """Return the cached record or retrieve it with fetch."""
+        record = self.get(exchange_id, updated_at)
+        if record is not None:
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        pending = self._pending.get(exchange_id)
+        if pending:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The fetch we waited for was cancelled, not us: fetch again
+                return await self.get_or_fetch(exchange_id, updated_at, fetch)
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending[exchange_id] = future
+        try:
+            record = await fetch()
+        except Exception as error:
+            future.set_exception(error)
+            # Mark retrieved so a failure without waiters isn't reported
+            future.exception()
+            raise
+        else:
+            future.set_result(record)
+            self.put(exchange_id, record, getattr(record, "updated_at", updated_at))
+            return record
+        finally:
+            # Cancelled, e.g. on shutdown; don't leave waiters hanging
+            if not future.done():
+                future.cancel()
+            del self._pending[exchange_id]
+
+
+cred_ex_v2_records: RecordCache[V20CredExRecord] = RecordCache()
+
+
+async def get_cred_ex_v2_record(
+    controller: Controller, cred_rec: V20CredExRecord
+) -> V20CredExRecord:
+    """Return the full record for a slim ICv2 webhook, fetching if needed."""
+    assert cred_rec.cred_ex_id
+
+    async def _fetch() -> V20CredExRecord:
+        detail = await controller.get(
+            f"/issue-credential-2.0/records/{cred_rec.cred_ex_id}",
+            response=V20CredExRecordDetail,
+        )
+        assert detail.cred_ex_record
+        return detail.cred_ex_record
+
+    return await cred_ex_v2_records.get_or_fetch(
+        cred_rec.cred_ex_id, cred_rec.updated_at, _fetch
+    )
@@ -0,0 +1,73 @@
+"""Draining on termination signals before the server shuts down.
+
+Servers such as uvicorn stop accepting connections as soon as they receive
+SIGTERM, and only run the application's shutdown once in-flight requests have
+finished. Draining only then leaves no time in which webhooks are refused with
+`503` so that ACA-Py retries them against another instance. The server's
+signal handlers are therefore wrapped: on the first signal the application
+drains while still accepting requests, and the server's handler runs once it
+has. A second signal runs the server's handler right away.
+"""
+
+import asyncio
+import signal
+import traceback
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+DRAINED_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def server_handler(
+    loop: asyncio.AbstractEventLoop, sig: int
+) -> Optional[Callable[[], Any]]:
+    """Return a call of the server's handler of sig, None if there is none."""
+    # uvicorn before 0.29 registers its handlers with the loop
+    registered = getattr(loop, "_signal_handlers", {}).get(sig)
+    if registered is not None:
+        return lambda: registered._run()
+    handler = signal.getsignal(sig)
+    if not callable(handler) or handler is signal.default_int_handler:
+        return None
+    return lambda: handler(sig, None)
+
+
+def drain_before_exit(
+    drain: Callable[[], Awaitable[Any]], signals: Iterable[int] = DRAINED_SIGNALS
+) -> bool:
+    """Run drain on a termination signal before passing it on to the server.
+
+    Returns whether the server's handlers were wrapped; without a server
+    handling the signals, or outside the main thread, nothing is done.
+    """
+    loop = asyncio.get_event_loop()
+    draining: "Optional[asyncio.Task]" = None
+    wrapped = False
+
+    def _on_signal(exit: Callable[[], Any]):
+        nonlocal draining
+        if draining:
+            exit()
+            return
+        print("Draining before shutdown")
+        draining = loop.create_task(_drain(exit))
+
+    async def _drain(exit: Callable[[], Any]):
+        try:
+            await drain()
+        except Exception:
+            print("Draining before shutdown failed:")
+            traceback.print_exc()
+        finally:
+            exit()
+
+    for sig in signals:
+        exit = server_handler(loop, sig)
+        if exit is None:
+            continue
+        try:
+            loop.add_signal_handler(sig, _on_signal, exit)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not supported by the loop, or not the main thread
+            return wrapped
+        wrapped = True
+    return wrapped
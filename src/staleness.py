@@ -0,0 +1,157 @@
+"""Verification of stale events before acting on them.
+
+After an outage, ACA-Py may deliver events that are hours old, whose exchanges
+have since moved on, been abandoned or deleted. Acting on them only produces
+admin API calls that fail. Events whose `updated_at` is older than their
+topic's maximum age are therefore checked against the current state of their
+exchange first and only acted on if the exchange is still in that state.
+
+Verifications are collected for a short interval and answered with a single
+listing of the exchanges in each state, so a backlog of stale events costs one
+admin API call per state rather than one per event.
+"""
+
+import asyncio
+from os import getenv
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple, Type
+
+from controller import Controller
+from pydantic import BaseModel
+
+from .events import exchange_id
+from .metrics import Counter
+from .models import V10CredentialExchangeListResult, V20CredExRecordListResult
+from .statemachine import normalize
+from .timestamps import parse_timestamp
+
+MAX_EVENT_AGE = getenv("MAX_EVENT_AGE", "")
+STALE_VERIFY_INTERVAL = float(getenv("STALE_VERIFY_INTERVAL", "0.05"))
+
+# Admin API path and list result model of the exchanges of each topic
+VERIFIED: Dict[str, Tuple[str, Type[BaseModel]]] = {
+    "issue_credential": ("/issue-credential/records", V10CredentialExchangeListResult),
+    "issue_credential_v2_0": (
+        "/issue-credential-2.0/records",
+        V20CredExRecordListResult,
+    ),
+}
+
+stale_events = Counter(
+    "controller_stale_events",
+    "Events verified for exceeding their maximum age, by topic",
+)
+stale_events_dropped = Counter(
+    "controller_stale_events_dropped",
+    "Stale events dropped as their exchange moved on, by topic",
+)
+
+Fetch = Callable[[str, str], Awaitable[Dict[str, Any]]]
+
+
+def parse_max_ages(spec: str) -> Dict[str, float]:
+    """Parse a comma separated list of `topic:seconds` maximum event ages.
+
+    A topic of `*`, or seconds without a topic, applies to every other topic.
+    """
+    ages: Dict[str, float] = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        topic, _, seconds = entry.rpartition(":")
+        try:
+            ages[topic.strip() or "*"] = float(seconds)
+        except ValueError:
+            raise ValueError(f"Invalid maximum event age {entry!r}") from None
+    return ages
+
+
+class MaxAge:
+    """Maximum age of events per topic."""
+
+    def __init__(self, ages: Dict[str, float]):
+        """Initialize the maximum ages."""
+        self.ages = ages
+
+    @classmethod
+    def from_env(cls) -> "MaxAge":
+        """Return the maximum ages configured with MAX_EVENT_AGE."""
+        return cls(parse_max_ages(MAX_EVENT_AGE))
+
+    def get(self, topic: str) -> Optional[float]:
+        """Return the maximum age of events of topic, None if unlimited."""
+        return self.ages.get(topic, self.ages.get("*"))
+
+    def stale(self, topic: str, updated_at: Optional[str]) -> bool:
+        """Return whether a record updated at updated_at is too old for topic."""
+        max_age = self.get(topic)
+        if max_age is None:
+            return False
+        updated = parse_timestamp(updated_at)
+        return updated is not None and time() - updated > max_age
+
+
+async def list_exchanges(
+    controller: Controller, topic: str, state: str
+) -> Dict[str, Any]:
+    """Return the current records of topic's exchanges in state by exchange id."""
+    path, model = VERIFIED[topic]
+    listed = await controller.get(path, params={"state": state}, response=model)
+    records: Dict[str, Any] = {}
+    for result in getattr(listed, "results", None) or []:
+        # ICv2 lists wrap each record with its format details
+        record = getattr(result, "cred_ex_record", None) or result
+        record_id = exchange_id(record.dict())
+        if record_id:
+            records[record_id] = record
+    return records
+
+
+class StaleVerifier:
+    """Check stale events against the current state of their exchanges.
+
+    Verifications of the same topic and state arriving within the flush
+    interval share one listing of the exchanges in that state.
+    """
+
+    def __init__(self, fetch: Fetch, *, flush_interval: float = STALE_VERIFY_INTERVAL):
+        """Initialize the verifier.
+
+        fetch is called with a topic and state and returns the current records
+        of the exchanges in that state by exchange id.
+        """
+        self.fetch = fetch
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[str, str], "asyncio.Future[Dict[str, Any]]"] = {}
+        # Referenced until done, as the loop only keeps weak references
+        self._flushes: "Set[asyncio.Task]" = set()
+
+    async def verify(self, topic: str, state: str, exchange: str) -> Optional[Any]:
+        """Return the current record of exchange if it is still in state."""
+        stale_events.inc(topic=topic)
+        key = (topic, state)
+        pending = self._pending.get(key)
+        if not pending:
+            pending = asyncio.get_event_loop().create_future()
+            self._pending[key] = pending
+            task = asyncio.get_event_loop().create_task(self._flush(key, pending))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+        record = (await asyncio.shield(pending)).get(exchange)
+        if record is None or normalize(record.state or "") != normalize(state):
+            stale_events_dropped.inc(topic=topic)
+            return None
+        return record
+
+    async def _flush(self, key: Tuple[str, str], pending: "asyncio.Future"):
+        if self.flush_interval:
+            await asyncio.sleep(self.flush_interval)
+        del self._pending[key]
+        try:
+            pending.set_result(await self.fetch(*key))
+        except Exception as error:
+            pending.set_exception(error)
+            # Mark retrieved so a failure without waiters isn't reported
+            pending.exception()
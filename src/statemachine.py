@@ -0,0 +1,268 @@
+"""Table-driven handling of exchange state transitions.
+
+Each protocol is described by its states in the order an exchange moves
+through them, and actions are registered for (protocol, role, state). The
+table is compiled into a single lookup dict before the first event.
+
+States are compared after normalizing their spelling, so `offer_received`
+(issue-credential 1.0) and `offer-received` (2.0) are the same state. The last
+state seen for each exchange of each wallet is remembered; an event whose
+state comes before it, or follows a terminal state, is stale and skipped
+without calling the admin API, as is an event with a state the protocol does
+not have.
+"""
+
+from collections import OrderedDict
+from os import getenv
+import sys
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .metrics import Counter
+
+STATE_TRACKING_SIZE = int(getenv("STATE_TRACKING_SIZE", "10000"))
+
+Action = Callable[[Any], Awaitable[Any]]
+
+transitions_skipped = Counter(
+    "controller_transitions_skipped",
+    "Events skipped as stale or impossible transitions, by protocol and reason",
+)
+
+
+def normalize(state: str) -> str:
+    """Return the spelling-independent form of state."""
+    # Interned, as the last state of every tracked exchange is kept
+    return sys.intern(state.replace("_", "-").lower())
+
+
+class Protocol:
+    """Ordered states of a protocol."""
+
+    def __init__(
+        self,
+        name: str,
+        stages: Sequence[Sequence[str]],
+        terminal: Iterable[str] = (),
+    ):
+        """Initialize the protocol.
+
+        stages lists the states an exchange moves through in order, with the
+        states of either role at the same stage grouped together. Terminal
+        states may follow any stage and end the exchange.
+        """
+        self.name = name
+        self.ranks: Dict[str, int] = {
+            normalize(state): rank
+            for rank, states in enumerate(stages)
+            for state in states
+        }
+        self.terminal: FrozenSet[str] = frozenset(normalize(s) for s in terminal)
+        for state in self.terminal:
+            self.ranks[state] = len(stages)
+
+    def rank(self, state: str) -> Optional[int]:
+        """Return the stage of a normalized state, None if unknown."""
+        return self.ranks.get(state)
+
+
+PROTOCOLS = (
+    Protocol(
+        "issue_credential",
+        (
+            ("proposal_sent", "proposal_received"),
+            ("offer_sent", "offer_received"),
+            ("request_sent", "request_received"),
+            ("credential_issued", "credential_received"),
+            ("credential_acked",),
+        ),
+        terminal=("credential_revoked", "abandoned", "deleted"),
+    ),
+    Protocol(
+        "issue_credential_v2_0",
+        (
+            ("proposal-sent", "proposal-received"),
+            ("offer-sent", "offer-received"),
+            ("request-sent", "request-received"),
+            ("credential-issued", "credential-received"),
+            ("done",),
+        ),
+        terminal=("credential-revoked", "abandoned", "deleted"),
+    ),
+    Protocol(
+        "present_proof",
+        (
+            ("proposal_sent", "proposal_received"),
+            ("request_sent", "request_received"),
+            ("presentation_sent", "presentation_received"),
+            ("verified", "presentation_acked"),
+        ),
+        terminal=("abandoned", "deleted"),
+    ),
+    Protocol(
+        "present_proof_v2_0",
+        (
+            ("proposal-sent", "proposal-received"),
+            ("request-sent", "request-received"),
+            ("presentation-sent", "presentation-received"),
+            ("done",),
+        ),
+        terminal=("abandoned", "deleted"),
+    ),
+    Protocol(
+        "connections",
+        (
+            ("start", "init"),
+            ("invitation",),
+            ("request",),
+            ("response",),
+            ("active", "completed"),
+        ),
+        terminal=("error", "abandoned", "deleted"),
+    ),
+)
+
+
+class StateMachine:
+    """Dispatch exchange states to actions registered in a table."""
+
+    def __init__(
+        self,
+        protocols: Iterable[Protocol] = PROTOCOLS,
+        tracking_size: int = STATE_TRACKING_SIZE,
+    ):
+        """Initialize the state machine."""
+        self.protocols = {protocol.name: protocol for protocol in protocols}
+        self.tracking_size = tracking_size
+        self.table: List[Tuple[str, str, str, Action]] = []
+        self._actions: Optional[Dict[Tuple[str, str, str], Action]] = None
+        self._last_seen: "OrderedDict[Tuple[str, Optional[str], str], str]" = (
+            OrderedDict()
+        )
+
+    def on(self, protocol: str, role: str, state: str):
+        """Register the decorated function as the action for state.
+
+        The action is called with the record of the exchange.
+        """
+        if protocol not in self.protocols:
+            raise ValueError(f"Unknown protocol {protocol}")
+        if self.protocols[protocol].rank(normalize(state)) is None:
+            raise ValueError(f"Unknown state {state} of {protocol}")
+
+        def _decorator(func: Action) -> Action:
+            self.table.append((protocol, role, state, func))
+            self._actions = None
+            return func
+
+        return _decorator
+
+    def compile(self) -> Dict[Tuple[str, str, str], Action]:
+        """Compile the table into the lookup dict.
+
+        Records without a role, e.g. trimmed webhooks, get the action of
+        their state if only one role has an action for it.
+        """
+        actions = {
+            (protocol, role, normalize(state)): action
+            for protocol, role, state, action in self.table
+        }
+        roles: Dict[Tuple[str, str], List[str]] = {}
+        for protocol, role, state in actions:
+            roles.setdefault((protocol, state), []).append(role)
+        for (protocol, state), state_roles in roles.items():
+            if len(state_roles) == 1:
+                actions.setdefault(
+                    (protocol, "", state), actions[(protocol, state_roles[0], state)]
+                )
+        self._actions = actions
+        return actions
+
+    def action_states(self, protocol: str) -> FrozenSet[str]:
+        """Return the states of protocol with an action, in both spellings."""
+        states = {
+            normalize(state) for name, _, state, _ in self.table if name == protocol
+        }
+        return frozenset(states | {state.replace("-", "_") for state in states})
+
+    def acts_on(self, protocol: str, role: Optional[str], state: Optional[str]) -> bool:
+        """Return whether an action is registered for state."""
+        if not state:
+            return False
+        actions = self._actions if self._actions is not None else self.compile()
+        return (protocol, role or "", normalize(state)) in actions
+
+    def observe(
+        self,
+        protocol: str,
+        exchange_id: Optional[str],
+        state: str,
+        wallet_id: Optional[str] = None,
+    ) -> bool:
+        """Record state for the exchange; return whether the transition is valid.
+
+        The exchanges of each wallet are tracked apart, as exchange ids need
+        not be unique across tenants. A transition is invalid if state is
+        unknown to the protocol, comes before the last state seen, or follows a
+        terminal state.
+        """
+        definition = self.protocols[protocol]
+        rank = definition.rank(state)
+        if rank is None:
+            transitions_skipped.inc(protocol=protocol, reason="unknown")
+            return False
+        if not exchange_id:
+            return True
+
+        key = (protocol, wallet_id, exchange_id)
+        last = self._last_seen.get(key)
+        if last is not None:
+            self._last_seen.move_to_end(key)
+            last_rank = definition.rank(last)
+            if (last in definition.terminal and state != last) or (
+                last_rank is not None and rank < last_rank
+            ):
+                transitions_skipped.inc(protocol=protocol, reason="stale")
+                return False
+
+        self._last_seen[key] = state
+        while len(self._last_seen) > self.tracking_size:
+            self._last_seen.popitem(last=False)
+        return True
+
+    async def handle(
+        self,
+        protocol: str,
+        role: Optional[str],
+        state: Optional[str],
+        exchange_id: Optional[str],
+        record: Any,
+        wallet_id: Optional[str] = None,
+    ) -> bool:
+        """Run the action for the exchange's state; return whether one ran."""
+        if not state or protocol not in self.protocols:
+            return False
+        state = normalize(state)
+        if not self.observe(protocol, exchange_id, state, wallet_id):
+            print(f"Skipping {state} of {protocol} exchange {exchange_id}")
+            return False
+
+        actions = self._actions if self._actions is not None else self.compile()
+        action = actions.get((protocol, role or "", state))
+        if not action:
+            return False
+        await action(record)
+        return True
+
+
+machine = StateMachine()
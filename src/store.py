@@ -0,0 +1,143 @@
+"""Coalescing of credential store operations.
+
+Storing a credential is serialized on the agent's wallet. When an issuer issues
+in bulk, storing every credential as soon as its webhook arrives only causes
+contention on the wallet. Store operations are instead run with bounded
+concurrency, optionally collected for a short interval into micro-batches.
+
+At most one store is pending per dispatcher worker, so batches are sized from
+the worker count, and a batch is started without waiting for the previous one
+to finish, so one slow store does not hold up the stores after it.
+"""
+
+import asyncio
+import contextvars
+from os import getenv
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from .dispatch import DISPATCH_WORKERS
+
+STORE_CONCURRENCY = int(getenv("STORE_CONCURRENCY", "4"))
+STORE_FLUSH_INTERVAL = float(getenv("STORE_FLUSH_INTERVAL", "0"))
+STORE_BATCH_SIZE = int(getenv("STORE_BATCH_SIZE", str(DISPATCH_WORKERS)))
+
+Pending = Tuple[str, "asyncio.Future[Any]", contextvars.Context]
+
+
+class StoreBatcher:
+    """Run store operations in micro-batches with bounded concurrency.
+
+    Each submitted operation resolves its own future, so one failure does not
+    affect the other records in the batch.
+    """
+
+    def __init__(
+        self,
+        store: Callable[[str], Awaitable[Any]],
+        *,
+        concurrency: int = STORE_CONCURRENCY,
+        flush_interval: float = STORE_FLUSH_INTERVAL,
+        batch_size: int = STORE_BATCH_SIZE,
+    ):
+        """Initialize the batcher.
+
+        store is called with the path of each record to store.
+        """
+        self.store = store
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue: "Optional[asyncio.Queue[Pending]]" = None
+        self._task: "Optional[asyncio.Task]" = None
+        self._stores: "Set[asyncio.Task]" = set()
+        self._started: "Set[asyncio.Future[Any]]" = set()
+
+    @property
+    def running(self) -> bool:
+        """Return whether the batcher is accepting operations."""
+        return self._task is not None
+
+    def start(self):
+        """Start flushing batches."""
+        if self._task:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        """Flush outstanding operations and stop."""
+        if not self._task or not self._queue:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._queue = None
+
+    async def submit(self, path: str) -> Any:
+        """Store the record at path as part of the next batch.
+
+        If cancelled, e.g. when the dispatcher stops, a store that has not
+        started is skipped, so the record is stored when its event is handled
+        again. One that has started is waited for instead, so the caller
+        finishes and its event is not handled, and stored, again.
+        """
+        if not self._queue:
+            return await self.store(path)
+
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((path, future, contextvars.copy_context()))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done() and future not in self._started:
+                future.cancel()
+                raise
+        return await future
+
+    async def _store(
+        self,
+        pending: Pending,
+        semaphore: asyncio.Semaphore,
+        queue: "asyncio.Queue[Pending]",
+    ):
+        path, future, context = pending
+        try:
+            async with semaphore:
+                if future.cancelled():
+                    return
+                self._started.add(future)
+                # Store in the submitter's context, e.g. its trace span
+                result = await context.run(
+                    asyncio.get_event_loop().create_task, self.store(path)
+                )
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._started.discard(future)
+            queue.task_done()
+
+    async def _run(self):
+        assert self._queue
+        queue = self._queue
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_event_loop()
+        while True:
+            batch: List[Pending] = [await queue.get()]
+            if self.flush_interval:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            # Not awaited, so the next batch is not held up by a slow store
+            for pending in batch:
+                task = loop.create_task(self._store(pending, semaphore, queue))
+                self._stores.add(task)
+                task.add_done_callback(self._stores.discard)
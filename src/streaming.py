@@ -0,0 +1,207 @@
+"""Server-sent event stream of received webhooks.
+
+The stream is enabled with `EVENTS_STREAM=true`. Subscribers receive every
+accepted webhook matching their filters. Each subscriber has a bounded buffer;
+when a subscriber falls behind, its oldest events are dropped and it is told
+how many it missed, so slow consumers neither hold memory nor slow down ingest.
+
+Streams end after `EVENTS_MAX_STREAM_SECONDS` so they do not hold up a
+graceful shutdown; clients reconnect with `Last-Event-ID` and resume from the
+recent history.
+"""
+
+import asyncio
+from collections import deque
+import json
+from os import getenv
+from time import monotonic
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    FrozenSet,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import fastapi
+
+from .events import Event
+from .forwarding import event_line
+from .metrics import Counter, Gauge
+
+EVENTS_STREAM = getenv("EVENTS_STREAM", "") == "true"
+EVENTS_BUFFER_SIZE = int(getenv("EVENTS_BUFFER_SIZE", "256"))
+EVENTS_HISTORY_SIZE = int(getenv("EVENTS_HISTORY_SIZE", "100"))
+EVENTS_KEEPALIVE = float(getenv("EVENTS_KEEPALIVE", "15"))
+EVENTS_MAX_STREAM_SECONDS = float(getenv("EVENTS_MAX_STREAM_SECONDS", "60"))
+
+Published = Tuple[int, Event]
+
+events_stream_dropped = Counter(
+    "controller_events_stream_dropped", "Events dropped for slow stream subscribers"
+)
+
+
+def connection_id(event: Event) -> Optional[str]:
+    """Return the connection of event's record."""
+    try:
+        record = event.json()
+    except ValueError:
+        return None
+    if isinstance(record, dict) and isinstance(record.get("connection_id"), str):
+        return record["connection_id"]
+    return None
+
+
+class Subscription:
+    """Bounded buffer of the events matching a subscriber's filters."""
+
+    def __init__(
+        self,
+        *,
+        topics: Optional[FrozenSet[str]] = None,
+        states: Optional[FrozenSet[str]] = None,
+        connection: Optional[str] = None,
+        buffer_size: int = EVENTS_BUFFER_SIZE,
+    ):
+        """Initialize the subscription; filters left as None match anything."""
+        self.topics = topics
+        self.states = states
+        self.connection = connection
+        self.buffer: Deque[Published] = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def matches(self, event: Event, connection: Optional[str]) -> bool:
+        """Return whether event, of connection, matches the filters."""
+        if self.topics is not None and event.topic not in self.topics:
+            return False
+        if self.states is not None and event.state not in self.states:
+            return False
+        if self.connection is not None and connection != self.connection:
+            return False
+        return True
+
+    def push(self, published: Published):
+        """Buffer an event, dropping the oldest if the buffer is full."""
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            events_stream_dropped.inc()
+        self.buffer.append(published)
+        self._ready.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait up to timeout for buffered events, returning whether any are."""
+        if not self.buffer:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return bool(self.buffer)
+
+
+class Broadcaster:
+    """Publish events to subscriptions, keeping a short history for resuming."""
+
+    def __init__(self, history_size: int = EVENTS_HISTORY_SIZE):
+        """Initialize the broadcaster."""
+        self.subscriptions: Set[Subscription] = set()
+        self.history: Deque[Published] = deque(maxlen=history_size)
+        self.sequence = 0
+
+    def publish(self, event: Event):
+        """Publish event to every matching subscription."""
+        self.sequence += 1
+        published = (self.sequence, event)
+        self.history.append(published)
+        # The body is decoded at most once, and only if a subscriber needs it
+        connection = None
+        if any(subscription.connection for subscription in self.subscriptions):
+            connection = connection_id(event)
+        for subscription in self.subscriptions:
+            if subscription.matches(event, connection):
+                subscription.push(published)
+
+    def subscribe(
+        self, subscription: Subscription, last_event_id: Optional[int] = None
+    ) -> Subscription:
+        """Add subscription, replaying history after last_event_id."""
+        if last_event_id is not None:
+            for published in self.history:
+                sequence, event = published
+                if sequence <= last_event_id:
+                    continue
+                connection = connection_id(event) if subscription.connection else None
+                if subscription.matches(event, connection):
+                    subscription.push(published)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Remove subscription."""
+        self.subscriptions.discard(subscription)
+
+    async def stream(
+        self,
+        subscription: Subscription,
+        disconnected: Callable[[], Awaitable[bool]],
+        *,
+        last_event_id: Optional[int] = None,
+        keepalive: float = EVENTS_KEEPALIVE,
+        max_seconds: float = EVENTS_MAX_STREAM_SECONDS,
+    ) -> AsyncIterator[bytes]:
+        """Subscribe and yield events in the server-sent events format.
+
+        The subscription is removed when the stream ends.
+        """
+        deadline = monotonic() + max_seconds
+        self.subscribe(subscription, last_event_id)
+        try:
+            # Reconnect shortly after the server ends the stream
+            yield b"retry: 1000\n\n"
+            while monotonic() < deadline and not await disconnected():
+                if not await subscription.wait(min(keepalive, deadline - monotonic())):
+                    yield b": keepalive\n\n"
+                    continue
+                if subscription.dropped:
+                    data = json.dumps({"count": subscription.dropped})
+                    subscription.dropped = 0
+                    yield f"event: dropped\ndata: {data}\n\n".encode()
+                while subscription.buffer:
+                    sequence, event = subscription.buffer.popleft()
+                    yield b"id: %d\nevent: %s\ndata: %s\n" % (
+                        sequence,
+                        event.topic.encode(),
+                        event_line(event),
+                    )
+        finally:
+            self.unsubscribe(subscription)
+
+
+def parse_filter(values: Optional[List[str]]) -> Optional[FrozenSet[str]]:
+    """Parse repeated or comma separated query values into a filter."""
+    if not values:
+        return None
+    return frozenset(
+        value.strip() for entry in values for value in entry.split(",") if value.strip()
+    )
+
+
+async def require_events_stream():
+    """Make routes unavailable unless EVENTS_STREAM is enabled."""
+    if not EVENTS_STREAM:
+        raise fastapi.HTTPException(404, "Not Found")
+
+
+broadcaster = Broadcaster()
+
+events_subscribers = Gauge(
+    "controller_events_subscribers",
+    "Subscribers to the event stream",
+    callback=lambda: len(broadcaster.subscriptions),
+)
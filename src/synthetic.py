@@ -0,0 +1,297 @@
+"""Synthetic webhook payloads for scaling benchmarks.
+
+Payloads are valid against the models in `src.models`. Their size is controlled
+by the size of each attachment, the number of attributes in the credential
+subject and the number of JSON-LD contexts, and their states are drawn from a
+weighted distribution.
+"""
+
+import base64
+from datetime import datetime, timezone
+import random
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, Tuple, Type
+from uuid import UUID
+
+from pydantic import BaseModel
+
+from .models import ConnRecord, V10CredentialExchange, V20CredExRecord, V20PresExRecord
+
+LD_PROOF_FORMAT = "aries/ld-proof-vc-detail@v1.0"
+INDY_OFFER_FORMAT = "hlindy/cred-abstract@v2.0"
+DIF_REQUEST_FORMAT = "dif/presentation-exchange/definitions@v1.0"
+BASE_CONTEXT = "https://www.w3.org/2018/credentials/v1"
+
+DEFAULT_STATES: Dict[str, Dict[str, float]] = {
+    "issue_credential_v2_0": {
+        "offer-received": 1,
+        "request-sent": 1,
+        "credential-received": 1,
+        "done": 1,
+    },
+    "issue_credential": {
+        "offer_received": 1,
+        "request_sent": 1,
+        "credential_received": 1,
+        "credential_acked": 1,
+    },
+    "present_proof_v2_0": {
+        "request-received": 1,
+        "presentation-sent": 1,
+        "done": 1,
+    },
+    "connections": {
+        "request": 1,
+        "response": 1,
+        "active": 1,
+    },
+}
+
+
+# Randomness of generators called without a seeded generator
+_rng = random.Random()
+
+
+def uid(rng: random.Random) -> str:
+    """Return a random UUID drawn from rng."""
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def timestamp() -> str:
+    """Return the current time formatted as ACA-Py does."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%fZ")
+
+
+def padding(size: int) -> str:
+    """Return a string of roughly size bytes."""
+    return "x" * max(size, 0)
+
+
+def ld_credential(
+    subject_width: int = 4, context_count: int = 1, attachment_size: int = 0
+) -> Dict[str, Any]:
+    """Return an LD proof credential detail."""
+    subject: Dict[str, Any] = {"type": ["Example"]}
+    subject.update(
+        {f"attribute{index}": f"value {index}" for index in range(subject_width)}
+    )
+    credential = {
+        "@context": [BASE_CONTEXT]
+        + [
+            f"https://example.com/contexts/{index}/v1" for index in range(context_count)
+        ],
+        "type": ["VerifiableCredential", "Example"],
+        "issuer": "did:key:z6MkiTBz1ymuepAQ4HEHYSF1H8quG5GLVVQR3djdX3mDooWp",
+        "issuanceDate": "2024-01-01T00:00:00Z",
+        "credentialSubject": subject,
+    }
+    detail = {
+        "credential": credential,
+        "options": {"proofType": "Ed25519Signature2018"},
+    }
+    if attachment_size:
+        size = len(str(detail))
+        credential["description"] = padding(attachment_size - size)
+    return detail
+
+
+def base64_attachment(
+    attach_id: str, size: int, rng: random.Random = _rng
+) -> Dict[str, Any]:
+    """Return an attachment of size bytes of base64 data drawn from rng."""
+    raw = rng.randbytes(size * 3 // 4) if size else b"{}"
+    return {
+        "@id": attach_id,
+        "mime-type": "application/json",
+        "data": {"base64": base64.b64encode(raw).decode()},
+    }
+
+
+def json_attachment(attach_id: str, value: Dict[str, Any]) -> Dict[str, Any]:
+    """Return an attachment of JSON data."""
+    return {"@id": attach_id, "mime-type": "application/json", "data": {"json": value}}
+
+
+def cred_ex_v2(
+    state: str,
+    *,
+    ld_proof: bool = True,
+    attachment_size: int = 0,
+    subject_width: int = 4,
+    context_count: int = 1,
+    rng: random.Random = _rng,
+) -> Dict[str, Any]:
+    """Return an issue_credential_v2_0 webhook payload."""
+    fmt = LD_PROOF_FORMAT if ld_proof else INDY_OFFER_FORMAT
+    key = "ld_proof" if ld_proof else "indy"
+    if ld_proof:
+        detail = ld_credential(subject_width, context_count, attachment_size)
+        attachment = json_attachment(key, detail)
+    else:
+        detail = {"schema_id": "schema", "cred_def_id": "cred_def"}
+        attachment = base64_attachment(key, attachment_size, rng)
+
+    return {
+        "cred_ex_id": uid(rng),
+        "connection_id": uid(rng),
+        "thread_id": uid(rng),
+        "role": "holder",
+        "initiator": "external",
+        "state": state,
+        "auto_offer": False,
+        "auto_issue": False,
+        "auto_remove": True,
+        "trace": False,
+        "created_at": timestamp(),
+        "updated_at": timestamp(),
+        "cred_offer": {
+            "@id": uid(rng),
+            "@type": "https://didcomm.org/issue-credential/2.0/offer-credential",
+            "formats": [{"attach_id": key, "format": fmt}],
+            "offers~attach": [attachment],
+        },
+        "by_format": {"cred_offer": {key: detail}},
+    }
+
+
+def cred_ex_v1(
+    state: str, *, attachment_size: int = 0, rng: random.Random = _rng, **_
+) -> Dict[str, Any]:
+    """Return an issue_credential webhook payload."""
+    return {
+        "credential_exchange_id": uid(rng),
+        "connection_id": uid(rng),
+        "thread_id": uid(rng),
+        "role": "holder",
+        "initiator": "external",
+        "state": state,
+        "auto_offer": False,
+        "auto_issue": False,
+        "auto_remove": True,
+        "trace": False,
+        "created_at": timestamp(),
+        "updated_at": timestamp(),
+        "credential_offer_dict": {
+            "@id": uid(rng),
+            "@type": "https://didcomm.org/issue-credential/1.0/offer-credential",
+            "offers~attach": [
+                base64_attachment("libindy-cred-offer-0", attachment_size, rng)
+            ],
+        },
+    }
+
+
+def pres_ex_v2(
+    state: str,
+    *,
+    attachment_size: int = 0,
+    subject_width: int = 4,
+    rng: random.Random = _rng,
+    **_,
+) -> Dict[str, Any]:
+    """Return a present_proof_v2_0 webhook payload."""
+    definition = {
+        "id": uid(rng),
+        "input_descriptors": [
+            {
+                "id": "input_1",
+                "schema": [
+                    {"uri": "https://www.w3.org/2018/credentials#VerifiableCredential"}
+                ],
+                "constraints": {
+                    "fields": [
+                        {"path": [f"$.credentialSubject.attribute{index}"]}
+                        for index in range(subject_width)
+                    ]
+                },
+            }
+        ],
+    }
+    request: Dict[str, Any] = {
+        "options": {"challenge": uid(rng), "domain": "example"},
+        "presentation_definition": definition,
+    }
+    if attachment_size:
+        request["padding"] = padding(attachment_size - len(str(request)))
+    return {
+        "pres_ex_id": uid(rng),
+        "connection_id": uid(rng),
+        "thread_id": uid(rng),
+        "role": "prover",
+        "initiator": "external",
+        "state": state,
+        "auto_present": False,
+        "auto_remove": True,
+        "trace": False,
+        "created_at": timestamp(),
+        "updated_at": timestamp(),
+        "pres_request": {
+            "@id": uid(rng),
+            "@type": "https://didcomm.org/present-proof/2.0/request-presentation",
+            "formats": [{"attach_id": "dif", "format": DIF_REQUEST_FORMAT}],
+            "request_presentations~attach": [json_attachment("dif", request)],
+        },
+    }
+
+
+def conn_record(state: str, *, rng: random.Random = _rng, **_) -> Dict[str, Any]:
+    """Return a connections webhook payload."""
+    return {
+        "connection_id": uid(rng),
+        "state": state,
+        "rfc23_state": state,
+        "their_label": "Synthetic",
+        "their_role": "inviter",
+        "connection_protocol": "didexchange/1.0",
+        "invitation_mode": "once",
+        "accept": "manual",
+        "routing_state": "none",
+        "created_at": timestamp(),
+        "updated_at": timestamp(),
+    }
+
+
+GENERATORS: Dict[str, Tuple[Callable[..., Dict[str, Any]], Type[BaseModel]]] = {
+    "issue_credential_v2_0": (cred_ex_v2, V20CredExRecord),
+    "issue_credential": (cred_ex_v1, V10CredentialExchange),
+    "present_proof_v2_0": (pres_ex_v2, V20PresExRecord),
+    "connections": (conn_record, ConnRecord),
+}
+
+
+def generate(
+    topic: str,
+    count: int,
+    *,
+    states: Optional[Mapping[str, float]] = None,
+    validate: bool = False,
+    seed: Optional[int] = None,
+    **options: Any,
+) -> Iterator[Dict[str, Any]]:
+    """Generate count payloads for topic with states drawn from states.
+
+    options are passed to the topic's generator, e.g. attachment_size,
+    subject_width, context_count or ld_proof. With validate, each payload is
+    parsed with its model first. With seed, the states, ids and attachments of
+    the payloads are the same on every run.
+    """
+    if topic not in GENERATORS:
+        raise ValueError(f"No generator for topic {topic}")
+    generator, model = GENERATORS[topic]
+    states = states or DEFAULT_STATES[topic]
+    rng = random.Random(seed)
+    names = list(states)
+    weights = [states[name] for name in names]
+    for _ in range(count):
+        payload = generator(rng.choices(names, weights)[0], rng=rng, **options)
+        if validate:
+            model.parse_obj(payload)
+        yield payload
+
+
+def parse_states(value: str) -> Dict[str, float]:
+    """Parse a state distribution such as `offer-received=3,done=1`."""
+    states = {}
+    for entry in value.split(","):
+        state, _, weight = entry.partition("=")
+        states[state.strip()] = float(weight or 1)
+    return states
@@ -0,0 +1,142 @@
+"""Per-exchange timelines of observed states and actions taken.
+
+The time each exchange spends between the states the controller sees and the
+actions it takes is recorded in a bounded, in-memory timeline. The latency
+between consecutive entries is exported as a histogram, and the slowest recent
+exchanges can be inspected.
+"""
+
+from collections import OrderedDict
+from os import getenv
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .metrics import Histogram
+
+TIMELINE_SIZE = int(getenv("TIMELINE_SIZE", "1000"))
+TIMELINE_MAX_ENTRIES = int(getenv("TIMELINE_MAX_ENTRIES", "32"))
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+exchange_stage_seconds = Histogram(
+    "controller_exchange_stage_seconds",
+    "Time between consecutive states and actions of an exchange",
+    buckets=STAGE_BUCKETS,
+)
+exchange_seconds = Histogram(
+    "controller_exchange_seconds",
+    "Time from the first state seen to the final action of an exchange",
+    buckets=STAGE_BUCKETS,
+)
+
+
+class TimelineEntry(BaseModel):
+    """State seen or action taken at a point in time."""
+
+    name: str
+    at: float
+
+
+class ExchangeTimeline(BaseModel):
+    """Timeline of one exchange."""
+
+    exchange_id: str
+    topic: str
+    duration: float
+    entries: List[TimelineEntry]
+
+
+class Timelines:
+    """Bounded collection of exchange timelines, oldest evicted first."""
+
+    def __init__(
+        self, max_size: int = TIMELINE_SIZE, max_entries: int = TIMELINE_MAX_ENTRIES
+    ):
+        """Initialize the collection."""
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._timelines: "OrderedDict[str, Tuple[str, List[Tuple[str, float]]]]" = (
+            OrderedDict()
+        )
+
+    def state(self, topic: str, exchange_id: Optional[str], state: Optional[str]):
+        """Record that exchange_id was seen in state."""
+        if exchange_id and state:
+            self._record(topic, exchange_id, state)
+
+    def action(
+        self, topic: str, exchange_id: Optional[str], action: str, final: bool = False
+    ):
+        """Record that action was completed for exchange_id.
+
+        The final action of an exchange also records the exchange's total time.
+        """
+        if exchange_id:
+            entries = self._record(topic, exchange_id, f"action:{action}")
+            if final:
+                exchange_seconds.observe(entries[-1][1] - entries[0][1], topic=topic)
+
+    def _record(
+        self, topic: str, exchange_id: str, name: str
+    ) -> List[Tuple[str, float]]:
+        now = time()
+        if exchange_id in self._timelines:
+            _, entries = self._timelines[exchange_id]
+            self._timelines.move_to_end(exchange_id)
+        else:
+            entries = []
+            self._timelines[exchange_id] = (topic, entries)
+            while len(self._timelines) > self.max_size:
+                self._timelines.popitem(last=False)
+
+        if entries:
+            previous, previous_at = entries[-1]
+            exchange_stage_seconds.observe(
+                now - previous_at, topic=topic, start=previous, end=name
+            )
+        if len(entries) < self.max_entries:
+            entries.append((name, now))
+        else:
+            entries[-1] = (name, now)
+        return entries
+
+    def get(self, exchange_id: str) -> Optional[ExchangeTimeline]:
+        """Return the timeline of exchange_id."""
+        if exchange_id not in self._timelines:
+            return None
+        topic, entries = self._timelines[exchange_id]
+        return self._timeline(exchange_id, topic, entries)
+
+    def slowest(
+        self, limit: int = 20, min_duration: float = 0
+    ) -> List[ExchangeTimeline]:
+        """Return the slowest recent exchanges, slowest first."""
+        durations: Dict[str, float] = {
+            exchange_id: entries[-1][1] - entries[0][1]
+            for exchange_id, (_, entries) in self._timelines.items()
+        }
+        slowest = sorted(
+            (item for item in durations.items() if item[1] >= min_duration),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:limit]
+        return [
+            self._timeline(exchange_id, *self._timelines[exchange_id])
+            for exchange_id, _ in slowest
+        ]
+
+    @staticmethod
+    def _timeline(
+        exchange_id: str, topic: str, entries: List[Tuple[str, float]]
+    ) -> ExchangeTimeline:
+        return ExchangeTimeline(
+            exchange_id=exchange_id,
+            topic=topic,
+            duration=entries[-1][1] - entries[0][1],
+            entries=[TimelineEntry(name=name, at=at) for name, at in entries],
+        )
+
+
+timelines = Timelines()
@@ -0,0 +1,36 @@
+"""Parsing of ACA-Py record timestamps."""
+
+from datetime import datetime, timezone
+import re
+from typing import Optional
+
+TIMESTAMP = re.compile(
+    r"^(\d{4}-\d\d-\d\d)[T ](\d\d:\d\d(?::\d\d)?)(?:\.(\d{1,6}))?(Z|[+-]\d\d:?\d\d)?$"
+)
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[float]:
+    """Return an ACA-Py timestamp, e.g. `2021-12-31 23:59:59.123456Z`, in epoch seconds.
+
+    Returns None if value is missing or malformed.
+    """
+    if not value:
+        return None
+    match = TIMESTAMP.match(value.strip())
+    if not match:
+        return None
+
+    date, time, fraction, offset = match.groups()
+    if len(time) == 5:
+        time += ":00"
+    if not offset or offset == "Z":
+        offset = "+00:00"
+    elif ":" not in offset:
+        offset = f"{offset[:3]}:{offset[3:]}"
+    try:
+        parsed = datetime.fromisoformat(
+            f"{date}T{time}.{(fraction or '').ljust(6, '0')}{offset}"
+        )
+    except ValueError:
+        return None
+    return parsed.astimezone(timezone.utc).timestamp()
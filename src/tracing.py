@@ -0,0 +1,194 @@
+"""Optional OpenTelemetry tracing of webhooks and admin API calls.
+
+Tracing is enabled by setting `TRACING` to `otlp`, to export spans with the
+OTLP/HTTP exporter (configured with the standard `OTEL_EXPORTER_OTLP_*`
+variables), or to `file`, to append spans as JSON lines to `TRACING_FILE`.
+It requires the `opentelemetry-sdk` package, and `opentelemetry-exporter-otlp-proto-http`
+for `otlp`; without them, or with `TRACING` unset, tracing does nothing.
+"""
+
+from contextlib import contextmanager
+import json
+from os import getenv
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterator, MutableMapping, Sequence
+
+from .events import exchange_id
+from .filtering import (
+    TOPIC_PREFIX,
+    ASGIApp,
+    Receive,
+    Scope,
+    Send,
+    read_body,
+    replay_body,
+)
+from .timestamps import parse_timestamp
+
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+    from opentelemetry.sdk.trace.export import (
+        BatchSpanProcessor,
+        SpanExporter,
+        SpanExportResult,
+    )
+except ImportError:
+    trace = None
+
+TRACING = getenv("TRACING", "")
+TRACING_FILE = getenv("TRACING_FILE", "traces.jsonl")
+SERVICE_NAME = getenv("OTEL_SERVICE_NAME", "acapy-json-ld-receiver")
+
+tracer = None
+
+if trace:
+
+    class FileSpanExporter(SpanExporter):
+        """Export spans as JSON lines to a local file."""
+
+        def __init__(self, path: str):
+            """Initialize the exporter."""
+            self.path = path
+            self.lock = Lock()
+
+        def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+            """Append spans to the file."""
+            lines = "".join(
+                json.dumps(json.loads(span.to_json())) + "\n" for span in spans
+            )
+            with self.lock, open(self.path, "a") as file:
+                file.write(lines)
+            return SpanExportResult.SUCCESS
+
+        def shutdown(self):
+            """Nothing to shut down."""
+
+
+def setup_tracing():
+    """Configure the tracer from the environment."""
+    global tracer
+    if not TRACING:
+        return
+    if not trace:
+        print("TRACING is set but opentelemetry-sdk is not installed; not tracing")
+        return
+
+    if TRACING == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+        except ImportError:
+            print(
+                "opentelemetry-exporter-otlp-proto-http is not installed; not tracing"
+            )
+            return
+        exporter = OTLPSpanExporter()
+    elif TRACING == "file":
+        exporter = FileSpanExporter(TRACING_FILE)
+    else:
+        raise ValueError(f"Unknown TRACING exporter: {TRACING}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    tracer = trace.get_tracer(__name__)
+
+
+def shutdown_tracing():
+    """Flush outstanding spans."""
+    if tracer and trace:
+        provider = trace.get_tracer_provider()
+        shutdown = getattr(provider, "shutdown", None)
+        if shutdown:
+            shutdown()
+
+
+@contextmanager
+def admin_span(
+    method: str, url: str, headers: MutableMapping[str, str]
+) -> Iterator[None]:
+    """Trace an admin API call, injecting the trace context into headers."""
+    if not tracer or not trace:
+        yield
+        return
+
+    with tracer.start_as_current_span(
+        f"admin {method.upper()}",
+        kind=trace.SpanKind.CLIENT,
+        attributes={"http.method": method.upper(), "http.url": url},
+    ):
+        propagate.inject(headers)
+        yield
+
+
+def webhook_attributes(
+    topic: str, headers: Dict[str, str], body: bytes
+) -> Dict[str, Any]:
+    """Return span attributes describing a webhook."""
+    attributes: Dict[str, Any] = {"webhook.topic": topic, "webhook.size": len(body)}
+    if "x-wallet-id" in headers:
+        attributes["webhook.wallet_id"] = headers["x-wallet-id"]
+    try:
+        record = json.loads(body)
+    except ValueError:
+        return attributes
+    if not isinstance(record, dict):
+        return attributes
+
+    if isinstance(record.get("state"), str):
+        attributes["webhook.state"] = record["state"]
+    exchange = exchange_id(record)
+    if exchange:
+        attributes["webhook.exchange_id"] = exchange
+    updated_at = parse_timestamp(record.get("updated_at"))
+    if updated_at:
+        # Time between ACA-Py updating the record and the webhook arriving
+        attributes["webhook.age"] = max(0.0, time() - updated_at)
+    return attributes
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing each webhook request in its own span."""
+
+    def __init__(self, app: ASGIApp):
+        """Wrap app."""
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle a request."""
+        if (
+            not tracer
+            or not trace
+            or scope["type"] != "http"
+            or not scope["path"].startswith(TOPIC_PREFIX)
+        ):
+            return await self.app(scope, receive, send)
+
+        topic = scope["path"][len(TOPIC_PREFIX) :].strip("/")
+        headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in scope["headers"]
+        }
+        body = await read_body(receive)
+        attributes = webhook_attributes(topic, headers, body)
+
+        status: Dict[str, int] = {}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        with tracer.start_as_current_span(
+            f"webhook {topic}",
+            context=propagate.extract(headers),
+            kind=trace.SpanKind.SERVER,
+            attributes=attributes,
+        ) as span:
+            await self.app(scope, replay_body(body, receive), _send)
+            if "code" in status:
+                span.set_attribute("http.status_code", status["code"])
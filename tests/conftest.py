@@ -0,0 +1,7 @@
+"""Configuration shared by the tests."""
+
+import os
+
+# Keep the controller's databases out of the working directory
+os.environ.setdefault("DEAD_LETTER_DB", ":memory:")
+os.environ.setdefault("EXCHANGE_DB", ":memory:")
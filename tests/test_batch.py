@@ -0,0 +1,68 @@
+"""Tests for parsing batches of webhook events."""
+
+import json
+
+import pytest
+
+from src.batch import BatchTooLarge, parse_batch
+from src.events import Event
+
+ENTRY = {"topic": "connections", "payload": {"connection_id": "c", "state": "active"}}
+
+
+def test_json_array():
+    parsed = parse_batch(json.dumps([ENTRY, dict(ENTRY, wallet_id="w")]).encode())
+    assert all(isinstance(entry, Event) for entry in parsed)
+    assert [entry.wallet_id for entry in parsed] == [None, "w"]
+    assert parsed[0].exchange_id == "c"
+
+
+def test_ndjson_skips_blank_lines():
+    body = b"\n".join([json.dumps(ENTRY).encode(), b"", json.dumps(ENTRY).encode()])
+    assert len(parse_batch(body)) == 2
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        "not an object",
+        {"payload": {}},
+        {"topic": "", "payload": {}},
+        {"topic": "connections"},
+        {"topic": "connections", "wallet_id": 1, "payload": {}},
+    ],
+)
+def test_malformed_entry_is_an_error(entry):
+    parsed = parse_batch(json.dumps([ENTRY, entry]).encode())
+    assert isinstance(parsed[0], Event)
+    assert isinstance(parsed[1], ValueError)
+
+
+def test_malformed_ndjson_line_is_an_error():
+    parsed = parse_batch(json.dumps(ENTRY).encode() + b"\n{not json\n")
+    assert isinstance(parsed[0], Event)
+    assert isinstance(parsed[1], ValueError)
+
+
+def test_validation_errors_per_entry():
+    def validate(event: Event):
+        if event.topic != "connections":
+            raise ValueError("invalid")
+
+    parsed = parse_batch(
+        json.dumps([ENTRY, dict(ENTRY, topic="other")]).encode(), validate
+    )
+    assert isinstance(parsed[0], Event)
+    assert str(parsed[1]) == "invalid"
+
+
+def test_not_a_batch():
+    with pytest.raises(ValueError):
+        parse_batch(b"[not json")
+
+
+def test_too_large():
+    with pytest.raises(BatchTooLarge):
+        parse_batch(json.dumps([ENTRY] * 3).encode(), max_items=2)
+    with pytest.raises(BatchTooLarge):
+        parse_batch(b"\n".join([json.dumps(ENTRY).encode()] * 3), max_items=2)
@@ -0,0 +1,88 @@
+"""Tests for partitioning exchanges across replicas."""
+
+import asyncio
+from collections import Counter
+import json
+import socket
+from typing import Optional
+
+import pytest
+
+from src.cluster import Cluster, HashRing, parse_peers
+from src.events import Event
+
+NODES = ["http://a", "http://b", "http://c"]
+KEYS = [f"wallet/exchange-{index}" for index in range(3000)]
+
+
+def event(exchange_id: Optional[str], wallet_id: Optional[str] = None) -> Event:
+    body = {"cred_ex_id": exchange_id, "state": "offer-received"}
+    return Event.from_raw("issue_credential_v2_0", json.dumps(body).encode(), wallet_id)
+
+
+def test_parse_peers():
+    assert parse_peers(" http://a/, ,http://b") == ["http://a", "http://b"]
+
+
+def test_ring_spreads_keys():
+    ring = HashRing(NODES)
+    owners = Counter(ring.owner(key) for key in KEYS)
+    assert set(owners) == set(NODES)
+    assert min(owners.values()) > len(KEYS) / len(NODES) / 2
+    assert HashRing([]).owner("key") is None
+
+
+def test_ring_moves_only_keys_of_leaving_node():
+    before = HashRing(NODES)
+    after = HashRing(NODES[:2])
+    moved = [key for key in KEYS if before.owner(key) != after.owner(key)]
+    assert moved
+    assert all(before.owner(key) == "http://c" for key in moved)
+    # Rebuilding the ring assigns keys the same way
+    rebuilt = HashRing(NODES)
+    assert all(rebuilt.owner(key) == before.owner(key) for key in KEYS)
+
+
+def test_owner():
+    single = Cluster("http://a")
+    assert not single.enabled
+    assert single.owner(event("x")) is None
+
+    cluster = Cluster("http://a", NODES)
+    assert cluster.enabled
+    assert cluster.owner(event(None)) is None
+    owners = {cluster.owner(event("x", wallet)) for wallet in map(str, range(50))}
+    assert owners == set(NODES)
+
+
+def test_members_keep_self():
+    cluster = Cluster("http://a", NODES)
+    cluster.set_members(["http://b"])
+    assert cluster.members == ["http://a", "http://b"]
+    cluster.set_members([])
+    assert cluster.members == ["http://a"]
+
+
+def test_unreachable_owner_leaves_ring():
+    aiohttp = pytest.importorskip("aiohttp")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        down = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    cluster = Cluster("http://a", ["http://a", down])
+    owned = next(
+        event(f"x{index}")
+        for index in range(100)
+        if cluster.owner(event(f"x{index}")) == down
+    )
+
+    async def run() -> bool:
+        cluster._session = aiohttp.ClientSession()
+        try:
+            return await cluster.route(owned)
+        finally:
+            await cluster._session.close()
+
+    # Handled locally rather than lost
+    assert not asyncio.run(run())
+    assert cluster.members == ["http://a"]
+    assert cluster.owner(owned) == "http://a"
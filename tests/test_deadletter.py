@@ -0,0 +1,102 @@
+"""Tests for keeping and replaying events whose handler failed."""
+
+import asyncio
+import json
+from typing import List
+
+from src.deadletter import DeadLetterFilter, DeadLetterStore, replay
+from src.dispatch import Dispatcher
+from src.events import Event
+
+TOPIC = "issue_credential_v2_0"
+
+
+def event(exchange_id: str, state: str = "credential-received") -> Event:
+    body = {"cred_ex_id": exchange_id, "state": state}
+    return Event.from_raw(TOPIC, json.dumps(body).encode(), "wallet")
+
+
+def test_store_is_bounded_and_filtered():
+    async def run():
+        store = DeadLetterStore(":memory:", max_size=2)
+        for exchange_id in ("a", "b", "c"):
+            await store.add(event(exchange_id), ValueError(f"store {exchange_id}"))
+        assert len(store) == 2
+
+        letters = await store.list(DeadLetterFilter())
+        assert [letter.exchange_id for letter in letters.results] == ["b", "c"]
+        assert letters.results[0].error == "ValueError: store b"
+        assert letters.results[0].payload["cred_ex_id"] == "b"
+
+        matched = await store.list(DeadLetterFilter(error="store c"))
+        assert [letter.exchange_id for letter in matched.results] == ["c"]
+        stored = await store.get(matched.results[0].id)
+        assert stored.event.wallet_id == "wallet"
+        assert await store.remove(stored.letter.id)
+        assert not await store.remove(stored.letter.id)
+        assert len(store) == 1
+
+    asyncio.run(run())
+
+
+def test_replay_submits_letters():
+    submitted: List[str] = []
+
+    async def submit(event: Event) -> str:
+        if event.exchange_id == "refused":
+            raise ValueError("refused")
+        submitted.append(event.exchange_id)
+        return "queued"
+
+    async def run():
+        store = DeadLetterStore(":memory:")
+        for exchange_id in ("a", "refused"):
+            await store.add(event(exchange_id), ValueError("failed"))
+        letters = await store.select(DeadLetterFilter(), 10)
+        result = await replay(store, letters, submit)
+        assert (result.replayed, result.failed) == (1, 1)
+        assert [item.status for item in result.results] == ["queued", "failed"]
+
+        (kept,) = (await store.list(DeadLetterFilter())).results
+        assert kept.exchange_id == "refused"
+        assert kept.attempts == 2
+        assert kept.error == "ValueError: refused"
+
+    asyncio.run(run())
+    assert submitted == ["a"]
+
+
+def test_failed_event_is_kept_and_handled_again():
+    async def run():
+        store = DeadLetterStore(":memory:")
+        dispatcher = Dispatcher(workers=1)
+        attempts: List[str] = []
+
+        @dispatcher.handler(TOPIC)
+        async def _handle(record):
+            attempts.append(record["cred_ex_id"])
+            if len(attempts) == 1:
+                raise ValueError("agent unavailable")
+
+        @dispatcher.failure_handler
+        async def _failed(event: Event, error: Exception):
+            await store.add(event, error)
+
+        dispatcher.start()
+        await dispatcher.submit(event("a"))
+        await dispatcher.stop()
+        assert len(store) == 1
+
+        dispatcher.start()
+        letters = await store.select(DeadLetterFilter(), 10)
+
+        async def submit(event: Event) -> str:
+            return "queued" if await dispatcher.submit(event) else "duplicate"
+
+        result = await replay(store, letters, submit)
+        await dispatcher.stop()
+        assert [item.status for item in result.results] == ["queued"]
+        assert len(store) == 0
+        return attempts
+
+    assert asyncio.run(run()) == ["a", "a"]
@@ -0,0 +1,191 @@
+"""Tests for queueing, deduplication and coalescing of events."""
+
+import asyncio
+import json
+from typing import List, Optional, Tuple
+
+import pytest
+
+from src.dispatch import Dedupe, Dispatcher, Draining, current_wallet, superseded
+from src.events import Event
+
+TOPIC = "issue_credential_v2_0"
+T1 = "2024-01-01 00:00:01.000000Z"
+T2 = "2024-01-01 00:00:02.000000Z"
+
+
+def event(
+    exchange_id: Optional[str] = "x",
+    state: Optional[str] = "offer-received",
+    updated_at: Optional[str] = T1,
+    wallet_id: Optional[str] = None,
+) -> Event:
+    body = {"cred_ex_id": exchange_id, "state": state, "updated_at": updated_at}
+    return Event.from_raw(TOPIC, json.dumps(body).encode(), wallet_id)
+
+
+@pytest.mark.parametrize(
+    "older, newer, actionable, expected",
+    [
+        # Same state and time, e.g. a retry with a new body
+        (event(), event(), True, True),
+        (event(), event(state="request-sent", updated_at=T2), True, True),
+        (event(), event(state="request-sent", updated_at=T1), True, False),
+        (event(state="done"), event(state="deleted", updated_at=T1), False, True),
+        (
+            event(updated_at=T2),
+            event(state="request-sent", updated_at=T1),
+            False,
+            False,
+        ),
+        # Without timestamps only inert events are superseded
+        (event(updated_at=None), event(state="done", updated_at=None), True, False),
+        (event(updated_at=None), event(state="done", updated_at=None), False, True),
+    ],
+)
+def test_superseded(older, newer, actionable, expected):
+    assert superseded(older, newer, actionable) is expected
+
+
+def test_dedupe():
+    dedupe = Dedupe(max_size=2)
+    first = event("a")
+    assert not dedupe.seen(first)
+    assert dedupe.seen(event("a"))
+    assert not dedupe.seen(event("a", updated_at=T2))
+    assert not dedupe.seen(event("a", wallet_id="w"))
+    # The oldest is forgotten beyond max_size
+    assert len(dedupe) == 2
+    assert not dedupe.seen(first)
+
+
+def test_dedupe_ignores_events_without_key():
+    dedupe = Dedupe()
+    assert not dedupe.seen(event(exchange_id=None))
+    assert not dedupe.seen(event(exchange_id=None))
+    assert not dedupe.seen(event(state=None))
+    assert not dedupe.seen(event(state=None))
+
+
+def test_dedupe_forget():
+    dedupe = Dedupe()
+    dedupe.seen(event())
+    dedupe.forget(event())
+    assert not dedupe.seen(event())
+
+
+def test_check():
+    dispatcher = Dispatcher()
+    dispatcher.handler(TOPIC, actions=("offer-received",))(lambda _: None)
+    dispatcher.check(event())
+    dispatcher.check(event(exchange_id=None, state="done"))
+    with pytest.raises(ValueError):
+        dispatcher.check(event(exchange_id=None))
+    with pytest.raises(ValueError):
+        dispatcher.check(Event.from_raw(TOPIC, b"[1]"))
+
+
+def test_coalesce_queued_events():
+    async def run() -> List[Tuple[str, str]]:
+        dispatcher = Dispatcher(workers=1)
+        handled: List[Tuple[str, str]] = []
+        gate = asyncio.Event()
+
+        @dispatcher.handler(TOPIC, actions=("offer-received", "credential-received"))
+        async def _handle(record):
+            if record["cred_ex_id"] == "block":
+                await gate.wait()
+            handled.append((record["cred_ex_id"], record["state"]))
+
+        dispatcher.start()
+        await dispatcher.submit(event("block"))
+        await asyncio.sleep(0)
+        # Superseded once the exchange has moved on
+        await dispatcher.submit(event("a"))
+        await dispatcher.submit(event("a", "request-sent", T2))
+        # Not superseded without knowing the newer event is later
+        await dispatcher.submit(event("b"))
+        await dispatcher.submit(event("b", "credential-received", None))
+        # Inert events are superseded by any newer event
+        await dispatcher.submit(event("c", "done"))
+        await dispatcher.submit(event("c", "deleted"))
+        gate.set()
+        await dispatcher.join()
+        await dispatcher.stop()
+        return handled
+
+    assert asyncio.run(run()) == [
+        ("block", "offer-received"),
+        ("a", "request-sent"),
+        ("b", "offer-received"),
+        ("b", "credential-received"),
+        ("c", "deleted"),
+    ]
+
+
+def test_submit_drops_duplicates():
+    async def run() -> Tuple[bool, bool, int]:
+        dispatcher = Dispatcher()
+        handled: List[str] = []
+
+        @dispatcher.handler(TOPIC)
+        async def _handle(record):
+            handled.append(record["state"])
+
+        first = await dispatcher.submit(event())
+        second = await dispatcher.submit(event())
+        return first, second, len(handled)
+
+    assert asyncio.run(run()) == (True, False, 1)
+
+
+def test_stop_returns_unfinished_events():
+    async def run() -> Tuple[List[Optional[str]], bool]:
+        dispatcher = Dispatcher(workers=1)
+
+        @dispatcher.handler(TOPIC, actions=("offer-received",))
+        async def _handle(record):
+            if record["cred_ex_id"] == "finishes":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    # e.g. a store that had already started
+                    return
+            await asyncio.sleep(10)
+
+        dispatcher.start()
+        await dispatcher.submit(event("finishes"))
+        await dispatcher.submit(event("queued"))
+        await asyncio.sleep(0)
+        unfinished = await dispatcher.stop(timeout=0.01)
+        return [event.exchange_id for event in unfinished], dispatcher.running
+
+    assert asyncio.run(run()) == (["queued"], False)
+
+
+def test_submit_refused_while_draining():
+    async def run():
+        dispatcher = Dispatcher()
+        dispatcher.start()
+        await dispatcher.stop()
+        await dispatcher.submit(event())
+
+    with pytest.raises(Draining):
+        asyncio.run(run())
+
+
+def test_handler_sees_wallet_of_its_event():
+    async def run() -> List[Optional[str]]:
+        dispatcher = Dispatcher()
+        wallets: List[Optional[str]] = []
+
+        @dispatcher.handler(TOPIC)
+        async def _handle(record):
+            wallets.append(current_wallet())
+
+        await dispatcher.dispatch(event(wallet_id="tenant"))
+        await dispatcher.dispatch(event())
+        wallets.append(current_wallet())
+        return wallets
+
+    assert asyncio.run(run()) == ["tenant", None, None]
@@ -0,0 +1,69 @@
+"""Tests for topic and state filtering of webhooks."""
+
+import asyncio
+from typing import List
+
+import pytest
+
+from src.filtering import DEFAULT_ALLOW, TopicFilter, TopicFilterMiddleware
+
+
+def post(middleware: TopicFilterMiddleware, path: str, body: bytes) -> List[dict]:
+    """Post body to path through middleware, returning the messages sent."""
+    sent: List[dict] = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path}
+    asyncio.run(middleware(scope, receive, send))
+    return sent
+
+
+def passed_through(app_calls: List[bytes], middleware, path, body) -> bool:
+    before = len(app_calls)
+    sent = post(middleware, path, body)
+    if len(app_calls) > before:
+        assert app_calls[-1] == body
+        return True
+    assert sent[0]["status"] == 200
+    return False
+
+
+@pytest.fixture
+def app_calls():
+    return []
+
+
+@pytest.fixture
+def middleware(app_calls):
+    async def app(scope, receive, send):
+        message = await receive()
+        app_calls.append(message["body"])
+
+    return TopicFilterMiddleware(app, TopicFilter(DEFAULT_ALLOW))
+
+
+def test_filters_states_without_action(app_calls, middleware):
+    path = "/topic/issue_credential_v2_0/"
+    assert passed_through(app_calls, middleware, path, b'{"state": "offer-received"}')
+    assert not passed_through(app_calls, middleware, path, b'{"state": "done"}')
+    assert not passed_through(
+        app_calls, middleware, "/topic/connections", b'{"state": "active"}'
+    )
+
+
+@pytest.mark.parametrize(
+    "body", [b'["offer-received"]', b'"offer-received"', b"not json", b""]
+)
+def test_body_not_an_object_reaches_route(app_calls, middleware, body):
+    # The route rejects these with 422 rather than the filter answering 200
+    assert passed_through(app_calls, middleware, "/topic/connections", body)
+
+
+def test_malformed_object_reaches_route(app_calls, middleware):
+    body = b'{"state": "offer-received",'
+    assert passed_through(app_calls, middleware, "/topic/issue_credential_v2_0", body)
@@ -0,0 +1,129 @@
+"""Tests for credential offer format detection."""
+
+import asyncio
+import json
+from typing import Any, List, Optional, Tuple
+
+import pytest
+
+import src
+from src.formats import (
+    INDY,
+    LD_PROOF,
+    ConnectionFormats,
+    V20CredExWebhook,
+    offer_format,
+)
+from src.models import V20CredExRecord
+from src.records import cred_ex_v2_records
+from src.synthetic import cred_ex_v2
+
+LD_OFFER = {
+    "formats": [{"attach_id": "a", "format": "aries/ld-proof-vc-detail@v1.0"}],
+    "offers~attach": [],
+}
+
+
+def record(**fields) -> V20CredExRecord:
+    return V20CredExRecord.parse_obj(
+        {"cred_ex_id": "x", "connection_id": "c", "state": "offer-received", **fields}
+    )
+
+
+def test_offer_format():
+    assert offer_format(record(cred_offer=LD_OFFER)) == LD_PROOF
+    assert offer_format(record(by_format={"cred_offer": {"indy": {}}})) == INDY
+    assert offer_format(record()) is None
+
+
+def test_full_webhook_parsed_without_attachments():
+    body = json.dumps(cred_ex_v2("offer-received", attachment_size=1024))
+    webhook = V20CredExWebhook.parse_raw(body)
+    assert offer_format(webhook) == LD_PROOF
+    assert not hasattr(webhook.cred_offer, "offers_attach")
+    assert webhook.cred_ex_id == json.loads(body)["cred_ex_id"]
+
+
+def test_guess_by_connection():
+    formats = ConnectionFormats()
+    assert formats.guess("c") is None
+    formats.learn("c", INDY)
+    assert formats.guess("c") == INDY
+    formats.learn("c", LD_PROOF)
+    assert formats.guess("c") is None
+    formats.learn("d", INDY)
+    formats.forget("d")
+    assert formats.guess("d") is None
+    assert not ConnectionFormats(enabled=False).guess("d")
+
+
+class FakeAdmin:
+    """Admin API answering offer requests and record retrievals."""
+
+    def __init__(self, offer: dict, state: str, fail_requests: int):
+        self.offer = offer
+        self.state = state
+        self.fail_requests = fail_requests
+        self.calls: List[Tuple[str, str, Any]] = []
+
+    def __call__(self, base_url: str):
+        return self
+
+    async def get(self, url: str, response: Any = None, **kwargs):
+        self.calls.append(("get", url, None))
+        return response.parse_obj(
+            {"cred_ex_record": record(state=self.state, cred_offer=self.offer).dict()}
+        )
+
+    async def post(self, url: str, json: Optional[dict] = None, **kwargs):
+        self.calls.append(("post", url, json))
+        if self.fail_requests:
+            self.fail_requests -= 1
+            raise Exception("400: wrong format")
+        return {}
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    def install(offer: dict, state: str = "offer-received", fail_requests: int = 0):
+        fake = FakeAdmin(offer, state, fail_requests)
+        monkeypatch.setattr(src, "AdminController", fake)
+        monkeypatch.setattr(src, "connection_formats", ConnectionFormats())
+        cred_ex_v2_records.evict("x")
+        return fake
+
+    return install
+
+
+def test_slim_offers_fetched_once_per_connection(admin):
+    fake = admin(LD_OFFER)
+    asyncio.run(src.request_credential_v2(record()))
+    asyncio.run(src.request_credential_v2(record(cred_ex_id="y")))
+    assert [method for method, _, _ in fake.calls] == ["get", "post", "post"]
+    assert fake.calls[2] == (
+        "post",
+        "/issue-credential-2.0/records/y/send-request",
+        {"holder_did": src.did},
+    )
+
+
+def test_wrong_guess_retried_with_fetched_offer(admin):
+    indy_offer = {
+        "formats": [{"attach_id": "a", "format": "hlindy/cred-abstract@v2.0"}],
+        "offers~attach": [],
+    }
+    fake = admin(indy_offer)
+    src.connection_formats.learn("c", LD_PROOF)
+    fake.fail_requests = 1
+    asyncio.run(src.request_credential_v2(record()))
+    assert [method for method, _, _ in fake.calls] == ["post", "get", "post"]
+    assert fake.calls[2][2] == {}
+    assert src.connection_formats.guess("c") is None
+
+
+def test_wrong_guess_not_retried_once_exchange_moved_on(admin):
+    fake = admin(LD_OFFER, state="abandoned", fail_requests=1)
+    src.connection_formats.learn("c", INDY)
+    with pytest.raises(ValueError):
+        asyncio.run(src.request_credential_v2(record()))
+    assert [method for method, _, _ in fake.calls] == ["post", "get"]
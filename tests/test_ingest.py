@@ -0,0 +1,143 @@
+"""Tests for ingesting events over the agent's admin WebSocket."""
+
+import asyncio
+import json
+from typing import Any, List
+
+import pytest
+
+import src
+from src.dispatch import Draining
+from src.events import Event
+from src.filtering import TopicFilter
+from src.ingest import AdminEventStream, reconcile, websocket_url
+from src.models import V20CredExRecord
+
+
+def test_websocket_url():
+    assert websocket_url("http://agent:3001/") == "ws://agent:3001/ws"
+    assert websocket_url("https://agent") == "wss://agent/ws"
+
+
+@pytest.fixture
+def received() -> List[Event]:
+    return []
+
+
+@pytest.fixture
+def stream(received) -> AdminEventStream:
+    async def on_event(event: Event):
+        if event.topic == "fails":
+            raise RuntimeError("handler failed")
+        received.append(event)
+
+    async def on_connect():
+        pass
+
+    return AdminEventStream("ws://agent/ws", on_event, on_connect)
+
+
+def receive(stream: AdminEventStream, *messages: Any):
+    async def run():
+        for message in messages:
+            data = message if isinstance(message, str) else json.dumps(message)
+            await stream._receive(data)
+
+    asyncio.run(run())
+
+
+def test_receive(stream, received):
+    payload = {"connection_id": "c", "state": "active"}
+    receive(
+        stream,
+        "not json",
+        {"payload": {}},
+        {"topic": "ping"},
+        # A failing event does not end the stream
+        {"topic": "fails", "payload": payload},
+        {"topic": "connections", "payload": payload, "wallet_id": "w"},
+    )
+    assert [(event.topic, event.wallet_id) for event in received] == [
+        ("connections", "w")
+    ]
+    assert received[0].exchange_id == "c"
+
+
+def test_invalid_events_rejected_like_webhooks(capsys):
+    async def on_connect():
+        pass
+
+    stream = AdminEventStream("ws://agent/ws", src.ingest_event, on_connect)
+    receive(
+        stream,
+        {"topic": "issue_credential_v2_0", "payload": {"state": "offer-received"}},
+        {"topic": "connections", "payload": ["not", "an", "object"]},
+    )
+    output = capsys.readouterr().out
+    assert "offer-received event has no exchange id" in output
+    assert "Body is not a JSON object" in output
+
+
+class FakeController:
+    """Admin API listing one ICv2 exchange and no ICv1 exchanges."""
+
+    def __init__(self):
+        self.paths: List[str] = []
+
+    async def get(self, path: str, params: Any = None, response: Any = None):
+        self.paths.append(path)
+        results = []
+        if path.startswith("/issue-credential-2.0/"):
+            record = V20CredExRecord(cred_ex_id="x", state=params["state"])
+            results = [{"cred_ex_record": record.dict()}]
+        return response.parse_obj({"results": results})
+
+
+def test_reconcile():
+    submitted: List[Event] = []
+
+    async def submit(event: Event):
+        submitted.append(event)
+
+    controller = FakeController()
+    count = asyncio.run(reconcile(controller, submit))
+    assert count == len(submitted) == 2
+    assert {event.state for event in submitted} == {
+        "offer-received",
+        "credential-received",
+    }
+    assert all(event.exchange_id == "x" for event in submitted)
+
+
+@pytest.fixture
+def published(monkeypatch) -> List[Event]:
+    """Record the events published, with only connections allowed."""
+    events: List[Event] = []
+    monkeypatch.setattr(src, "topic_filter", TopicFilter("connections"))
+    monkeypatch.setattr(src.forwarder, "listeners", [events.append])
+    return events
+
+
+def connection_event(connection_id: str, topic: str = "connections") -> Event:
+    body = {"connection_id": connection_id, "state": "active"}
+    return Event.from_raw(topic, json.dumps(body).encode())
+
+
+def test_ingest_publishes_accepted_events_once(published):
+    async def run() -> List[str]:
+        return [
+            await src.ingest_event(connection_event("once")),
+            await src.ingest_event(connection_event("once")),
+            await src.ingest_event(connection_event("other", "oob_invitation")),
+            await src.ingest_event(connection_event("peer"), forwarded=True),
+        ]
+
+    assert asyncio.run(run()) == ["queued", "duplicate", "ignored", "queued"]
+    assert [event.exchange_id for event in published] == ["once", "other"]
+
+
+def test_ingest_refused_while_draining_is_not_published(published, monkeypatch):
+    monkeypatch.setattr(src.dispatcher, "draining", True)
+    with pytest.raises(Draining):
+        asyncio.run(src.ingest_event(connection_event("refused")))
+    assert not published
@@ -0,0 +1,79 @@
+"""Tests for the adaptive concurrency limit of admin API calls."""
+
+import asyncio
+
+import pytest
+
+from src.limiter import AdaptiveLimiter
+
+
+def test_limit_grows_while_saturated():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=3)
+    limiter.update(0.01, error=False, saturated=False)
+    assert limiter.limit == 2
+    for _ in range(10):
+        limiter.update(0.01, error=False, saturated=True)
+    assert limiter.limit == 3
+
+
+def test_limit_backs_off_on_errors_and_latency():
+    limiter = AdaptiveLimiter(initial_limit=10, min_limit=2, backoff=0.5)
+    limiter.update(0.01, error=False, saturated=True)
+    limit = limiter.limit
+    limiter.update(0.1, error=False, saturated=True)
+    assert limiter.limit == limit * 0.5
+    # At most once per baseline latency
+    limiter.update(0.1, error=True, saturated=True)
+    assert limiter.limit == limit * 0.5
+    limiter._last_decrease = 0
+    limiter.update(0.01, error=True, saturated=True)
+    assert limiter.limit == limit * 0.25
+    limiter._last_decrease = 0
+    limiter.update(0.01, error=True, saturated=True)
+    assert limiter.limit == 2
+
+
+def test_baseline_follows_lowest_latency():
+    limiter = AdaptiveLimiter()
+    limiter.update(0.02, error=False, saturated=False)
+    limiter.update(0.01, error=False, saturated=False)
+    assert limiter.baseline == 0.01
+    limiter.update(0.11, error=False, saturated=False)
+    assert limiter.baseline == pytest.approx(0.011)
+    limiter.update(5, error=True, saturated=False)
+    assert limiter.baseline == pytest.approx(0.011)
+
+
+def test_slots_are_limited():
+    running = 0
+    most = 0
+
+    async def call(limiter: AdaptiveLimiter):
+        nonlocal running, most
+        async with limiter.slot():
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    async def run() -> AdaptiveLimiter:
+        limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+        await asyncio.gather(*(call(limiter) for _ in range(6)))
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert most == 2
+    assert limiter.in_flight == 0
+
+
+def test_failed_call_releases_slot():
+    async def run() -> AdaptiveLimiter:
+        limiter = AdaptiveLimiter(initial_limit=1)
+        with pytest.raises(ValueError):
+            async with limiter.slot():
+                raise ValueError("agent unavailable")
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert limiter.in_flight == 0
+    assert limiter.baseline is None
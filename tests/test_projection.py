@@ -0,0 +1,59 @@
+"""Tests for the exchange projection."""
+
+import asyncio
+import json
+
+from src.events import Event
+from src.projection import ExchangeProjection, ExchangeQuery
+
+
+def event(topic="issue_credential_v2_0", wallet_id=None, **record) -> Event:
+    return Event.from_raw(topic, json.dumps(record).encode(), wallet_id)
+
+
+def test_exchanges_keyed_by_wallet_and_topic():
+    async def run():
+        projection = ExchangeProjection(":memory:")
+        projection.publish(event(cred_ex_id="x", state="offer-received"))
+        projection.publish(event(wallet_id="w", cred_ex_id="x", state="done"))
+        projection.publish(event("present_proof_v2_0", pres_ex_id="x", state="done"))
+        page = await projection.query(ExchangeQuery())
+        in_wallet = await projection.get("x", wallet_id="w")
+        base = await projection.get("x", wallet_id="", topic="issue_credential_v2_0")
+        return page.total, in_wallet, base
+
+    total, in_wallet, base = asyncio.run(run())
+    assert total == 3
+    assert in_wallet and in_wallet.state == "done"
+    assert base and base.wallet_id is None and base.state == "offer-received"
+
+
+def test_older_record_does_not_replace_newer():
+    async def run():
+        projection = ExchangeProjection(":memory:")
+        projection.publish(
+            event(cred_ex_id="x", state="request-sent", updated_at="2024-01-02")
+        )
+        projection.publish(
+            event(cred_ex_id="x", state="offer-received", updated_at="2024-01-01")
+        )
+        await projection.flush()
+        return await projection.get("x")
+
+    exchange = asyncio.run(run())
+    assert exchange and exchange.state == "request-sent"
+
+
+def test_deleted_exchange_removed():
+    async def run():
+        projection = ExchangeProjection(":memory:")
+        projection.publish(event(cred_ex_id="x", state="offer-received"))
+        projection.publish(event(wallet_id="w", cred_ex_id="x", state="done"))
+        await projection.flush()
+        projection.publish(event(cred_ex_id="x", state="deleted"))
+        await projection.flush()
+        return await projection.get("x"), len(projection)
+
+    exchange, count = asyncio.run(run())
+    assert exchange and exchange.wallet_id == "w"
+    assert count == 1
@@ -0,0 +1,224 @@
+"""Tests for the Redis Streams queue backend, run against fakeredis."""
+
+import asyncio
+import json
+from typing import List
+
+import pytest
+
+from src.dispatch import Dispatcher
+from src.events import Event
+from src.queues import RedisStreamsBackend
+
+fakeredis = pytest.importorskip("fakeredis")
+
+STREAM = "events"
+GROUP = "controllers"
+
+
+def event(index: int) -> Event:
+    body = {"cred_ex_id": f"x{index}", "state": "offer-received"}
+    return Event.from_raw("issue_credential_v2_0", json.dumps(body).encode())
+
+
+def backend(server, consumer: str, **kwargs) -> RedisStreamsBackend:
+    return RedisStreamsBackend(
+        fakeredis.aioredis.FakeRedis(server=server),
+        stream=STREAM,
+        group=GROUP,
+        consumer=consumer,
+        block=0.01,
+        **kwargs,
+    )
+
+
+def dispatcher(queue: RedisStreamsBackend, handled: List[str], delay: float = 0):
+    dispatcher = Dispatcher(workers=2, low_workers=1, backend=queue)
+
+    @dispatcher.handler("issue_credential_v2_0", actions=("offer-received",))
+    async def _handle(record):
+        await asyncio.sleep(delay)
+        handled.append(record["cred_ex_id"])
+
+    return dispatcher
+
+
+async def pending(server) -> int:
+    client = fakeredis.aioredis.FakeRedis(server=server)
+    return (await client.xpending(STREAM, GROUP))["pending"]
+
+
+def test_read_and_ack():
+    async def run():
+        server = fakeredis.FakeServer()
+        queue = backend(server, "a")
+        await queue.start()
+        for index in range(3):
+            await queue.put(event(index))
+        deliveries = await queue.read(10)
+        before = await pending(server)
+        await queue.ack([delivery.id for delivery in deliveries])
+        return deliveries, before, await pending(server)
+
+    deliveries, before, after = asyncio.run(run())
+    assert [d.event.exchange_id for d in deliveries] == ["x0", "x1", "x2"]
+    assert (before, after) == (3, 0)
+
+
+def test_read_limited_to_count():
+    async def run():
+        server = fakeredis.FakeServer()
+        queue = backend(server, "a")
+        await queue.start()
+        for index in range(5):
+            await queue.put(event(index))
+        return len(await queue.read(2)), len(await queue.read(10))
+
+    assert asyncio.run(run()) == (2, 3)
+
+
+def test_dispatchers_share_and_ack_events():
+    async def run():
+        server = fakeredis.FakeServer()
+        handled: List[str] = []
+        first = dispatcher(backend(server, "a"), handled, delay=0.01)
+        second = dispatcher(backend(server, "b"), handled, delay=0.01)
+        first.start()
+        second.start()
+        for index in range(20):
+            assert await first.submit(event(index))
+        for _ in range(100):
+            if len(handled) == 20:
+                break
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.05)
+        left = await pending(server)
+        await first.stop()
+        await second.stop()
+        return handled, left
+
+    handled, left = asyncio.run(run())
+    assert sorted(handled) == sorted(f"x{index}" for index in range(20))
+    assert left == 0
+
+
+def test_unacknowledged_events_reclaimed():
+    async def run():
+        server = fakeredis.FakeServer()
+        crashed = backend(server, "crashed")
+        await crashed.start()
+        for index in range(3):
+            await crashed.put(event(index))
+        assert len(await crashed.read(10)) == 3
+
+        handled: List[str] = []
+        other = dispatcher(backend(server, "b", reclaim_idle=0.1), handled)
+        await asyncio.sleep(0.1)
+        other.start()
+        await asyncio.sleep(0.3)
+        await other.stop()
+        return handled, await pending(server)
+
+    handled, left = asyncio.run(run())
+    assert sorted(handled) == ["x0", "x1", "x2"]
+    assert left == 0
+
+
+def test_held_events_not_reclaimed():
+    async def run():
+        server = fakeredis.FakeServer()
+        handled: List[str] = []
+        slow = dispatcher(backend(server, "a", reclaim_idle=0.1), handled, delay=0.5)
+        slow.start()
+        await slow.submit(event(0))
+        await asyncio.sleep(0.7)
+        await slow.stop()
+        return handled
+
+    assert asyncio.run(run()) == ["x0"]
+
+
+def test_drain_leaves_unfinished_events_pending():
+    async def run():
+        server = fakeredis.FakeServer()
+        handled: List[str] = []
+        slow = dispatcher(backend(server, "a"), handled, delay=10)
+        slow.start()
+        await slow.submit(event(0))
+        await asyncio.sleep(0.1)
+        unfinished = await slow.stop(timeout=0.1)
+        return unfinished, await pending(server)
+
+    unfinished, left = asyncio.run(run())
+    assert unfinished == []
+    assert left == 1
+
+
+def test_reads_only_what_high_priority_queues_have_room_for():
+    async def run():
+        server = fakeredis.FakeServer()
+        release = asyncio.Event()
+        handled: List[str] = []
+        # One queued event per worker, and plenty of room in the low lane
+        busy = Dispatcher(workers=2, queue_size=2, backend=backend(server, "a"))
+
+        @busy.handler("issue_credential_v2_0", actions=("offer-received",))
+        async def _handle(record):
+            await release.wait()
+            handled.append(record["cred_ex_id"])
+
+        busy.start()
+        for index in range(8):
+            await busy.submit(event(index))
+        await asyncio.sleep(0.2)
+        # In flight and queued, none held waiting for room
+        held = len(busy._held)
+        release.set()
+        for _ in range(100):
+            if len(handled) == 8:
+                break
+            await asyncio.sleep(0.05)
+        await busy.stop()
+        return held, handled
+
+    held, handled = asyncio.run(run())
+    assert held <= 4
+    assert sorted(handled) == sorted(f"x{index}" for index in range(8))
+
+
+def test_shed_events_left_to_be_reclaimed():
+    async def run():
+        server = fakeredis.FakeServer()
+        release = asyncio.Event()
+        handled: List[str] = []
+        busy = Dispatcher(
+            low_workers=1,
+            low_queue_size=1,
+            backend=backend(server, "a", reclaim_idle=0.2),
+        )
+
+        @busy.handler("issue_credential_v2_0")
+        async def _handle(record):
+            await release.wait()
+            handled.append(record["cred_ex_id"])
+
+        busy.start()
+        for index in range(3):
+            await busy.submit(event(index))
+        await asyncio.sleep(0.1)
+        # One in flight, one queued and one shed but not acknowledged
+        before = await pending(server), len(busy._held)
+        release.set()
+        for _ in range(100):
+            if len(handled) == 3:
+                break
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.05)
+        after = await pending(server)
+        await busy.stop()
+        return before, after, handled
+
+    before, after, handled = asyncio.run(run())
+    assert before == (3, 2)
+    assert after == 0
+    assert sorted(handled) == ["x0", "x1", "x2"]
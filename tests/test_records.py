@@ -0,0 +1,46 @@
+"""Tests for the record cache."""
+
+import asyncio
+
+from src.records import RecordCache
+
+
+def test_fetch_shared_by_concurrent_misses():
+    async def run():
+        cache: RecordCache[str] = RecordCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "record"
+
+        results = await asyncio.gather(
+            *(cache.get_or_fetch("x", None, fetch) for _ in range(3))
+        )
+        return results, calls
+
+    results, calls = asyncio.run(run())
+    assert results == ["record"] * 3
+    assert calls == [1]
+
+
+def test_waiter_fetches_again_when_leader_cancelled():
+    async def run():
+        cache: RecordCache[str] = RecordCache()
+
+        async def slow():
+            await asyncio.sleep(10)
+            return "slow"
+
+        async def fast():
+            return "fast"
+
+        leader = asyncio.ensure_future(cache.get_or_fetch("x", None, slow))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_fetch("x", None, fast))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.wait_for(waiter, 1), leader.cancelled()
+
+    assert asyncio.run(run()) == ("fast", True)
@@ -0,0 +1,95 @@
+"""Tests for draining the controller when its server is terminated."""
+
+import json
+import os
+from pathlib import Path
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+import pytest
+
+pytest.importorskip("uvicorn")
+
+from benchmarks import admin_stub  # noqa: E402
+from src.loadgen import read_recording  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post(url: str, body: dict) -> int:
+    request = Request(
+        url, json.dumps(body).encode(), {"content-type": "application/json"}
+    )
+    try:
+        with urlopen(request, timeout=5) as response:
+            return response.status
+    except HTTPError as error:
+        return error.code
+
+
+def credential_received(cred_ex_id: str) -> dict:
+    return {
+        "cred_ex_id": cred_ex_id,
+        "role": "holder",
+        "state": "credential-received",
+        "updated_at": "2024-01-01T00:00:00Z",
+    }
+
+
+def test_sigterm_refuses_webhooks_while_draining(monkeypatch, tmp_path: Path):
+    # Each store takes long enough to still be queued when terminated
+    monkeypatch.setattr(admin_stub, "WALLET_LATENCY", 0.5)
+    drain_file = tmp_path / "drain.ndjson"
+    port = free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join([os.getcwd(), *sys.path]),
+        "DRAIN_FILE": str(drain_file),
+        "DRAIN_TIMEOUT": "1",
+        "DISPATCH_WORKERS": "1",
+    }
+    with admin_stub.serve(port=free_port()) as agent:
+        env["AGENT"] = agent
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src:app", "--port", str(port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            url = f"http://127.0.0.1:{port}/topic/issue_credential_v2_0/"
+            deadline = time.monotonic() + 20
+            while True:
+                try:
+                    urlopen(f"http://127.0.0.1:{port}/cluster", timeout=1).close()
+                    break
+                except (URLError, ConnectionError):
+                    assert time.monotonic() < deadline, "controller did not start"
+                    time.sleep(0.1)
+
+            for index in range(5):
+                assert post(url, credential_received(f"queued-{index}")) == 200
+            server.send_signal(signal.SIGTERM)
+            time.sleep(0.3)
+
+            assert post(url, credential_received("late")) == 503
+            assert server.wait(10) is not None
+        finally:
+            if server.poll() is None:
+                server.kill()
+
+    ids = {
+        json.loads(webhook.body)["cred_ex_id"]
+        for webhook in read_recording(str(drain_file))
+    }
+    assert ids and ids < {f"queued-{index}" for index in range(5)}
+    assert "late" not in ids
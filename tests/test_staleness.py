@@ -0,0 +1,73 @@
+"""Tests for verifying stale events before acting on them."""
+
+import asyncio
+from datetime import datetime, timezone
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+from src.models import V20CredExRecord
+from src.staleness import MaxAge, StaleVerifier, parse_max_ages
+
+TOPIC = "issue_credential_v2_0"
+
+
+def format_timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(
+        "%Y-%m-%d %H:%M:%S.%fZ"
+    )
+
+
+def test_parse_max_ages():
+    assert parse_max_ages("") == {}
+    assert parse_max_ages("60, issue_credential_v2_0:30") == {
+        "*": 60.0,
+        TOPIC: 30.0,
+    }
+    with pytest.raises(ValueError):
+        parse_max_ages("issue_credential:soon")
+
+
+def test_max_age_stale():
+    max_age = MaxAge({TOPIC: 60})
+    assert max_age.stale(TOPIC, format_timestamp(time() - 120))
+    assert not max_age.stale(TOPIC, format_timestamp(time()))
+    assert not max_age.stale(TOPIC, None)
+    assert not max_age.stale("present_proof_v2_0", format_timestamp(time() - 120))
+
+
+def test_verifications_share_one_listing():
+    fetched: List[Tuple[str, str]] = []
+
+    async def fetch(topic: str, state: str) -> Dict[str, Any]:
+        fetched.append((topic, state))
+        return {
+            "current": V20CredExRecord(cred_ex_id="current", state=state),
+            "moved": V20CredExRecord(cred_ex_id="moved", state="done"),
+        }
+
+    async def run() -> Tuple[List[Optional[Any]], int]:
+        verifier = StaleVerifier(fetch, flush_interval=0.01)
+        records = await asyncio.gather(
+            verifier.verify(TOPIC, "offer-received", "current"),
+            verifier.verify(TOPIC, "offer-received", "moved"),
+            verifier.verify(TOPIC, "offer-received", "gone"),
+        )
+        return records, len(verifier._flushes)
+
+    (current, moved, gone), flushes = asyncio.run(run())
+    assert fetched == [(TOPIC, "offer-received")]
+    assert current.cred_ex_id == "current"
+    assert moved is None and gone is None
+    # Flushes are referenced until done
+    assert flushes == 0
+
+
+def test_failed_listing_fails_waiting_verifications():
+    async def fetch(topic: str, state: str) -> Dict[str, Any]:
+        raise RuntimeError("agent unavailable")
+
+    verifier = StaleVerifier(fetch, flush_interval=0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(verifier.verify(TOPIC, "offer-received", "x"))
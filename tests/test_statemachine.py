@@ -0,0 +1,98 @@
+"""Tests for the exchange state machine."""
+
+import asyncio
+from typing import List
+
+import pytest
+
+from src.statemachine import StateMachine
+
+PROTOCOL = "issue_credential_v2_0"
+
+
+@pytest.fixture
+def machine():
+    return StateMachine(tracking_size=2)
+
+
+def test_observe_forward_transitions(machine):
+    assert machine.observe(PROTOCOL, "x", "offer-received")
+    assert machine.observe(PROTOCOL, "x", "request-sent")
+    assert machine.observe(PROTOCOL, "x", "request-sent")
+    assert machine.observe(PROTOCOL, "x", "done")
+
+
+def test_observe_skips_stale_state(machine):
+    assert machine.observe(PROTOCOL, "x", "request-sent")
+    assert not machine.observe(PROTOCOL, "x", "offer-received")
+
+
+def test_observe_skips_after_terminal_state(machine):
+    assert machine.observe(PROTOCOL, "x", "abandoned")
+    assert not machine.observe(PROTOCOL, "x", "done")
+    assert machine.observe(PROTOCOL, "x", "abandoned")
+
+
+def test_observe_skips_unknown_state(machine):
+    assert not machine.observe(PROTOCOL, "x", "bogus")
+
+
+def test_observe_without_exchange_id(machine):
+    assert machine.observe(PROTOCOL, None, "done")
+    assert machine.observe(PROTOCOL, None, "offer-received")
+
+
+def test_observe_forgets_oldest(machine):
+    machine.observe(PROTOCOL, "x", "done")
+    machine.observe(PROTOCOL, "y", "done")
+    machine.observe(PROTOCOL, "z", "done")
+    assert machine.observe(PROTOCOL, "x", "offer-received")
+
+
+def test_observe_tracks_wallets_apart():
+    machine = StateMachine()
+    assert machine.observe(PROTOCOL, "x", "done", "tenant-a")
+    assert machine.observe(PROTOCOL, "x", "offer-received", "tenant-b")
+    assert machine.observe(PROTOCOL, "x", "offer-received")
+    assert not machine.observe(PROTOCOL, "x", "offer-received", "tenant-a")
+
+
+def test_on_rejects_unknown_state(machine):
+    with pytest.raises(ValueError):
+        machine.on(PROTOCOL, "holder", "bogus")
+    with pytest.raises(ValueError):
+        machine.on("bogus", "holder", "done")
+
+
+def test_handle(machine):
+    ran: List[str] = []
+
+    @machine.on(PROTOCOL, "holder", "offer-received")
+    async def _request(record):
+        ran.append(record)
+
+    async def run():
+        return [
+            # Spelling is normalized
+            await machine.handle(PROTOCOL, "holder", "offer_received", "a", "a"),
+            # Roles without an action
+            await machine.handle(PROTOCOL, "issuer", "offer-received", "b", "b"),
+            # Without a role, the only role with an action
+            await machine.handle(PROTOCOL, None, "offer-received", "c", "c"),
+            # No action for the state
+            await machine.handle(PROTOCOL, "holder", "request-sent", "a", "a"),
+            # Stale
+            await machine.handle(PROTOCOL, "holder", "offer-received", "a", "a"),
+            await machine.handle(PROTOCOL, "holder", None, "d", "d"),
+            await machine.handle("bogus", "holder", "offer-received", "d", "d"),
+        ]
+
+    assert asyncio.run(run()) == [True, False, True, False, False, False, False]
+    assert ran == ["a", "c"]
+
+
+def test_action_states(machine):
+    machine.on(PROTOCOL, "holder", "offer-received")(lambda _: None)
+    assert machine.action_states(PROTOCOL) == {"offer-received", "offer_received"}
+    assert machine.acts_on(PROTOCOL, "holder", "offer_received")
+    assert not machine.acts_on(PROTOCOL, "holder", "done")
@@ -0,0 +1,124 @@
+"""Tests for coalescing credential store operations."""
+
+import asyncio
+from typing import List
+
+from src.store import StoreBatcher
+
+
+def test_slow_store_does_not_hold_up_later_stores():
+    stored: List[str] = []
+    release = asyncio.Event()
+
+    async def store(path: str):
+        if path == "slow":
+            await release.wait()
+        stored.append(path)
+        return path
+
+    async def run():
+        batcher = StoreBatcher(store, concurrency=2, batch_size=1)
+        batcher.start()
+        slow = asyncio.ensure_future(batcher.submit("slow"))
+        await asyncio.sleep(0)
+        assert await asyncio.wait_for(batcher.submit("fast"), 1) == "fast"
+        release.set()
+        assert await slow == "slow"
+        await batcher.stop()
+
+    asyncio.run(run())
+    assert stored == ["fast", "slow"]
+
+
+def test_concurrency_is_bounded():
+    running = 0
+    most = 0
+
+    async def store(path: str):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        batcher = StoreBatcher(store, concurrency=3)
+        batcher.start()
+        await asyncio.gather(*(batcher.submit(str(i)) for i in range(10)))
+        await batcher.stop()
+
+    asyncio.run(run())
+    assert most == 3
+
+
+def test_failure_is_per_store():
+    async def store(path: str):
+        if path == "bad":
+            raise ValueError(path)
+        return path
+
+    async def run():
+        batcher = StoreBatcher(store, flush_interval=0.01)
+        batcher.start()
+        results = await asyncio.gather(
+            batcher.submit("good"), batcher.submit("bad"), return_exceptions=True
+        )
+        await batcher.stop()
+        return results
+
+    good, bad = asyncio.run(run())
+    assert good == "good"
+    assert isinstance(bad, ValueError)
+
+
+def test_stop_waits_for_pending_stores():
+    stored: List[str] = []
+
+    async def store(path: str):
+        await asyncio.sleep(0.01)
+        stored.append(path)
+
+    async def run():
+        batcher = StoreBatcher(store)
+        batcher.start()
+        pending = asyncio.ensure_future(batcher.submit("a"))
+        await asyncio.sleep(0)
+        await batcher.stop()
+        await pending
+        assert not batcher.running
+
+    asyncio.run(run())
+    assert stored == ["a"]
+
+
+def test_without_start_stores_directly():
+    async def store(path: str):
+        return path
+
+    assert asyncio.run(StoreBatcher(store).submit("a")) == "a"
+
+
+def test_cancelled_submit_skips_store_not_started():
+    stored: List[str] = []
+    release = asyncio.Event()
+
+    async def store(path: str):
+        await release.wait()
+        stored.append(path)
+
+    async def run():
+        batcher = StoreBatcher(store, concurrency=1)
+        batcher.start()
+        first = asyncio.ensure_future(batcher.submit("started"))
+        second = asyncio.ensure_future(batcher.submit("waiting"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        second.cancel()
+        release.set()
+        await batcher.stop()
+        # The started store is finished, so its caller is not cancelled
+        assert await first is None
+        assert second.cancelled()
+
+    asyncio.run(run())
+    assert stored == ["started"]
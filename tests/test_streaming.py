@@ -0,0 +1,104 @@
+"""Tests for the server-sent event stream."""
+
+import asyncio
+import json
+from typing import List
+
+import pytest
+
+from src import streaming
+from src.events import Event
+from src.streaming import Broadcaster, Subscription, parse_filter
+
+
+def event(topic: str = "connections", **record) -> Event:
+    return Event.from_raw(topic, json.dumps(record).encode())
+
+
+@pytest.fixture
+def decoded(monkeypatch) -> List[Event]:
+    """Record the events whose body is decoded for their connection."""
+    calls: List[Event] = []
+    connection_id = streaming.connection_id
+
+    def _connection_id(event: Event):
+        calls.append(event)
+        return connection_id(event)
+
+    monkeypatch.setattr(streaming, "connection_id", _connection_id)
+    return calls
+
+
+def test_filters():
+    broadcaster = Broadcaster()
+    by_topic = broadcaster.subscribe(Subscription(topics=frozenset(["connections"])))
+    by_state = broadcaster.subscribe(Subscription(states=frozenset(["active"])))
+    by_connection = broadcaster.subscribe(Subscription(connection="c"))
+    broadcaster.publish(event(connection_id="c", state="active"))
+    broadcaster.publish(event("present_proof_v2_0", connection_id="d", state="done"))
+    assert [seq for seq, _ in by_topic.buffer] == [1]
+    assert [seq for seq, _ in by_state.buffer] == [1]
+    assert [seq for seq, _ in by_connection.buffer] == [1]
+
+
+def test_body_decoded_once_per_event(decoded):
+    broadcaster = Broadcaster()
+    subscriptions = [
+        broadcaster.subscribe(Subscription(connection=connection))
+        for connection in ("c", "c", "d")
+    ]
+    broadcaster.publish(event(connection_id="c"))
+    assert len(decoded) == 1
+    assert [len(subscription.buffer) for subscription in subscriptions] == [1, 1, 0]
+
+
+def test_body_not_decoded_without_connection_filter(decoded):
+    broadcaster = Broadcaster()
+    broadcaster.subscribe(Subscription(topics=frozenset(["connections"])))
+    broadcaster.publish(event(connection_id="c"))
+    assert not decoded
+
+
+def test_slow_subscriber_drops_oldest():
+    broadcaster = Broadcaster()
+    subscription = broadcaster.subscribe(Subscription(buffer_size=2))
+    for index in range(5):
+        broadcaster.publish(event(connection_id=str(index)))
+    assert subscription.dropped == 3
+    assert [seq for seq, _ in subscription.buffer] == [4, 5]
+
+
+def test_resume_from_history():
+    broadcaster = Broadcaster(history_size=3)
+    for connection in ("c", "d", "c", "c"):
+        broadcaster.publish(event(connection_id=connection))
+    subscription = broadcaster.subscribe(Subscription(connection="c"), 2)
+    assert [seq for seq, _ in subscription.buffer] == [3, 4]
+
+
+def test_stream():
+    broadcaster = Broadcaster()
+    subscription = Subscription(buffer_size=1)
+
+    async def disconnected() -> bool:
+        return False
+
+    async def run() -> List[bytes]:
+        stream = broadcaster.stream(subscription, disconnected, max_seconds=0.5)
+        chunks = [await stream.__anext__()]
+        broadcaster.publish(event(connection_id="c"))
+        broadcaster.publish(event(connection_id="d"))
+        chunks += [await stream.__anext__(), await stream.__anext__()]
+        await stream.aclose()
+        return chunks
+
+    retry, dropped, line = asyncio.run(run())
+    assert retry.startswith(b"retry:")
+    assert dropped == b'event: dropped\ndata: {"count": 1}\n\n'
+    assert line.startswith(b"id: 2\nevent: connections\ndata: ")
+    assert not broadcaster.subscriptions
+
+
+def test_parse_filter():
+    assert parse_filter(None) is None
+    assert parse_filter(["a,b", " c ", ""]) == frozenset(["a", "b", "c"])
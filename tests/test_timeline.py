@@ -0,0 +1,73 @@
+"""Tests for per-exchange timelines."""
+
+from typing import List
+
+import pytest
+
+from src import timeline
+from src.timeline import Timelines
+
+TOPIC = "issue_credential_v2_0"
+
+
+@pytest.fixture
+def clock(monkeypatch) -> List[float]:
+    """Make the timelines' clock return the last time appended."""
+    now = [0.0]
+    monkeypatch.setattr(timeline, "time", lambda: now[-1])
+    return now
+
+
+def test_records_states_and_actions(clock):
+    timelines = Timelines()
+    timelines.state(TOPIC, "x", "offer-received")
+    clock.append(1.5)
+    timelines.action(TOPIC, "x", "send-request")
+    clock.append(4.0)
+    timelines.action(TOPIC, "x", "store", final=True)
+    # Without an exchange or state nothing is recorded
+    timelines.state(TOPIC, None, "offer-received")
+    timelines.state(TOPIC, "y", None)
+
+    recorded = timelines.get("x")
+    assert recorded.topic == TOPIC
+    assert recorded.duration == 4.0
+    assert [(entry.name, entry.at) for entry in recorded.entries] == [
+        ("offer-received", 0.0),
+        ("action:send-request", 1.5),
+        ("action:store", 4.0),
+    ]
+    assert timelines.get("y") is None
+
+
+def test_bounded(clock):
+    timelines = Timelines(max_size=2, max_entries=2)
+    for exchange_id in ("a", "b", "c"):
+        timelines.state(TOPIC, exchange_id, "offer-received")
+    assert timelines.get("a") is None
+
+    clock.append(1.0)
+    timelines.state(TOPIC, "b", "request-sent")
+    clock.append(2.0)
+    timelines.state(TOPIC, "b", "done")
+    # The last entry is replaced once the timeline is full
+    assert [entry.name for entry in timelines.get("b").entries] == [
+        "offer-received",
+        "done",
+    ]
+
+
+def test_slowest(clock):
+    timelines = Timelines()
+    for exchange_id in ("fast", "slow", "medium"):
+        timelines.state(TOPIC, exchange_id, "offer-received")
+    for exchange_id, at in (("fast", 1.0), ("medium", 5.0), ("slow", 10.0)):
+        clock.append(at)
+        timelines.action(TOPIC, exchange_id, "store", final=True)
+
+    slowest = timelines.slowest(limit=2)
+    assert [exchange.exchange_id for exchange in slowest] == ["slow", "medium"]
+    assert [e.exchange_id for e in timelines.slowest(min_duration=5)] == [
+        "slow",
+        "medium",
+    ]